@@ -0,0 +1,158 @@
+import argparse
+import json
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from results_store import SCORE_VARIABLES, ResultsStore
+
+VARIABLE_LABELS = {
+    "mention_support": "Support",
+    "mention_opp": "Opposition",
+    "physical_opp": "Physical",
+    "policy_opp": "Policy",
+    "legal_opp": "Legal",
+    "opinion_opp": "Opinion",
+    "environmental_opp": "Environmental",
+    "participation_opp": "Participation",
+    "tribal_opp": "Tribal",
+    "health_opp": "Health",
+    "intergov_opp": "Intergovt",
+    "property_opp": "Property",
+    "compensation": "Compensation",
+    "delay": "Delay",
+    "co_land_use": "Co-Use",
+}
+
+NO_RELEVANT_INFO = "No relevant info"
+
+
+@dataclass
+class ScoreMatrix:
+    """The first summary of every scored plant as a plants x 15 binary matrix (columns in SCORE_VARIABLES order)."""
+    plant_codes: np.ndarray
+    values: np.ndarray
+    no_relevant_info: np.ndarray
+
+
+@dataclass
+class ArticleGrades:
+    """Ragged article grades: the grades of plant_codes[i] are grades[offsets[i]:offsets[i + 1]]."""
+    plant_codes: np.ndarray
+    offsets: np.ndarray
+    grades: np.ndarray
+
+    def mean(self):
+        """Average grade per plant (NaN for plants without graded articles)."""
+        counts = np.diff(self.offsets)
+        cumulative = np.concatenate([[0], np.cumsum(self.grades, dtype=np.float64)])
+        sums = cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def load_scores(store=None):
+    df = (store or ResultsStore()).load('scores')
+    df = df[df['entry'] == 0].sort_values('plant_code')
+    values = df[SCORE_VARIABLES].fillna(0).to_numpy(dtype=np.int8)
+    # anything other than 0/1 (e.g. a stray 2) counts as evidence found
+    values = (values > 0).astype(np.uint8)
+    no_relevant_info = df['narrative'].fillna('').str.contains(NO_RELEVANT_INFO, regex=False).to_numpy()
+    return ScoreMatrix(df['plant_code'].to_numpy(dtype=np.int64), values, no_relevant_info)
+
+
+def load_grades(store=None):
+    df = (store or ResultsStore()).load('article_relevance', columns=['plant_code', 'grade'])
+    plant_codes, counts = np.unique(df['plant_code'].to_numpy(dtype=np.int64), return_counts=True)
+    order = np.argsort(df['plant_code'].to_numpy(), kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return ArticleGrades(plant_codes, offsets, df['grade'].to_numpy(dtype=np.int8)[order])
+
+
+def align(plant_codes, target_codes):
+    """Index of each target plant code in plant_codes, or -1 if it is missing."""
+    if len(plant_codes) == 0:
+        return np.full(len(target_codes), -1)
+    position = np.clip(np.searchsorted(plant_codes, target_codes), 0, len(plant_codes) - 1)
+    return np.where(plant_codes[position] == target_codes, position, -1)
+
+
+def take(values, index, fill=np.nan):
+    """values[index] for the plants align found, `fill` for the rest (and for all of them if values is empty)."""
+    if len(values) == 0:
+        return np.full((len(index),) + values.shape[1:], fill)
+    found = (index >= 0).reshape((len(index),) + (1,) * (values.ndim - 1))
+    return np.where(found, values[np.maximum(index, 0)], fill)
+
+
+def group_stats(keys, values, label='group'):
+    """
+    Count and percentage of 1s per column of a binary plants x k matrix for each
+    distinct key, using one bincount per column instead of a pandas groupby.
+    """
+    groups, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(groups))
+    sums = np.stack([np.bincount(inverse, weights=values[:, j], minlength=len(groups))
+                     for j in range(values.shape[1])], axis=1)
+    stats = pd.DataFrame(sums.astype(np.int64), columns=SCORE_VARIABLES[:values.shape[1]])
+    stats.insert(0, label, groups)
+    stats.insert(1, 'count', counts)
+    for j, variable in enumerate(SCORE_VARIABLES[:values.shape[1]]):
+        stats[f'percentage_{variable}'] = 100 * sums[:, j] / counts
+    return stats
+
+
+def capacity_bins(capacity, width=10):
+    """Lower edge of the [edge, edge + width) capacity bin of each plant, as in the analysis notebook."""
+    return (np.floor_divide(capacity, width) * width).astype(np.int64)
+
+
+def summarize(plants, store=None, bin_width=10):
+    """
+    Every metric of analysis.ipynb in one pass over the arrays: variable
+    frequencies, all-zero and "No relevant info" counts, average article grade
+    per plant, and opposition/support percentages by capacity bin, state and
+    tech_type. `plants` is the plants DataFrame (plant_code, capacity, state,
+    tech_type), e.g. ready_to_search.csv.
+    """
+    store = store or ResultsStore()
+    scores = load_scores(store)
+    grades = load_grades(store)
+
+    frequency = scores.values.sum(axis=0)
+    plant_codes = plants['plant_code'].to_numpy(dtype=np.int64)
+    avg_relevance_score = take(grades.mean(), align(grades.plant_codes, plant_codes))
+
+    # plants without scores count as 0 for every variable, like the notebook's mention_opp column
+    plant_values = take(scores.values, align(scores.plant_codes, plant_codes), 0)
+    capacity = plants['capacity'].to_numpy(dtype=np.float64)
+    has_capacity = ~np.isnan(capacity)
+
+    return {
+        'scored_plants': len(scores.plant_codes),
+        'files_with_all_zeros': int((scores.values.sum(axis=1) == 0).sum()),
+        'files_with_no_relevant_info': int(scores.no_relevant_info.sum()),
+        'variable_frequency': {VARIABLE_LABELS[v]: int(n) for v, n in zip(SCORE_VARIABLES, frequency)},
+        'variable_percentage': {VARIABLE_LABELS[v]: float(100 * n / max(frequency.sum(), 1))
+                                for v, n in zip(SCORE_VARIABLES, frequency)},
+        'avg_relevance_score': pd.Series(avg_relevance_score, index=plant_codes, name='avg_relevance_score'),
+        'by_capacity_bin': group_stats(capacity_bins(capacity[has_capacity], bin_width),
+                                       plant_values[has_capacity], 'capacity_bin'),
+        'by_state': group_stats(plants['state'].astype(str).to_numpy(), plant_values, 'state'),
+        'by_tech_type': group_stats(plants['tech_type'].astype(str).to_numpy(), plant_values, 'tech_type'),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate statistics of the project scores")
+    parser.add_argument('--plants', default='ready_to_search.csv')
+    parser.add_argument('--output', default='aggregate_statistics_with_labels.json')
+    args = parser.parse_args()
+
+    summary = summarize(pd.read_csv(args.plants))
+    stats = {key: summary[key] for key in
+             ('files_with_all_zeros', 'files_with_no_relevant_info', 'variable_frequency')}
+    with open(args.output, 'w') as f:
+        json.dump(stats, f)
+    print(json.dumps(stats, indent=2))
+    print(summary['by_tech_type'][['tech_type', 'count', 'percentage_mention_opp', 'percentage_mention_support']])
@@ -1,15 +1,17 @@
 import streamlit as st
-import pandas as pd
 import json
 import gspread
 import dotenv
-import os
-import pandas as pd
-from streamlit_js_eval import streamlit_js_eval
+
+from label_store import LabelStore, SheetSync
 
 
 dotenv.load_dotenv()
 
+SHEET_URL = "https://docs.google.com/spreadsheets/d/1NaitOeamRWgkJlj5JCBmyJwwImgC-o2qAeIvlg2w9eI/edit#gid=309366946"
+# tasks claimed ahead for each labeler, so submitting never waits on a claim
+PREFETCH = 5
+
 @st.cache_resource
 def get_gc():
     """Get gspread client"""
@@ -18,13 +20,22 @@ def get_gc():
     gc = gspread.service_account(filename="gcloud.json")
     return gc
 
-st.set_page_config(layout="wide")
-
-gc = get_gc()
-sh = gc.open_by_url("https://docs.google.com/spreadsheets/d/1NaitOeamRWgkJlj5JCBmyJwwImgC-o2qAeIvlg2w9eI/edit#gid=309366946")
+@st.cache_resource
+def get_store():
+    """
+    Local label store shared by every session of this server, with the sheet
+    as sync target. The sheet is read in full only when the store is empty.
+    """
+    store = LabelStore()
+    sync = SheetSync(get_gc().open_by_url(SHEET_URL).sheet1, store)
+    if store.stats()['tasks'] == 0:
+        sync.pull()
+    # a single thread updates the sheet in the background, in batches
+    return store, sync.start()
 
+st.set_page_config(layout="wide")
 
-db = pd.DataFrame(sh.sheet1.get_all_records())
+store, sync = get_store()
 
 st.info("""
 ### Guidelines
@@ -41,7 +52,23 @@ A result is relevant if it contains any of the following:
 
 name = st.text_input("What is your name?")
 
-active_row = db[(db['human'].isna()) | (db['human'] == '')].iloc[0]
+if type(name) != str or name == "":
+    st.error("Please enter your name to start labeling.")
+    st.stop()
+
+if st.session_state.get('labeler') != name or not st.session_state.get('queue'):
+    st.session_state['labeler'] = name
+    st.session_state['queue'] = store.claim(name, PREFETCH)
+
+if st.session_state.get('discarded') is not None:
+    st.warning(f"Your labels for row {st.session_state.pop('discarded')} were not saved: your claim on it expired "
+               "and someone else labeled it first.")
+
+if not st.session_state['queue']:
+    st.success("Every search result has been labeled. Thank you!")
+    st.stop()
+
+active_row = st.session_state['queue'][0]
 
 st.info(f"These are results from the following search query:\n\n {active_row['query']}")
 
@@ -59,13 +86,18 @@ for j, result in enumerate(json.loads(active_row['result'])):
     {result['description'] if "description" in result else "No description available"}
     """
 
-    results[j] = st.checkbox("Is this relevant (would you click this)?", key=f"{j}")
+    results[j] = st.checkbox("Is this relevant (would you click this)?", key=f"{active_row['id']}-{j}")
 
 
 if st.button("Submit Results", use_container_width=True):
-    if type(name) == str and name != "":
-        db.loc[active_row.name, 'human'] = json.dumps({"name": name, "submission": results})
-        sh.sheet1.update([db.columns.values.tolist()] + db.values.tolist())
-        streamlit_js_eval(js_expressions="parent.window.location.reload()")
+    # False if someone picked the row up after this labeler's claim expired; their label wins
+    if store.submit(active_row['id'], name, json.dumps({"name": name, "submission": results})):
+        sync.notify()
+        st.session_state['queue'].pop(0)
+        if len(st.session_state['queue']) < PREFETCH // 2 + 1:
+            st.session_state['queue'] = store.claim(name, PREFETCH)
     else:
-        st.error("Please enter your name and submit again.")
+        st.session_state['discarded'] = active_row['id']
+        # the rest of the prefetched rows may have expired too: renew the ones still held, replace the others
+        st.session_state['queue'] = store.claim(name, PREFETCH)
+    st.rerun()
@@ -0,0 +1,438 @@
+import argparse
+import asyncio
+import atexit
+import importlib
+import inspect
+import multiprocessing
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', 'cache/jobs.db')
+LEASE_SECONDS = 60
+POLL_SECONDS = 0.5
+# attempts per job, counting both exceptions and workers that died holding it
+MAX_ATTEMPTS = 3
+
+
+class JobFailed(Exception):
+    """A job raised on every attempt, or its workers kept dying."""
+
+
+def main_module_name():
+    """
+    The importable name of the script running as __main__: its name under
+    `python -m`, otherwise the file name, which workers import from the
+    script's directory (on their sys.path when started by this process) or
+    from their working directory.
+    """
+    main = sys.modules['__main__']
+    spec = getattr(main, '__spec__', None)
+    if spec is not None and spec.name:
+        return spec.name
+    if getattr(main, '__file__', None) is None:
+        raise ValueError("functions defined interactively can't run on workers: define them in a module "
+                         "and call its entrypoint with `python backends.py run module:main`")
+    return os.path.splitext(os.path.basename(main.__file__))[0]
+
+
+def function_name(fn):
+    # a worker can't import __main__, which is the worker itself there
+    module = main_module_name() if fn.__module__ == '__main__' else fn.__module__
+    return f'{module}:{fn.__qualname__}'
+
+
+def resolve(name):
+    """The plain function behind module:qualname, unwrapping a backend's decorator."""
+    module_name, qualname = name.split(':')
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return getattr(obj, 'fn', obj)
+
+
+class JobQueue:
+    """
+    Durable job queue in SQLite, shared by the processes that submit jobs and
+    the workers that run them, on one machine or on several that mount the
+    same filesystem (create it with shared_fs=True there: WAL needs shared
+    memory, which network filesystems don't provide).
+
+    A worker claims a job with a lease and keeps extending it with heartbeats
+    while the function runs. A job whose lease ran out (its worker was killed,
+    or its machine went away) is claimed again by the next worker, up to
+    max_attempts. Results and errors are pickled into the row until the
+    submitter collects them.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH, shared_fs=False):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute(f"PRAGMA journal_mode={'DELETE' if shared_fs else 'WAL'}")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                batch TEXT NOT NULL,
+                function TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                result BLOB,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+            CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch, status);
+        """)
+
+    def submit(self, name, calls, max_attempts=MAX_ATTEMPTS):
+        """Queues one job per (args, kwargs) in calls; returns the batch id and the job ids in order."""
+        batch = uuid.uuid4().hex
+        now = time.time()
+        ids = []
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for args, kwargs in calls:
+                    cursor = self.conn.execute(
+                        "INSERT INTO jobs (batch, function, payload, max_attempts, created_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (batch, name, pickle.dumps((args, kwargs)), max_attempts, now, now))
+                    ids.append(cursor.lastrowid)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return batch, ids
+
+    def claim(self, worker, lease=LEASE_SECONDS):
+        """Leases the oldest runnable job to `worker`; returns (id, function, args, kwargs) or None."""
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'abandoned by its workers', updated_at = ? "
+                    "WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts", (now, now))
+                row = self.conn.execute(
+                    "SELECT id, function, payload FROM jobs "
+                    "WHERE status = 'pending' OR (status = 'running' AND lease_expires < ?) ORDER BY id LIMIT 1",
+                    (now,)).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, "
+                        "lease_expires = ?, updated_at = ? WHERE id = ?", (worker, now + lease, now, row[0]))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        args, kwargs = pickle.loads(row[2])
+        return row[0], row[1], args, kwargs
+
+    def heartbeat(self, job_id, worker, lease=LEASE_SECONDS):
+        """Extends the lease; False if the job was given to another worker meanwhile."""
+        now = time.time()
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + lease, now, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (pickle.dumps(result), time.time(), job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        """Puts the job back in the queue, or marks it failed once it used up its attempts."""
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_expires = NULL, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (error, time.time(), job_id, worker))
+
+    def finished(self, batch):
+        """{job id: (status, result, error)} of the batch's done and failed jobs, which are removed."""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "SELECT id, status, result, error FROM jobs WHERE batch = ? AND status IN ('done', 'failed')",
+                    (batch,)).fetchall()
+                self.conn.execute("DELETE FROM jobs WHERE batch = ? AND status IN ('done', 'failed')", (batch,))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return {job_id: (status, pickle.loads(result) if result is not None else None, error)
+                for job_id, status, result, error in rows}
+
+    def counts(self):
+        with self._lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def cancel(self, batch):
+        """Drops what is left of a batch its submitter stopped waiting for; running jobs finish into nothing."""
+        with self._lock:
+            self.conn.execute("DELETE FROM jobs WHERE batch = ?", (batch,))
+
+    def close(self):
+        self.conn.close()
+
+
+def check(job_id, status, result, error):
+    if status == 'failed':
+        raise JobFailed(f"job {job_id}: {error}")
+    return result
+
+
+class Remote:
+    """`fn.remote(...)` and `await fn.remote.aio(...)`, as on a Modal function."""
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args, **kwargs):
+        [result] = self.function.starmap([args], kwargs)
+        return result
+
+    async def aio(self, *args, **kwargs):
+        self.function.backend.start_workers()
+        queue = self.function.backend.queue()
+        batch, (job_id,) = queue.submit(self.function.name, [(args, kwargs)], self.function.max_attempts)
+        try:
+            while True:
+                finished = await asyncio.to_thread(queue.finished, batch)
+                if job_id in finished:
+                    return check(job_id, *finished[job_id])
+                await asyncio.sleep(POLL_SECONDS)
+        finally:
+            queue.cancel(batch)
+
+
+class LocalFunction:
+    """
+    A function registered with LocalBackend. Calling it runs it in this
+    process; `.map`, `.starmap` and `.remote` run it on the job queue's
+    workers, so code written against a Modal function works unchanged.
+    """
+
+    def __init__(self, backend, fn, max_attempts=MAX_ATTEMPTS):
+        self.backend = backend
+        self.fn = fn
+        self.name = function_name(fn)
+        self.max_attempts = max_attempts
+        self.remote = Remote(self)
+
+    def __call__(self, *args, **kwargs):
+        return self.local(*args, **kwargs)
+
+    def local(self, *args, **kwargs):
+        return call(self.fn, args, kwargs)
+
+    def map(self, *iterables, kwargs=None):
+        return self.starmap(zip(*iterables), kwargs)
+
+    def starmap(self, arg_tuples, kwargs=None):
+        """Results in input order, yielded as soon as they (and every earlier one) are done."""
+        self.backend.start_workers()
+        queue = self.backend.queue()
+        batch, ids = queue.submit(self.name, [(tuple(args), kwargs or {}) for args in arg_tuples], self.max_attempts)
+        results = {}
+        try:
+            for job_id in ids:
+                while job_id not in results:
+                    results.update(queue.finished(batch))
+                    if job_id not in results:
+                        time.sleep(POLL_SECONDS)
+                yield check(job_id, *results.pop(job_id))
+        finally:
+            queue.cancel(batch)
+
+
+class LocalBackend:
+    """
+    Runs registered functions on workers of a JobQueue: `python backends.py
+    worker` processes on this machine and on any other machine sharing the
+    queue's filesystem. With `workers`, that many worker processes are also
+    started here on the first map and stopped when this process exits.
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH, workers=0, shared_fs=False):
+        self.path = path
+        self.workers = workers
+        self.shared_fs = shared_fs
+        self.processes = []
+        self._queue = None
+
+    def queue(self):
+        if self._queue is None:
+            self._queue = JobQueue(self.path, self.shared_fs)
+        return self._queue
+
+    def function(self, retries=None, **options):
+        """
+        Decorator taking stub.function's options. `retries` sets the attempts
+        per job; concurrency is the number of workers, so the rest is ignored.
+        """
+        def register(fn):
+            return LocalFunction(self, fn, MAX_ATTEMPTS if retries is None else retries + 1)
+        return register
+
+    def local_entrypoint(self):
+        return lambda fn: fn
+
+    def start_workers(self):
+        if self.processes or not self.workers:
+            return
+        self.processes = start_workers(self.workers, self.path, self.shared_fs)
+        atexit.register(stop_workers, self.processes)
+
+
+class ModalBackend:
+    """stub.function / stub.local_entrypoint as before."""
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def function(self, **options):
+        return self.stub.function(**options)
+
+    def local_entrypoint(self):
+        return self.stub.local_entrypoint()
+
+
+def get_backend(stub=None):
+    """
+    The backend chosen by EXECUTION_BACKEND: 'modal' (the default) with the
+    given stub, or 'local' for the job queue, with EXECUTION_WORKERS workers
+    started by this process (default: one per CPU; 0 leaves the work to
+    `python backends.py worker`).
+    """
+    if os.environ.get('EXECUTION_BACKEND', 'modal') == 'local' or stub is None:
+        return LocalBackend(
+            workers=int(os.environ.get('EXECUTION_WORKERS', os.cpu_count())),
+            shared_fs=bool(os.environ.get('JOB_QUEUE_SHARED_FS')),
+        )
+    return ModalBackend(stub)
+
+
+def call(fn, args, kwargs):
+    result = fn(*args, **kwargs)
+    if inspect.isawaitable(result):
+        result = asyncio.run(result)
+    return result
+
+
+def run_worker(path=JOB_QUEUE_PATH, shared_fs=False, lease=LEASE_SECONDS, max_idle=None):
+    """Claims and runs jobs until interrupted, or until the queue stayed empty for max_idle seconds."""
+    # functions are resolved by importing their module, whose backend.function then registers them locally
+    os.environ['EXECUTION_BACKEND'] = 'local'
+    os.environ['EXECUTION_WORKERS'] = '0'
+    queue = JobQueue(path, shared_fs)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    idle_since = time.monotonic()
+    functions = {}
+    while max_idle is None or time.monotonic() - idle_since < max_idle:
+        job = queue.claim(worker, lease)
+        if job is None:
+            time.sleep(POLL_SECONDS)
+            continue
+        job_id, name, args, kwargs = job
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_leased, args=(queue, job_id, worker, lease, stop), daemon=True)
+        heartbeat.start()
+        try:
+            if name not in functions:
+                functions[name] = resolve(name)
+            result = call(functions[name], args, kwargs)
+        except Exception as e:
+            queue.fail(job_id, worker, f"{type(e).__name__}: {e}")
+        else:
+            queue.complete(job_id, worker, result)
+        finally:
+            stop.set()
+            heartbeat.join()
+        idle_since = time.monotonic()
+    queue.close()
+
+
+def keep_leased(queue, job_id, worker, lease, stop):
+    while not stop.wait(lease / 3):
+        if not queue.heartbeat(job_id, worker, lease):
+            # another worker has it now; whichever finishes second is ignored
+            return
+
+
+def start_workers(n, path=JOB_QUEUE_PATH, shared_fs=False, lease=LEASE_SECONDS):
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for _ in range(n):
+        # not daemonic: fetch.py's partition pool starts processes of its own
+        process = context.Process(target=run_worker, args=(path, shared_fs, lease))
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def stop_workers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Workers and status of the local job queue")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help="run jobs from the queue")
+    worker_parser.add_argument('-n', '--workers', type=int, default=os.cpu_count())
+    worker_parser.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                               help="seconds without a heartbeat before a job is handed to another worker")
+    run_parser = subparsers.add_parser('run', help="call a module:function entrypoint on the local backend")
+    run_parser.add_argument('entrypoint', help="e.g. local_parallel:main")
+    run_parser.add_argument('-n', '--workers', type=int, default=os.cpu_count(),
+                            help="workers started on this machine (0: only external workers)")
+    subparsers.add_parser('status', help="count jobs per status")
+    parser.add_argument('--path', default=JOB_QUEUE_PATH)
+    parser.add_argument('--shared-fs', action='store_true', help="the queue is on a network filesystem")
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        sys.path.insert(0, os.getcwd())
+        processes = start_workers(args.workers, args.path, args.shared_fs, args.lease)
+        try:
+            while True:
+                # a worker that died (e.g. killed for memory) is replaced; its job goes back once its lease runs out
+                for i, process in enumerate(processes):
+                    if not process.is_alive():
+                        processes[i], = start_workers(1, args.path, args.shared_fs, args.lease)
+                time.sleep(5)
+        except KeyboardInterrupt:
+            stop_workers(processes)
+    elif args.command == 'run':
+        os.environ.update(EXECUTION_BACKEND='local', EXECUTION_WORKERS=str(args.workers), JOB_QUEUE_PATH=args.path)
+        if args.shared_fs:
+            os.environ['JOB_QUEUE_SHARED_FS'] = '1'
+        sys.path.insert(0, os.getcwd())
+        module_name, attr = args.entrypoint.split(':')
+        call(getattr(importlib.import_module(module_name), attr), (), {})
+    else:
+        counts = JobQueue(args.path, args.shared_fs).counts()
+        print(', '.join(f"{status}: {count}" for status, count in sorted(counts.items())) or "no jobs")
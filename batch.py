@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import time
+
+import anthropic
+from dotenv import load_dotenv
+from instructor import openai_schema
+from pydantic import ValidationError
+
+from llm_scheduler import scheduler
+from deps import Dependencies
+from local_parallel import (ArticleRelevanceScores, ContentRelevance, ProjectSummary, content_relevance_request,
+                            project_summary_request, relevance_scores_request)
+from pipeline import STAGES, search_result_string
+from results_io import RESULTS_DIR, Manifest, atomic_write, encode, iter_plants, read_result
+
+BATCH_DIR = os.path.join(RESULTS_DIR, 'batches')
+# the API accepts up to 100,000 requests per batch; smaller batches finish sooner
+MAX_BATCH_SIZE = 10000
+
+
+def article_relevance_request(plant):
+    search_results = search_result_string(plant)
+    if search_results is None:
+        return None
+    return relevance_scores_request(plant['search_query'], search_results, plant['plant_info'])
+
+
+def content_relevance_batch_request(plant):
+    search_results = search_result_string(plant)
+    if search_results is None:
+        return None
+    return content_relevance_request(plant['search_query'], search_results, plant['plant_info'])
+
+
+def scores_request(plant):
+    content = read_result('relevant_content', plant['plant_code'])
+    return project_summary_request(plant['plant_info'], content['relevant_content_text'])
+
+
+# stage -> (request builder, response model, dependencies). A builder returning None
+# means the stage's result is known without a call (no organic results -> []).
+BATCH_STAGES = {
+    'article_relevance': (article_relevance_request, ArticleRelevanceScores, ['search']),
+    'content_relevance': (content_relevance_batch_request, ContentRelevance, ['search']),
+    'scores': (scores_request, ProjectSummary, ['relevant_content']),
+}
+
+
+def to_batch_params(request):
+    """
+    Turns a *_request dict (instructor style: response_model plus system/user
+    messages) into raw Messages API params, using the same forced tool call that
+    instructor's Anthropic tools mode sends.
+    """
+    params = dict(request)
+    response_model = params.pop('response_model')
+    system = []
+    messages = []
+    for message in params['messages']:
+        if message['role'] != 'system':
+            messages.append(message)
+        elif isinstance(message['content'], str):
+            system.append({'type': 'text', 'text': message['content']})
+        else:
+            system.extend(message['content'])
+    tool = openai_schema(response_model).anthropic_schema
+    params.update(messages=messages, tools=[tool], tool_choice={'type': 'tool', 'name': tool['name']})
+    if system:
+        params['system'] = system
+    return params
+
+
+def parse_message(message, response_model):
+    for block in message.content:
+        if block.type == 'tool_use':
+            return response_model.model_validate(block.input)
+    raise ValueError(f"No tool_use block in response (stop_reason={message.stop_reason})")
+
+
+class BatchRunner:
+    """
+    Scores one stage through the Message Batches API. Submitted batch ids are
+    saved in results/batches/<stage>.json, so an interrupted run resumes polling
+    instead of paying for the same requests again. Results are validated against
+    the stage's pydantic model and written to results/<stage>/{plant_code}.json.
+    Only requests that errored, expired or failed validation are submitted again.
+    With `dependencies` (a deps.Dependencies), results are recorded with their
+    inputs and results whose inputs changed are scored again, as in pipeline.py.
+    """
+
+    def __init__(self, stage, client, manifest, poll_interval=60, max_rounds=3, max_batch_size=MAX_BATCH_SIZE,
+                 dependencies=None):
+        self.stage = stage
+        self.build_request, self.response_model, self.deps = BATCH_STAGES[stage]
+        self.client = client
+        self.manifest = manifest
+        self.poll_interval = poll_interval
+        self.max_rounds = max_rounds
+        self.max_batch_size = max_batch_size
+        self.state_path = os.path.join(BATCH_DIR, f'{stage}.json')
+        self.in_flight = self.load_state()
+        self.dependencies = dependencies
+        # plant_code -> request in the *_request form, for the response cache and resubmission
+        self.requests = {}
+        # plant_code -> inputs recorded with the result
+        self.inputs = {}
+
+    def load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def save_state(self):
+        atomic_write(self.state_path, encode(self.in_flight))
+
+    def custom_id(self, plant_code):
+        return f"{self.stage}-{plant_code}"
+
+    def submit(self, requests):
+        """requests maps plant_code -> batch params; returns the new batch ids."""
+        items = list(requests.items())
+        batch_ids = []
+        for start in range(0, len(items), self.max_batch_size):
+            chunk = items[start:start + self.max_batch_size]
+            batch = self.client.messages.batches.create(requests=[
+                {'custom_id': self.custom_id(plant_code), 'params': params} for plant_code, params in chunk
+            ])
+            self.in_flight[batch.id] = {'plant_codes': [plant_code for plant_code, _ in chunk]}
+            self.save_state()
+            batch_ids.append(batch.id)
+            print(f"Submitted batch {batch.id} with {len(chunk)} {self.stage} requests")
+        return batch_ids
+
+    def collect(self, batch_id):
+        """Writes the successful results of an ended batch and returns the plant codes that failed."""
+        plant_codes = {self.custom_id(pc): pc for pc in self.in_flight[batch_id]['plant_codes']}
+        failed = set(plant_codes.values())
+        for entry in self.client.messages.batches.results(batch_id):
+            plant_code = plant_codes.get(entry.custom_id)
+            if plant_code is None:
+                continue
+            if entry.result.type != 'succeeded':
+                print(f"{self.stage} {entry.result.type} for plant code {plant_code}")
+                continue
+            message = entry.result.message
+            scheduler.log_usage(message.model, self.response_model, message.usage, mode='batch')
+            try:
+                result = parse_message(message, self.response_model)
+            except (ValidationError, ValueError) as e:
+                print(f"{self.stage} response for plant code {plant_code} failed validation: {e}")
+                continue
+            cache = scheduler.response_cache()
+            if cache is not None and plant_code in self.requests:
+                cache.put(self.requests[plant_code], result)
+            self.manifest.write(self.stage, plant_code, result.model_dump(), self.inputs.get(plant_code))
+            failed.discard(plant_code)
+        return failed
+
+    def wait(self):
+        """Polls every in-flight batch until it ends; returns the plant codes to retry."""
+        failed = set()
+        while self.in_flight:
+            for batch_id in list(self.in_flight):
+                batch = self.client.messages.batches.retrieve(batch_id)
+                if batch.processing_status != 'ended':
+                    continue
+                failed |= self.collect(batch_id)
+                del self.in_flight[batch_id]
+                self.save_state()
+            if self.in_flight:
+                time.sleep(self.poll_interval)
+        return failed
+
+    def outdated(self, plant):
+        return self.dependencies is not None and bool(self.dependencies.changed(self.stage, plant))
+
+    def run(self, plants):
+        cache = scheduler.response_cache()
+        in_flight_codes = {pc for batch in self.in_flight.values() for pc in batch['plant_codes']}
+        to_submit = []
+        for plant in plants:
+            plant_code = plant['plant_code']
+            if self.manifest.status(plant_code, self.stage) is not None and not self.outdated(plant):
+                continue
+            if not all(self.manifest.status(plant_code, dep) == 'done' for dep in self.deps):
+                continue
+            if self.dependencies is not None:
+                self.inputs[plant_code] = self.dependencies.inputs(self.stage, plant)
+            request = self.build_request(plant)
+            if request is None:
+                self.manifest.write(self.stage, plant_code, [], self.inputs.get(plant_code))
+                continue
+            cached = cache.get(request) if cache is not None else None
+            if cached is not None:
+                self.manifest.write(self.stage, plant_code, cached.model_dump(), self.inputs.get(plant_code))
+                continue
+            self.requests[plant_code] = request
+            # requests of resumed batches are kept too, in case they have to be resubmitted
+            if plant_code not in in_flight_codes:
+                to_submit.append(plant_code)
+
+        if in_flight_codes:
+            print(f"Resuming {len(self.in_flight)} in-flight {self.stage} batches")
+        for round_number in range(self.max_rounds):
+            if to_submit:
+                self.submit({plant_code: to_batch_params(self.requests[plant_code]) for plant_code in to_submit})
+            failed = self.wait()
+            if not failed:
+                return set()
+            print(f"Round {round_number + 1}: {len(failed)} {self.stage} requests failed")
+            to_submit = [plant_code for plant_code in failed if plant_code in self.requests]
+        return failed
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Offline scoring through the Message Batches API")
+    parser.add_argument('--stages', nargs='+', choices=list(BATCH_STAGES), default=list(BATCH_STAGES))
+    parser.add_argument('--plants', default='ready_to_search.csv', help="csv with plant_code, search_query, plant_info")
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--poll-interval', type=float, default=60)
+    parser.add_argument('--max-rounds', type=int, default=3)
+    parser.add_argument('--base-url', default=None, help="e.g. a local mock of the batches endpoint")
+    args = parser.parse_args()
+
+    client = anthropic.Anthropic(base_url=args.base_url) if args.base_url else anthropic.Anthropic()
+    manifest = Manifest()
+    dependencies = Dependencies(STAGES, manifest)
+    for stage in args.stages:
+        runner = BatchRunner(stage, client, manifest, args.poll_interval, args.max_rounds, dependencies=dependencies)
+        failed = runner.run(iter_plants(args.plants, args.limit))
+        if failed:
+            print(f"{stage}: {len(failed)} plants still failing after {args.max_rounds} rounds")
+    manifest.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""
+Local stand-ins for everything the pipeline talks to over the network, served
+by one aiohttp app:
+
+    GET  /search?q=...       BrightData SERP json (set SERP_URL to it)
+    GET  /reader/<link>      r.jina.ai (set READER_URL to it)
+    GET  /article/<id>       article hosts: HTML or PDF, with failures
+    POST /v1/messages        Anthropic messages endpoint answering the
+                             forced tool call with schema-valid input
+                             (set ANTHROPIC_BASE_URL to it)
+    POST /v1/messages/batches              Message Batches API: batches end
+    GET  /v1/messages/batches/<id>         after batch_latency seconds, and
+    GET  /v1/messages/batches/<id>/results the first attempt of a request
+                                           errors or expires at
+                                           batch_error_rate / batch_expired_rate
+
+The app listens on 127.0.0.1 ... 127.0.0.<hosts>, and search results spread
+their links over those addresses so that per-host connection limits behave
+like they do against real article sites.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+WORDS = ("solar wind farm county board hearing residents opposition support project permit ordinance "
+         "megawatt land lease farmers commissioners lawsuit zoning approval developer community").split()
+
+
+@dataclass
+class FakeConfig:
+    port: int = 8790
+    hosts: int = 8
+    results_per_query: int = 10
+    serp_latency: float = 0.5
+    serp_failure_rate: float = 0.02
+    article_latency: float = 0.2
+    article_bytes: int = 20000
+    pdf_rate: float = 0.1
+    article_failure_rate: float = 0.05
+    article_timeout_rate: float = 0.01
+    reader_latency: float = 0.5
+    llm_latency: float = 1.0
+    llm_seconds_per_output_token: float = 0.002
+    llm_overload_rate: float = 0.01
+    batch_latency: float = 2.0
+    batch_error_rate: float = 0.1
+    batch_expired_rate: float = 0.05
+    seed: int = 0
+
+
+def jittered(rng, median):
+    """Log-normal latency around `median` seconds, so there is a tail for the p99."""
+    return median * rng.lognormvariate(0, 0.5) if median > 0 else 0
+
+
+def text_of(rng, n_bytes):
+    words = []
+    size = 0
+    while size < n_bytes:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    # paragraphs of ~60 words, like scraped article text
+    return '\n\n'.join(' '.join(words[i:i + 60]) for i in range(0, len(words), 60))
+
+
+def pdf_of(text):
+    """A minimal one-page PDF with `text` in it."""
+    lines = [line.replace('\\', '').replace('(', '').replace(')', '') for line in text.split('\n\n')[:40]]
+    stream = 'BT /F1 10 Tf 40 800 Td 12 TL ' + ' '.join(f'({line[:90]}) Tj T*' for line in lines) + ' ET'
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>',
+        f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream',
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    out = '%PDF-1.4\n'
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f'{i} 0 obj\n{body}\nendobj\n'
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'
+    out += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets)
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'
+    return out.encode('latin-1')
+
+
+def sample_schema(schema, rng, defs=None):
+    """A random instance of a JSON schema: binary ints, short strings, one-item lists."""
+    defs = defs if defs is not None else schema.get('$defs', {})
+    if '$ref' in schema:
+        return sample_schema(defs[schema['$ref'].split('/')[-1]], rng, defs)
+    if 'anyOf' in schema:
+        return sample_schema(schema['anyOf'][0], rng, defs)
+    kind = schema.get('type')
+    if kind == 'object':
+        return {name: sample_schema(prop, rng, defs) for name, prop in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [sample_schema(schema.get('items', {}), rng, defs)]
+    if kind == 'integer':
+        return rng.randint(0, 1)
+    if kind == 'number':
+        return rng.random()
+    if kind == 'boolean':
+        return rng.random() < 0.5
+    return ' '.join(rng.choice(WORDS) for _ in range(12))
+
+
+def tool_input(tool, user_text, rng):
+    if tool['name'] == 'ArticleRelevanceScores':
+        letters = re.findall(r"Article Letter: ([A-Z])", user_text) or ['A']
+        return {'scores_and_justifications': [
+            {'article_letter': letter, 'grade': rng.randint(1, 5), 'justification': 'mentions the project'}
+            for letter in letters
+        ]}
+    if tool['name'] == 'ContentRelevance':
+        return {'score_and_justification': [{'score': rng.randint(1, 5), 'justification': 'mentions the project'}]}
+    return sample_schema(tool['input_schema'], rng)
+
+
+def user_text(messages):
+    parts = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get('text', '') for block in content or [] if isinstance(block, dict))
+    return '\n'.join(parts)
+
+
+class FakeWeb:
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.counts = {}
+        self.batches = {}
+        # custom_ids that already had their failed first attempt
+        self.batch_attempted = set()
+
+    def count(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def base(self, host=1):
+        return f'http://127.0.0.{host}:{self.config.port}'
+
+    async def search(self, request):
+        self.count('search')
+        config = self.config
+        await asyncio.sleep(jittered(self.rng, config.serp_latency))
+        if self.rng.random() < config.serp_failure_rate:
+            return web.Response(status=self.rng.choice([429, 502]))
+        query = request.query.get('q', '')
+        seed = int(hashlib.sha256(query.encode()).hexdigest()[:8], 16)
+        organic = []
+        for rank in range(config.results_per_query):
+            article_id = f'{seed}-{rank}'
+            host = 1 + (seed + rank) % config.hosts
+            organic.append({
+                'link': f'{self.base(host)}/article/{article_id}',
+                'display_link': f'news{host}.example.com',
+                'title': f'{query[:60]} ({rank})',
+                'description': text_of(self.rng, 160),
+                'rank': rank + 1,
+            })
+        return web.json_response({'general': {'query': query}, 'organic': organic})
+
+    async def article(self, request):
+        self.count('article')
+        config = self.config
+        rng = random.Random(request.match_info['id'])
+        await asyncio.sleep(jittered(self.rng, config.article_latency))
+        roll = rng.random()
+        if roll < config.article_timeout_rate:
+            await asyncio.sleep(3600)
+        if roll < config.article_timeout_rate + config.article_failure_rate:
+            return web.Response(status=rng.choice([403, 404, 500]))
+        text = text_of(rng, config.article_bytes)
+        if rng.random() < config.pdf_rate:
+            return web.Response(body=pdf_of(text), content_type='application/pdf')
+        paragraphs = ''.join(f'<p>{paragraph}</p>' for paragraph in text.split('\n\n'))
+        return web.Response(text=f'<html><body><article>{paragraphs}</article></body></html>', content_type='text/html')
+
+    async def reader(self, request):
+        self.count('reader')
+        config = self.config
+        await asyncio.sleep(jittered(self.rng, config.reader_latency))
+        rng = random.Random(request.match_info['link'])
+        return web.Response(text=f"Title: article\n\nMarkdown Content:\n{text_of(rng, config.article_bytes)}")
+
+    async def messages(self, request):
+        self.count('messages')
+        config = self.config
+        body = await request.json()
+        if self.rng.random() < config.llm_overload_rate:
+            return web.json_response({'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'Overloaded'}},
+                                     status=529)
+        message = self.message(body)
+        output_tokens = message['usage']['output_tokens']
+        await asyncio.sleep(jittered(self.rng, config.llm_latency) + output_tokens * config.llm_seconds_per_output_token)
+        return web.json_response(message)
+
+    def message(self, body):
+        """The tool_use message answering a messages request body."""
+        tool = body['tools'][0]
+        tool_use = tool_input(tool, user_text(body['messages']), self.rng)
+        system = body.get('system') or ''
+        system_chars = len(json.dumps(system)) + len(json.dumps(body['tools']))
+        # only a prefix marked with cache_control is read from the cache
+        cached = isinstance(system, list) and any('cache_control' in block for block in system)
+        usage = {
+            'input_tokens': (len(user_text(body['messages'])) + (0 if cached else system_chars)) // 4,
+            'output_tokens': len(json.dumps(tool_use)) // 4,
+            'cache_creation_input_tokens': 0,
+            'cache_read_input_tokens': system_chars // 4 if cached else 0,
+        }
+        return {
+            'id': f'msg_{time.time_ns()}', 'type': 'message', 'role': 'assistant', 'model': body['model'],
+            'content': [{'type': 'tool_use', 'id': f'toolu_{time.time_ns()}', 'name': tool['name'], 'input': tool_use}],
+            'stop_reason': 'tool_use', 'stop_sequence': None, 'usage': usage,
+        }
+
+    def batch_json(self, request, batch):
+        ended = time.time() >= batch['ends_at']
+        created = datetime.fromtimestamp(batch['created_at'], timezone.utc)
+        counts = dict.fromkeys(['processing', 'succeeded', 'errored', 'canceled', 'expired'], 0)
+        if ended:
+            for result in batch['results']:
+                counts[result['result']['type']] += 1
+        else:
+            counts['processing'] = len(batch['results'])
+        return {
+            'id': batch['id'], 'type': 'message_batch',
+            'processing_status': 'ended' if ended else 'in_progress',
+            'request_counts': counts,
+            'created_at': created.isoformat(),
+            'expires_at': (created + timedelta(days=1)).isoformat(),
+            'ended_at': datetime.fromtimestamp(batch['ends_at'], timezone.utc).isoformat() if ended else None,
+            'cancel_initiated_at': None, 'archived_at': None,
+            'results_url': f"{request.scheme}://{request.host}/v1/messages/batches/{batch['id']}/results"
+                           if ended else None,
+        }
+
+    def batch_result(self, item):
+        """A succeeded result, or an errored or expired one the first time a custom_id is seen."""
+        custom_id = item['custom_id']
+        if custom_id not in self.batch_attempted:
+            self.batch_attempted.add(custom_id)
+            roll = self.rng.random()
+            if roll < self.config.batch_error_rate:
+                return {'custom_id': custom_id, 'result': {'type': 'errored', 'error': {
+                    'type': 'error', 'error': {'type': 'api_error', 'message': 'Internal server error'}}}}
+            if roll < self.config.batch_error_rate + self.config.batch_expired_rate:
+                return {'custom_id': custom_id, 'result': {'type': 'expired'}}
+        return {'custom_id': custom_id, 'result': {'type': 'succeeded', 'message': self.message(item['params'])}}
+
+    async def create_batch(self, request):
+        self.count('batches')
+        body = await request.json()
+        now = time.time()
+        batch = {
+            'id': f'msgbatch_{time.time_ns()}', 'created_at': now,
+            'ends_at': now + jittered(self.rng, self.config.batch_latency),
+            'results': [self.batch_result(item) for item in body['requests']],
+        }
+        self.batches[batch['id']] = batch
+        return web.json_response(self.batch_json(request, batch))
+
+    async def retrieve_batch(self, request):
+        batch = self.batches.get(request.match_info['id'])
+        if batch is None:
+            return web.json_response({'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}},
+                                     status=404)
+        return web.json_response(self.batch_json(request, batch))
+
+    async def batch_results(self, request):
+        batch = self.batches.get(request.match_info['id'])
+        if batch is None or time.time() < batch['ends_at']:
+            return web.json_response({'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}},
+                                     status=404)
+        lines = ''.join(json.dumps(result) + '\n' for result in batch['results'])
+        return web.Response(text=lines, content_type='application/x-jsonl')
+
+    async def stats(self, request):
+        return web.json_response({'counts': self.counts, 'config': asdict(self.config)})
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_get('/search', self.search)
+        app.router.add_get('/article/{id}', self.article)
+        app.router.add_get('/reader/{link:.*}', self.reader)
+        app.router.add_post('/v1/messages', self.messages)
+        app.router.add_post('/v1/messages/batches', self.create_batch)
+        app.router.add_get('/v1/messages/batches/{id}', self.retrieve_batch)
+        app.router.add_get('/v1/messages/batches/{id}/results', self.batch_results)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+    async def serve(self, ready=None):
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        for host in range(1, self.config.hosts + 1):
+            await web.TCPSite(runner, f'127.0.0.{host}', self.config.port).start()
+        if ready is not None:
+            ready.set()
+        await asyncio.Event().wait()
+
+    def env(self):
+        """Environment variables that point the pipeline at this server."""
+        return {
+            'SERP_URL': f'{self.base()}/search',
+            'READER_URL': f'{self.base()}/reader/',
+            'ANTHROPIC_BASE_URL': self.base(),
+        }
+
+
+def serve(config, ready=None):
+    """Process target: runs the fake servers until the process is terminated."""
+    asyncio.run(FakeWeb(config).serve(ready))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake SERP, reader, article and Anthropic servers for benchmarks")
+    for name, default in asdict(FakeConfig()).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    config = FakeConfig(**vars(parser.parse_args()))
+    fake = FakeWeb(config)
+    for key, value in fake.env().items():
+        print(f"export {key}={value}")
+    asyncio.run(fake.serve())
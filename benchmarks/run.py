@@ -0,0 +1,266 @@
+"""
+End-to-end throughput benchmark of the pipeline against the fake servers in
+fake_servers.py: no internet access and no API spend. Every plant goes
+search -> (content, article_relevance) -> relevant_content -> scores with the
+pipeline's per-stage concurrency, and the report has plants/sec (over the
+plants that went through without an error), the failed plants, p50/p99
+latency per stage and peak RSS.
+
+    python benchmarks/run.py --plants 500 --output benchmarks/results/baseline.json
+    python benchmarks/run.py --plants 500 --baseline benchmarks/results/baseline.json
+
+With --baseline, the run fails (exit code 1) if plants/sec dropped or a stage's
+p99 latency grew by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, fields
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeConfig, FakeWeb, serve  # noqa: E402
+
+BENCHMARK_STAGES = ['search', 'content', 'article_relevance', 'relevant_content', 'scores']
+STATES = ['CA', 'TX', 'IA', 'MN', 'NC', 'CO', 'NY', 'IL']
+
+
+def synthetic_plants(n, seed=0):
+    rng = np.random.default_rng(seed)
+    plants = []
+    for i in range(n):
+        tech = 'solar' if rng.random() < 0.6 else 'wind'
+        county, state = f'County{rng.integers(500)}', STATES[rng.integers(len(STATES))]
+        plants.append({
+            'plant_code': str(100000 + i),
+            'search_query': f'Plant {i} {tech} {county} County {state} (controversy OR opposition OR lawsuit OR conflict OR hearing)',
+            'plant_info': f'Plant {i}, a {rng.integers(1, 300)} MW {tech} project in {county} County, {state}',
+        })
+    return plants
+
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    # kilobytes on Linux, bytes on macOS
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss / scale
+
+
+def pool_rss_mb(executors):
+    """
+    Peak RSS of each live partition worker, by pid. Read from /proc (VmHWM), so
+    it is empty on platforms without one.
+    """
+    peaks = {}
+    for executor in executors:
+        for pid in list(executor._processes or {}):
+            try:
+                with open(f'/proc/{pid}/status', 'r') as f:
+                    peaks[pid] = next(int(line.split()[1]) / 1024 for line in f if line.startswith('VmHWM:'))
+            except (OSError, StopIteration):
+                continue
+    return peaks
+
+
+class Benchmark:
+    def __init__(self, concurrency, token_budget, engine_kwargs=None):
+        self.concurrency = concurrency
+        self.token_budget = token_budget
+        self.engine_kwargs = engine_kwargs or {}
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.completed = 0
+        self.empty = 0
+        self.failed = 0
+
+    async def timed(self, stage, run):
+        async with self.semaphores[stage]:
+            start = time.perf_counter()
+            try:
+                return await run()
+            except Exception:
+                self.errors[stage] += 1
+                raise
+            finally:
+                self.latencies[stage].append(time.perf_counter() - start)
+
+    async def plant(self, plant):
+        from local_parallel import build_relevant_content, get_project_summary, get_relevance_scores_deduped
+
+        query, info = plant['search_query'], plant['plant_info']
+        try:
+            search = await self.timed('search', lambda: self.serp.search(query))
+            organic = search.get('organic', [])
+            content, relevance = await asyncio.gather(
+                self.timed('content', lambda: self.engine.partition_content(search)),
+                self.timed('article_relevance', lambda: asyncio.to_thread(
+                    get_relevance_scores_deduped, query, organic, info)),
+            )
+            relevant = await self.timed('relevant_content', lambda: asyncio.to_thread(
+                build_relevant_content, relevance, content, plant_info=info, token_budget=self.token_budget))
+            if relevant is None:
+                self.empty += 1
+                return
+            await self.timed('scores', lambda: asyncio.to_thread(
+                get_project_summary, info, relevant['relevant_content_text']))
+            self.completed += 1
+        except Exception:
+            # already counted against the stage that raised
+            self.failed += 1
+
+    async def run(self, plants):
+        from fetch import FetchEngine
+        from serp import SerpClient
+
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=sum(self.concurrency.values())))
+        self.semaphores = {stage: asyncio.Semaphore(self.concurrency[stage]) for stage in BENCHMARK_STAGES}
+        async with FetchEngine(cache=False, **self.engine_kwargs) as engine, \
+                SerpClient(proxy=None, concurrency=self.concurrency['search']) as serp:
+            self.engine, self.serp = engine, serp
+            start = time.perf_counter()
+            await asyncio.gather(*[self.plant(plant) for plant in plants])
+            return time.perf_counter() - start
+
+
+def report(benchmark, n_plants, elapsed, config, worker_rss=None):
+    stages = {}
+    for stage in BENCHMARK_STAGES:
+        latencies = np.array(benchmark.latencies[stage])
+        stages[stage] = {
+            'calls': len(latencies),
+            'errors': benchmark.errors[stage],
+            'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'mean': float(latencies.mean()) if len(latencies) else None,
+        }
+    return {
+        'plants': n_plants,
+        'completed': benchmark.completed,
+        'empty': benchmark.empty,
+        'failed': benchmark.failed,
+        'elapsed': elapsed,
+        'plants_per_sec': (benchmark.completed + benchmark.empty) / elapsed,
+        'stages': stages,
+        'peak_rss_mb': max_rss_mb(),
+        'peak_rss_worker_mb': max(worker_rss.values()) if worker_rss else None,
+        'partition_workers': len(worker_rss or {}),
+        'config': asdict(config),
+        'time': time.time(),
+    }
+
+
+def regressions(current, baseline, tolerance):
+    """Human-readable list of metrics that got worse than the baseline by more than `tolerance`."""
+    found = []
+    if current['plants_per_sec'] < baseline['plants_per_sec'] * (1 - tolerance):
+        found.append(f"plants/sec {baseline['plants_per_sec']:.2f} -> {current['plants_per_sec']:.2f}")
+    for stage, stats in current['stages'].items():
+        before = baseline['stages'].get(stage, {}).get('p99')
+        if before and stats['p99'] and stats['p99'] > before * (1 + tolerance):
+            found.append(f"{stage} p99 {before:.3f}s -> {stats['p99']:.3f}s")
+    if current['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + tolerance):
+        found.append(f"peak RSS {baseline['peak_rss_mb']:.0f}MB -> {current['peak_rss_mb']:.0f}MB")
+    return found
+
+
+def start_server(config, timeout=30):
+    """Runs the fake servers in their own process, so they don't share the event loop, CPU or RSS being measured."""
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    server = context.Process(target=serve, args=(config, ready), daemon=True)
+    server.start()
+    if not ready.wait(timeout):
+        server.terminate()
+        raise RuntimeError(f"fake servers did not start on port {config.port}")
+    return server
+
+
+def print_report(result):
+    print(f"{result['plants']} plants in {result['elapsed']:.1f}s: {result['plants_per_sec']:.2f} plants/sec "
+          f"({result['completed']} scored, {result['empty']} without relevant content, {result['failed']} failed)")
+    print(f"{'stage':<18}{'calls':>7}{'errors':>8}{'p50':>9}{'p99':>9}")
+    for stage, stats in result['stages'].items():
+        p50 = f"{stats['p50']:.3f}" if stats['p50'] is not None else '-'
+        p99 = f"{stats['p99']:.3f}" if stats['p99'] is not None else '-'
+        print(f"{stage:<18}{stats['calls']:>7}{stats['errors']:>8}{p50:>9}{p99:>9}")
+    if result['peak_rss_worker_mb'] is None:
+        print(f"peak RSS {result['peak_rss_mb']:.0f}MB")
+    else:
+        print(f"peak RSS {result['peak_rss_mb']:.0f}MB (largest of {result['partition_workers']} partition workers "
+              f"{result['peak_rss_worker_mb']:.0f}MB)")
+    if result.get('errors'):
+        print("errors: " + ', '.join(f"{kind} {count}" for kind, count in sorted(result['errors'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark against fake servers")
+    parser.add_argument('--plants', type=int, default=200)
+    parser.add_argument('--concurrency', nargs='*', metavar='STAGE=N', help="override per-stage concurrency")
+    parser.add_argument('--token-budget', type=int, default=8000)
+    parser.add_argument('--strategy', default='fast', help="unstructured strategy for the PDF payloads")
+    parser.add_argument('--output', default=None, help="write the report as json")
+    parser.add_argument('--baseline', default=None, help="report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    for field in fields(FakeConfig):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=type(field.default), default=field.default)
+    args = parser.parse_args()
+    config = FakeConfig(**{field.name: getattr(args, field.name) for field in fields(FakeConfig)})
+
+    # the pipeline modules read their endpoints from the environment at import time
+    os.environ.update(FakeWeb(config).env())
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'benchmark')
+    os.environ.setdefault('SPOOL_DIR', tempfile.mkdtemp(prefix='benchmark-spool-'))
+
+    from llm_scheduler import scheduler
+    from metrics import metrics
+    from partition_pool import _executors
+    from pipeline import STAGES_BY_NAME, parse_concurrency
+
+    scheduler.cache = False
+    scheduler.usage_log = None
+    metrics.path = None
+    concurrency = {stage: STAGES_BY_NAME[stage].concurrency for stage in BENCHMARK_STAGES}
+    concurrency.update(parse_concurrency(args.concurrency))
+
+    server = start_server(config)
+    try:
+        benchmark = Benchmark(concurrency, args.token_budget, {'strategy': args.strategy})
+        elapsed = asyncio.run(benchmark.run(synthetic_plants(args.plants, config.seed)))
+        # while the workers are still up; the server process is not one of them
+        worker_rss = pool_rss_mb(_executors.values())
+    finally:
+        server.terminate()
+        for executor in _executors.values():
+            executor.shutdown()
+
+    result = report(benchmark, args.plants, elapsed, config, worker_rss)
+    result['errors'] = {
+        f"{dict(key)['where']}/{dict(key)['kind']}": int(value)
+        for (name, key), value in metrics.counters.items() if name == 'errors_total'
+    }
+    print_report(result)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
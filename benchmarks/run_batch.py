@@ -0,0 +1,89 @@
+"""
+Runs batch.py's BatchRunner against the fake Message Batches endpoint in
+fake_servers.py: synthetic plants are scored for article_relevance and scores
+in a scratch results directory, the first attempt of some requests errors or
+expires, and the runner has to resubmit them until every plant is written.
+
+    python benchmarks/run_batch.py --plants 200 --batch-error-rate 0.2
+
+Exits with code 1 if any plant is still missing a result.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from dataclasses import fields
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeConfig, FakeWeb  # noqa: E402
+from run import start_server, synthetic_plants  # noqa: E402
+
+BATCH_BENCHMARK_STAGES = ['article_relevance', 'scores']
+
+
+def seed_results(plants, manifest, results_per_query=10):
+    """search results for article_relevance and relevant content for scores, recorded as done."""
+    for plant in plants:
+        organic = [{
+            'link': f"https://news.example.com/{plant['plant_code']}/{rank}",
+            'display_link': 'news.example.com',
+            'title': f"{plant['plant_info']} ({rank})",
+            'description': f"County board hearing on {plant['plant_info']}",
+        } for rank in range(results_per_query)]
+        manifest.write('search', plant['plant_code'], {'organic': organic})
+        manifest.write('relevant_content', plant['plant_code'], {
+            'relevant_content_text': f"<doc>\nArticle Letter: A\nResidents opposed {plant['plant_info']}\n</doc>",
+        })
+    manifest.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BatchRunner against the fake Message Batches endpoint")
+    parser.add_argument('--plants', type=int, default=100)
+    parser.add_argument('--max-rounds', type=int, default=3)
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--max-batch-size', type=int, default=50, help="small, so a run has several batches")
+    for field in fields(FakeConfig):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=type(field.default), default=field.default)
+    args = parser.parse_args()
+    config = FakeConfig(**{field.name: getattr(args, field.name) for field in fields(FakeConfig)})
+
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'benchmark')
+    # results/, results/batches and the manifest are relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='benchmark-batch-'))
+
+    import anthropic
+
+    from batch import BatchRunner
+    from llm_scheduler import scheduler
+    from results_io import Manifest
+
+    scheduler.cache = False
+    scheduler.usage_log = None
+    plants = synthetic_plants(args.plants, config.seed)
+    manifest = Manifest()
+    seed_results(plants, manifest)
+
+    server = start_server(config)
+    client = anthropic.Anthropic(base_url=FakeWeb(config).env()['ANTHROPIC_BASE_URL'])
+    missing = 0
+    try:
+        for stage in BATCH_BENCHMARK_STAGES:
+            start = time.perf_counter()
+            runner = BatchRunner(stage, client, manifest, args.poll_interval, args.max_rounds, args.max_batch_size)
+            failed = runner.run(plants)
+            done = sum(manifest.status(plant['plant_code'], stage) == 'done' for plant in plants)
+            missing += len(plants) - done
+            print(f"{stage}: {done}/{len(plants)} written in {time.perf_counter() - start:.1f}s, "
+                  f"{len(failed)} still failing")
+    finally:
+        server.terminate()
+        manifest.close()
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == "__main__":
+    main()
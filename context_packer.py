@@ -0,0 +1,144 @@
+import math
+import re
+from collections import Counter
+
+from llm_scheduler import estimate_tokens
+
+DEFAULT_TOKEN_BUDGET = 8000
+
+# Stems of the words that signal the evidence the summary scores look for
+# (the ProjectPerceptionVariables fields), matched as prefixes.
+OPPOSITION_KEYWORDS = [
+    'oppos', 'support', 'protest', 'petition', 'resident', 'neighbor', 'concern', 'complain', 'object',
+    'lawsuit', 'sue', 'court', 'appeal', 'litigat', 'ordinance', 'moratori', 'zoning', 'permit', 'variance',
+    'hearing', 'commission', 'council', 'supervisor', 'vote', 'denied', 'deny', 'reject', 'approv',
+    'delay', 'tribe', 'tribal', 'wildlife', 'environment', 'water', 'farmland', 'agricultur', 'graz',
+    'property', 'health', 'safety', 'noise', 'glare', 'benefit', 'agreement', 'compensat', 'tax', 'editorial',
+]
+
+STOPWORDS = {
+    'the', 'and', 'of', 'in', 'a', 'an', 'to', 'for', 'on', 'at', 'by', 'with', 'is', 'are', 'from',
+    'project', 'plant', 'energy', 'located', 'county', 'state', 'mw', 'llc', 'inc',
+}
+
+TRUNCATION_MARKER = re.compile(r"\.\.\. Remaining content truncated\. Full length: \d+ characters\.$")
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def split_paragraphs(text, min_chars=200, max_chars=800):
+    """
+    Splits article text into paragraph-sized chunks. Partitioned documents come
+    back as one element per line, so short lines (headings, list items) are
+    merged into the following ones until a chunk reaches `min_chars`; lines
+    longer than `max_chars` are cut at word boundaries.
+    """
+    text = TRUNCATION_MARKER.sub('', text or '')
+    paragraphs = []
+    current = ''
+    for line in text.split('\n'):
+        line = line.strip()
+        while len(line) > max_chars:
+            cut = line.rfind(' ', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            paragraphs.append(line[:cut])
+            line = line[cut:].strip()
+        if not line:
+            continue
+        if current and (len(current) >= min_chars or len(current) + len(line) + 1 > max_chars):
+            paragraphs.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        paragraphs.append(current)
+    return paragraphs
+
+
+def query_terms(plant_info):
+    return {term for term in tokenize(plant_info) if term not in STOPWORDS and len(term) > 1}
+
+
+def score_paragraphs(paragraphs, plant_info):
+    """
+    Lexical relevance of each paragraph: idf-weighted matches of the plant_info
+    terms (names, places) plus matches of the opposition keywords, dampened by
+    paragraph length so long boilerplate doesn't win on volume.
+    """
+    tokenized = [tokenize(paragraph) for paragraph in paragraphs]
+    plant_terms = query_terms(plant_info)
+    document_frequency = Counter(term for tokens in tokenized for term in set(tokens) & plant_terms)
+    scores = []
+    for tokens in tokenized:
+        counts = Counter(tokens)
+        plant_score = sum(
+            (1 + math.log(counts[term])) * math.log(1 + len(paragraphs) / document_frequency[term])
+            for term in plant_terms if counts[term]
+        )
+        keyword_score = sum(
+            1 + math.log(count) for token, count in counts.items()
+            if any(token.startswith(keyword) for keyword in OPPOSITION_KEYWORDS)
+        )
+        scores.append((2 * plant_score + keyword_score) / math.log(2 + len(tokens)))
+    return scores
+
+
+def article_header(article):
+    return f"Article Letter: {article['article_letter']}\n{article['title']}\n{article['description']}"
+
+
+def format_docs(articles):
+    """The unpacked <doc> blocks, in the field order of fetch.format_full_text."""
+    return "\n".join(
+        f"<doc>\nArticle Letter: {r['article_letter']}\n{r['title']}\n{r['description']}\n{r['content']}\n</doc>"
+        for r in articles
+    )
+
+
+def pack_articles(articles, plant_info, token_budget=DEFAULT_TOKEN_BUDGET):
+    """
+    Packs the relevant articles (content json entries with a 'grade' from
+    article_relevance) into at most about `token_budget` tokens of <doc> blocks.
+    Every article keeps its letter, title and description so the summary can
+    still cite it; the rest of the budget goes to the best paragraphs across all
+    articles, ranked by lexical score weighted by the article's grade. Kept
+    paragraphs stay in their original order, with "..." where text was left out.
+    Articles that already fit come back unchanged, as `format_docs` renders them.
+    """
+    full_text = format_docs(articles)
+    if estimate_tokens(full_text) <= token_budget:
+        return full_text
+
+    used = sum(estimate_tokens(article_header(article)) for article in articles)
+    candidates = []
+    paragraphs_by_article = []
+    for i, article in enumerate(articles):
+        paragraphs = split_paragraphs(article.get('content'))
+        paragraphs_by_article.append(paragraphs)
+        for j, score in enumerate(score_paragraphs(paragraphs, plant_info)):
+            candidates.append((score * article.get('grade', 3) / 5, i, j))
+
+    selected = set()
+    for score, i, j in sorted(candidates, reverse=True):
+        if score <= 0:
+            break
+        cost = estimate_tokens(paragraphs_by_article[i][j])
+        if used + cost > token_budget:
+            continue
+        selected.add((i, j))
+        used += cost
+
+    docs = []
+    for i, article in enumerate(articles):
+        kept = []
+        for j, paragraph in enumerate(paragraphs_by_article[i]):
+            if (i, j) in selected:
+                kept.append(paragraph)
+            elif not kept or kept[-1] != '...':
+                kept.append('...')
+        body = "\n".join(kept)
+        docs.append(f"<doc>\n{article_header(article)}\n{body}\n</doc>")
+    return "\n".join(docs)
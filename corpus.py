@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import time
+
+import numpy as np
+
+from url_cache import normalize_url
+
+CORPUS_DIR = os.environ.get('CORPUS_DIR', 'results/corpus')
+
+# one record per article, in the order the articles were appended; the text of
+# an article is link, title, description and content back to back in text.bin
+INDEX_DTYPE = np.dtype([
+    ('plant_code', '<i8'),
+    ('letter', 'u1'),
+    ('status', 'u1'),
+    ('duplicate_of', 'u1'),
+    ('url_hash', '<u8'),
+    ('offset', '<u8'),
+    ('link_length', '<u4'),
+    ('title_length', '<u4'),
+    ('description_length', '<u4'),
+    ('length', '<u4'),
+])
+
+OK, TIMED_OUT, NO_ACCESS, NO_RESULTS = 0, 1, 2, 255
+# failed links store no text, only the status behind the message fetch.py wrote
+STATUS_TEXT = {TIMED_OUT: 'Timed out', NO_ACCESS: 'Could not access content'}
+TEXT_STATUS = {text: status for status, text in STATUS_TEXT.items()}
+NO_RESULTS_TEXT = "No organic results found."
+
+
+def url_hash(link):
+    if not link:
+        return 0
+    digest = hashlib.blake2b(normalize_url(link).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class Corpus:
+    """
+    The scraped article text of every plant in one append-only blob
+    (text.bin, memory-mapped) with a fixed-width index (index.bin, INDEX_DTYPE),
+    replacing results/content/*.json, which store every article twice (in
+    individual_results and again in full_text).
+
+    Opening reads only the index; text is sliced out of the map on demand, so
+    `text` returns a memoryview without copying and `doc_context` builds the
+    <doc> blocks of a plant by joining slices. `content` rebuilds the old
+    results/content json of a plant. Appending a plant again supersedes its
+    earlier records. A plant with no search results gets one NO_RESULTS record.
+    """
+
+    def __init__(self, path=CORPUS_DIR):
+        self.path = path
+        self.text_path = os.path.join(path, 'text.bin')
+        self.index_path = os.path.join(path, 'index.bin')
+        self.text_file = None
+        self.index_file = None
+        self.reload()
+
+    def reload(self):
+        """Maps the current files, dropping index records whose text didn't make it to disk."""
+        text_size = os.path.getsize(self.text_path) if os.path.exists(self.text_path) else 0
+        self.map = None
+        if text_size:
+            with open(self.text_path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map) if self.map is not None else memoryview(b'')
+        index = np.zeros(0, dtype=INDEX_DTYPE)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            index = np.frombuffer(data[:len(data) - len(data) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+        end = index['offset'] + index['link_length'] + index['title_length'] + index['description_length'] + \
+            index['length']
+        self.index = index[:np.searchsorted(np.maximum.accumulate(end) > text_size, True)] if len(index) else index
+        codes = self.index['plant_code']
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=int)
+        ends = np.r_[starts[1:], len(codes)]
+        # later appends of a plant come last, so they win
+        self.plants = {int(codes[s]): (int(s), int(e)) for s, e in zip(starts, ends)}
+
+    def __contains__(self, plant_code):
+        return int(plant_code) in self.plants
+
+    def __len__(self):
+        return len(self.plants)
+
+    def records(self, plant_code):
+        start, end = self.plants[int(plant_code)]
+        records = self.index[start:end]
+        return records[records['status'] != NO_RESULTS]
+
+    def fields(self, record):
+        """memoryviews of the link, title, description and content of an index record."""
+        offset = int(record['offset'])
+        views = []
+        for name in ('link_length', 'title_length', 'description_length', 'length'):
+            views.append(self.view[offset:offset + int(record[name])])
+            offset += int(record[name])
+        return views
+
+    def text(self, record):
+        """The content of an article as a memoryview into the map."""
+        return self.fields(record)[3]
+
+    def article(self, plant_code, letter):
+        records = self.records(plant_code)
+        match = records[records['letter'] == ord(letter)]
+        if not len(match):
+            raise KeyError(f"no article {letter} for plant code {plant_code}")
+        return self.article_dict(match[-1])
+
+    def article_dict(self, record):
+        link, title, description, content = (bytes(view).decode('utf-8') for view in self.fields(record))
+        status = int(record['status'])
+        article = {
+            'content': STATUS_TEXT.get(status, content),
+            'article_letter': chr(record['letter']),
+            'link': link,
+            'title': title,
+            'description': description,
+        }
+        if record['duplicate_of']:
+            article['duplicate_of'] = chr(record['duplicate_of'])
+        return article
+
+    def iter_docs(self, plant_code, letters=None):
+        """The <doc> blocks of a plant (as in fetch.format_full_text) as a sequence of byte slices."""
+        first = True
+        for record in self.records(plant_code):
+            letter = chr(record['letter'])
+            if letters is not None and letter not in letters:
+                continue
+            if not first:
+                yield b'\n'
+            first = False
+            _, title, description, content = self.fields(record)
+            if record['duplicate_of']:
+                yield f"<doc>\nArticle Letter: {letter}\nDuplicate of article {chr(record['duplicate_of'])}\n</doc>".encode()
+                continue
+            status = int(record['status'])
+            yield f"<doc>\nArticle Letter: {letter}\n".encode()
+            yield from (title, b'\n', description, b'\n')
+            yield STATUS_TEXT[status].encode() if status in STATUS_TEXT else content
+            yield b'\n</doc>'
+
+    def doc_context(self, plant_code, letters=None):
+        if not len(self.records(plant_code)):
+            return NO_RESULTS_TEXT
+        return b''.join(self.iter_docs(plant_code, letters)).decode('utf-8')
+
+    def content(self, plant_code):
+        """The results/content json of a plant: full_text and individual_results."""
+        return {
+            'full_text': self.doc_context(plant_code),
+            'individual_results': [self.article_dict(record) for record in self.records(plant_code)],
+        }
+
+    def append(self, plant_code, individual_results):
+        """Appends the articles of one plant (individual_results of its content json)."""
+        if self.text_file is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.text_file = open(self.text_path, 'ab')
+            self.index_file = open(self.index_path, 'ab')
+        offset = self.text_file.tell()
+        records = np.zeros(max(len(individual_results), 1), dtype=INDEX_DTYPE)
+        records['plant_code'] = int(plant_code)
+        if not individual_results:
+            records['status'] = NO_RESULTS
+            records['offset'] = offset
+        for record, article in zip(records, individual_results):
+            content = article.get('content') or ''
+            status = TEXT_STATUS.get(content, OK)
+            fields = [(article.get(key) or '').encode('utf-8') for key in ('link', 'title', 'description')]
+            fields.append(b'' if status != OK else content.encode('utf-8'))
+            record['letter'] = ord(article['article_letter'])
+            record['status'] = status
+            record['duplicate_of'] = ord(article['duplicate_of']) if article.get('duplicate_of') else 0
+            record['url_hash'] = url_hash(article.get('link'))
+            record['offset'] = offset
+            for name, field in zip(('link_length', 'title_length', 'description_length', 'length'), fields):
+                record[name] = len(field)
+                self.text_file.write(field)
+                offset += len(field)
+        self.index_file.write(records.tobytes())
+
+    def flush(self):
+        """Makes appended plants durable (text before index) and visible to this instance."""
+        if self.text_file is not None:
+            for f in (self.text_file, self.index_file):
+                f.flush()
+                os.fsync(f.fileno())
+        self.reload()
+
+    def close(self):
+        if self.text_file is not None:
+            self.flush()
+            self.text_file.close()
+            self.index_file.close()
+            self.text_file = self.index_file = None
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # a caller still holds a text() slice; the map goes when that does
+                pass
+
+
+def comparable(article):
+    return {key: article.get(key) or '' for key in ('content', 'article_letter', 'link', 'title', 'description',
+                                                    'duplicate_of')}
+
+
+def migrate(content_dir='results/content', path=CORPUS_DIR, remove=False, batch=500):
+    """
+    Appends every results/content json not yet in the corpus and checks that
+    the corpus gives back the same articles. With remove=True, the json files
+    that round-trip are deleted. Returns (migrated, mismatched plant codes).
+    """
+    corpus = Corpus(path)
+    filenames = sorted(
+        (f for f in os.listdir(content_dir) if f.endswith('.json') and f[:-5].isdigit()),
+        key=lambda f: int(f[:-5]),
+    )
+    pending = []
+    migrated, mismatched = 0, []
+    for i, filename in enumerate(filenames):
+        plant_code = filename[:-5]
+        if plant_code in corpus:
+            continue
+        with open(os.path.join(content_dir, filename), 'r') as f:
+            try:
+                content = json.load(f)
+            except ValueError:
+                mismatched.append(plant_code)
+                continue
+        if not isinstance(content, dict):
+            mismatched.append(plant_code)
+            continue
+        corpus.append(plant_code, content.get('individual_results', []))
+        pending.append((plant_code, content))
+        if len(pending) >= batch or i == len(filenames) - 1:
+            corpus.flush()
+            for code, original in pending:
+                restored = corpus.content(code)['individual_results']
+                if [comparable(a) for a in restored] != [comparable(a) for a in original.get('individual_results', [])]:
+                    mismatched.append(code)
+                    continue
+                migrated += 1
+                if remove:
+                    os.remove(os.path.join(content_dir, f'{code}.json'))
+            pending = []
+    corpus.close()
+    return migrated, mismatched
+
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory-mapped article corpus built from results/content")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help="append results/content/*.json to the corpus")
+    migrate_parser.add_argument('--content-dir', default='results/content')
+    migrate_parser.add_argument('--remove', action='store_true', help="delete the json files that round-trip")
+    stats_parser = subparsers.add_parser('stats', help="size and load time of the corpus vs. the json files")
+    stats_parser.add_argument('--content-dir', default='results/content')
+    parser.add_argument('--path', default=CORPUS_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrated, mismatched = migrate(args.content_dir, args.path, args.remove)
+        print(f"Migrated {migrated} plants")
+        if mismatched:
+            print(f"{len(mismatched)} plants kept as json (unreadable or not round-tripping): {mismatched[:20]}")
+    else:
+        start = time.time()
+        corpus = Corpus(args.path)
+        characters = sum(len(corpus.text(record)) for record in corpus.index)
+        corpus_seconds = time.time() - start
+        corpus_bytes = directory_size(args.path)
+        print(f"corpus: {len(corpus)} plants, {len(corpus.index)} articles, {corpus_bytes / 1e6:.1f} MB, "
+              f"open + read every article {corpus_seconds:.2f}s")
+        if os.path.isdir(args.content_dir):
+            start = time.time()
+            for filename in os.listdir(args.content_dir):
+                if filename.endswith('.json'):
+                    with open(os.path.join(args.content_dir, filename), 'r') as f:
+                        try:
+                            json.load(f)
+                        except ValueError:
+                            pass
+            print(f"json: {directory_size(args.content_dir) / 1e6:.1f} MB, load every file {time.time() - start:.2f}s")
+        corpus.close()
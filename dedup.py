@@ -0,0 +1,275 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+
+from sqlite_cache import SqliteCache
+from url_cache import normalize_url
+
+NUM_PERM = 128
+BANDS = 16
+SHINGLE_WORDS = 5
+THRESHOLD = 0.8
+# below this many words there aren't enough shingles for a meaningful estimate
+MIN_WORDS = 50
+GRADE_CACHE_PATH = os.environ.get('GRADE_CACHE_PATH', 'cache/grades.db')
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.RandomState(42)
+# a, b < 2**32 and 32-bit shingle hashes keep a * h + b below 2**64
+PERM_A = _rng.randint(1, 1 << 32, NUM_PERM, dtype=np.uint64)
+PERM_B = _rng.randint(0, 1 << 32, NUM_PERM, dtype=np.uint64)
+
+WORD = re.compile(r"[a-z0-9]+")
+AMP_PATH = re.compile(r"/amp/?$|/amp(?=/)")
+AMP_PARAMS = {'amp', 'outputtype', 'amp_js_v', 'usqp'}
+FAILURE_CONTENT = {'Could not access content', 'Timed out'}
+
+
+def canonical_url(url):
+    """normalize_url plus the AMP variants of a page (amp. hosts, /amp paths, ?amp / outputType=amp)."""
+    parts = urlsplit(normalize_url(url))
+    host = parts.netloc[4:] if parts.netloc.startswith('amp.') else parts.netloc
+    host = host[4:] if host.startswith('www.') else host
+    path = AMP_PATH.sub('', parts.path) or '/'
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in AMP_PARAMS]
+    return urlunsplit((parts.scheme, host, path, urlencode(query), ''))
+
+
+def word_hashes(text):
+    return np.array([zlib.crc32(word.encode('utf-8')) for word in WORD.findall((text or '').lower())], dtype=np.uint64)
+
+
+def shingle_hashes(words, k=SHINGLE_WORDS):
+    """32-bit hashes of the k-word shingles, combined from the word hashes with a rolling polynomial."""
+    if len(words) < k:
+        return words & np.uint64(0xFFFFFFFF)
+    h = np.zeros(len(words) - k + 1, dtype=np.uint64)
+    for j in range(k):
+        h = h * np.uint64(1000003) + words[j:len(words) - k + 1 + j]
+    return np.unique(h & np.uint64(0xFFFFFFFF))
+
+
+def signature(text):
+    """MinHash signature of a text's word shingles, or None if it is too short to compare."""
+    words = word_hashes(text)
+    if len(words) < MIN_WORDS:
+        return None
+    h = shingle_hashes(words)
+    return ((PERM_A[:, None] * h[None, :] + PERM_B[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.mean(a == b))
+
+
+class MinHashIndex:
+    """
+    LSH index over MinHash signatures: BANDS bands of NUM_PERM / BANDS rows,
+    so pairs above roughly (1 / BANDS) ** (BANDS / NUM_PERM) Jaccard become
+    candidates, and candidates are kept only if their estimated similarity
+    reaches `threshold`.
+    """
+
+    def __init__(self, threshold=THRESHOLD, bands=BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = NUM_PERM // bands
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def band_keys(self, sig):
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def query(self, sig):
+        """Key of the most similar indexed signature above the threshold, or None."""
+        candidates = set()
+        for bucket, band in zip(self.buckets, self.band_keys(sig)):
+            candidates.update(bucket.get(band, ()))
+        best, best_similarity = None, self.threshold
+        for key in candidates:
+            s = similarity(sig, self.signatures[key])
+            if s >= best_similarity:
+                best, best_similarity = key, s
+        return best
+
+    def add(self, key, sig):
+        self.signatures[key] = sig
+        for bucket, band in zip(self.buckets, self.band_keys(sig)):
+            bucket.setdefault(band, []).append(key)
+
+    def __len__(self):
+        return len(self.signatures)
+
+
+def mark_duplicates(articles):
+    """
+    Sets `duplicate_of` (the letter of the first copy) on articles of one plant
+    that repeat an earlier one: same canonical URL, or near-identical text.
+    Returns the number of duplicates.
+    """
+    index = MinHashIndex()
+    by_url = {}
+    duplicates = 0
+    for article in articles:
+        article.pop('duplicate_of', None)
+        letter = article.get('article_letter')
+        url = canonical_url(article['link']) if article.get('link') else None
+        original = by_url.get(url) if url else None
+        content = article.get('content') or ''
+        sig = signature(content) if content not in FAILURE_CONTENT else None
+        if original is None and sig is not None:
+            original = index.query(sig)
+        if original is not None:
+            article['duplicate_of'] = original
+            duplicates += 1
+            continue
+        if url:
+            by_url[url] = letter
+        if sig is not None:
+            index.add(letter, sig)
+    return duplicates
+
+
+def shingle_set(text, k=3):
+    words = WORD.findall((text or '').lower())
+    return {' '.join(words[i:i + k]) for i in range(max(len(words) - k + 1, 1))}
+
+
+def search_duplicates(organic_results, threshold=THRESHOLD):
+    """
+    Index of the first copy for every search result that repeats an earlier one
+    (same canonical URL, or title and description with Jaccard >= threshold),
+    and None for the rest. Snippets are short, so the Jaccard is exact.
+    """
+    originals = [None] * len(organic_results)
+    urls, shingles = {}, []
+    for i, result in enumerate(organic_results):
+        url = canonical_url(result['link']) if result.get('link') else None
+        current = shingle_set(f"{result.get('title', '')} {result.get('description', '')}")
+        if url in urls:
+            originals[i] = urls[url]
+        else:
+            for j, previous in shingles:
+                if len(current | previous) and len(current & previous) / len(current | previous) >= threshold:
+                    originals[i] = j
+                    break
+        if originals[i] is None:
+            if url:
+                urls[url] = i
+            shingles.append((i, current))
+    return originals
+
+
+def normalize_text(text):
+    return ' '.join(WORD.findall((text or '').lower()))
+
+
+class GradeCache(SqliteCache):
+    """
+    Relevance grades of search results keyed by the plant_info and the result's
+    canonical URL, title and description, so a result graded for one plant
+    isn't sent to the model again for a plant with the same plant_info. Pass
+    the grading request's fingerprint as `version` to keep grades made under
+    another prompt or model from being reused.
+    """
+
+    table = 'grades'
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS grades (
+            key TEXT PRIMARY KEY,
+            grade INTEGER NOT NULL,
+            justification TEXT,
+            created_at REAL NOT NULL
+        )
+        """,
+    )
+
+    def __init__(self, path=GRADE_CACHE_PATH, version=''):
+        super().__init__(path)
+        self.version = version
+
+    def key(self, plant_info, result):
+        parts = [
+            normalize_text(plant_info),
+            canonical_url(result['link']) if result.get('link') else '',
+            normalize_text(result.get('title')),
+            normalize_text(result.get('description')),
+        ]
+        if self.version:
+            parts.insert(0, self.version)
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, plant_info, result):
+        with self._lock:
+            row = self.conn.execute("SELECT grade, justification FROM grades WHERE key = ?",
+                                    (self.key(plant_info, result),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {'grade': row[0], 'justification': row[1]}
+
+    def put(self, plant_info, result, grade, justification):
+        with self._lock:
+            self._put((self.key(plant_info, result), grade, justification, time.time()))
+
+
+def report(content_dir='results/content'):
+    """Near-duplicate statistics over every article in results/content."""
+    index = MinHashIndex()
+    owner = {}
+    stats = dict.fromkeys(['plants', 'articles', 'indexed', 'within_plant', 'across_plants',
+                           'duplicate_chars', 'indexed_chars'], 0)
+    for filename in sorted(os.listdir(content_dir)):
+        plant_code, ext = os.path.splitext(filename)
+        if ext != '.json':
+            continue
+        with open(os.path.join(content_dir, filename), 'r') as f:
+            content = json.load(f)
+        articles = content.get('individual_results', []) if isinstance(content, dict) else []
+        stats['plants'] += 1
+        stats['articles'] += len(articles)
+        mark_duplicates(articles)
+        for article in articles:
+            text = article.get('content') or ''
+            if 'duplicate_of' in article:
+                stats['within_plant'] += 1
+                stats['duplicate_chars'] += len(text)
+                continue
+            sig = signature(text) if text not in FAILURE_CONTENT else None
+            if sig is None:
+                continue
+            stats['indexed'] += 1
+            stats['indexed_chars'] += len(text)
+            match = index.query(sig)
+            if match is not None and owner[match] != plant_code:
+                stats['across_plants'] += 1
+                stats['duplicate_chars'] += len(text)
+            key = (plant_code, article.get('article_letter'))
+            owner[key] = plant_code
+            index.add(key, sig)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Near-duplicate article statistics of the scraped content")
+    parser.add_argument('--content-dir', default='results/content')
+    args = parser.parse_args()
+
+    start = time.time()
+    stats = report(args.content_dir)
+    duplicates = stats['within_plant'] + stats['across_plants']
+    print(f"{stats['plants']} plants, {stats['articles']} articles, {stats['indexed']} long enough to compare "
+          f"({time.time() - start:.1f}s)")
+    print(f"within-plant duplicates: {stats['within_plant']}, copies of another plant's article: {stats['across_plants']}")
+    print(f"dedup ratio: {duplicates / max(stats['indexed'] + stats['within_plant'], 1):.1%}, "
+          f"~{stats['duplicate_chars'] // 4} tokens of duplicated text")
@@ -0,0 +1,142 @@
+import inspect
+import json
+
+from fetch import MAX_CHARS
+from local_parallel import (build_relevant_content, content_relevance_request, project_summary_request,
+                            relevance_scores_request)
+from results_io import content_hash, schema_version
+
+# the plant csv columns each stage reads
+PLANT_FIELDS = {
+    'search': ['search_query'],
+    'content': [],
+    'article_relevance': ['search_query', 'plant_info'],
+    'content_relevance': ['search_query', 'plant_info'],
+    'relevant_content': ['plant_info'],
+    'scores': ['plant_info'],
+}
+
+# the *_request builders of the LLM stages, shared with batch.py
+REQUEST_BUILDERS = {
+    'article_relevance': relevance_scores_request,
+    'content_relevance': content_relevance_request,
+    'scores': project_summary_request,
+}
+
+REASONS = {'code': 'prompt, model or settings changed', 'plant': 'plant row changed'}
+
+
+def fingerprint(value):
+    return content_hash(json.dumps(value, sort_keys=True, default=str).encode('utf-8'))
+
+
+def request_template(build_request):
+    """
+    What a *_request builder sends apart from the plant: model, sampling
+    parameters, prompt template and the JSON schema of the response model.
+    The arguments are filled in with placeholders.
+    """
+    names = inspect.signature(build_request).parameters
+    request = dict(build_request(*(f'{{{name}}}' for name in names)))
+    request['response_model'] = request['response_model'].model_json_schema()
+    return request
+
+
+def stage_settings(strategy='auto', token_budget=None, reader_fallback=False, preclassifier=None):
+    """
+    Everything besides its inputs that a stage's result depends on, per stage.
+    `preclassifier` is the path of the relevance gate in use, if any.
+    """
+    settings = {stage: {'schema': schema_version(stage)} for stage in PLANT_FIELDS}
+    settings['content'].update(max_chars=MAX_CHARS, strategy=strategy, html='local', reader_fallback=reader_fallback)
+    settings['relevant_content'].update(
+        token_budget=token_budget,
+        min_grade=inspect.signature(build_relevant_content).parameters['min_grade'].default,
+    )
+    for stage, build_request in REQUEST_BUILDERS.items():
+        settings[stage]['request'] = request_template(build_request)
+    if preclassifier is not None:
+        # a retrained gate decides a different set of results locally
+        with open(preclassifier, 'rb') as f:
+            settings['article_relevance']['preclassifier'] = content_hash(f.read())
+    return settings
+
+
+class Dependencies:
+    """
+    Input fingerprints of the pipeline's results. Every manifest entry records
+    the `inputs` its result was computed from: the content hash of each
+    dependency's result (search json, article texts, grades ...), a hash of the
+    plant row columns the stage reads, and a hash of the stage's settings
+    (prompt template, model, response schema, truncation, token budget).
+
+    A result is stale when any of these differ from the current ones. Stages
+    are checked in dependency order, so a stale result also makes everything
+    downstream of it stale (`plan`); a run instead recomputes a downstream
+    result only once its dependency was recomputed with a different hash.
+    Entries recorded before inputs were (or reseeded by rebuild-manifest) have
+    nothing to compare and count as up to date.
+    """
+
+    def __init__(self, stages, manifest, settings=None):
+        self.stages = stages
+        self.deps = {stage.name: stage.deps for stage in stages}
+        self.manifest = manifest
+        settings = settings if settings is not None else stage_settings()
+        self.code = {stage: fingerprint(value) for stage, value in settings.items()}
+
+    def inputs(self, stage, plant):
+        plant_code = plant['plant_code']
+        inputs = {
+            'code': self.code[stage],
+            'plant': fingerprint({name: plant.get(name) for name in PLANT_FIELDS[stage]}),
+        }
+        for dep in self.deps[stage]:
+            entry = self.manifest.entries.get((plant_code, dep))
+            inputs[dep] = None if entry is None else entry.get('hash', entry['status'])
+        return inputs
+
+    def changed(self, stage, plant):
+        """Names of the recorded inputs of a result that differ from the current ones."""
+        entry = self.manifest.entries.get((plant['plant_code'], stage))
+        if entry is None or 'inputs' not in entry:
+            return []
+        recorded = entry['inputs']
+        return [name for name, value in self.inputs(stage, plant).items() if recorded.get(name) != value]
+
+    def plan(self, plants, stage_names=None):
+        """
+        (plant_code, stage, reason) for every recorded result that has to be
+        recomputed, in dependency order. Results downstream of a recomputed one
+        are listed too, though a run skips them if it reproduces the same
+        result. Results that were never computed are left out; a run computes
+        those anyway.
+        """
+        stage_names = set(stage_names or self.deps)
+        stale = []
+        for plant in plants:
+            plant_code = plant['plant_code']
+            recompute = set()
+            for stage in self.stages:
+                if self.manifest.status(plant_code, stage.name) is None:
+                    continue
+                reasons = [REASONS.get(name, f'{name} result changed') for name in self.changed(stage.name, plant)]
+                reasons += [f'{dep} is recomputed' for dep in stage.deps if dep in recompute]
+                if reasons and stage.name in stage_names:
+                    recompute.add(stage.name)
+                    stale.append((plant_code, stage.name, '; '.join(reasons)))
+        return stale
+
+    def adopt(self, plants):
+        """Records the current inputs on entries that have none, taking their results as up to date."""
+        adopted = 0
+        for plant in plants:
+            for stage in self.stages:
+                entry = self.manifest.entries.get((plant['plant_code'], stage.name))
+                if entry is None or 'inputs' in entry:
+                    continue
+                self.manifest.record(plant['plant_code'], stage.name, entry['status'], dict(entry),
+                                     inputs=self.inputs(stage.name, plant))
+                adopted += 1
+        self.manifest.flush()
+        return adopted
@@ -0,0 +1,41 @@
+import re
+
+# element categories that carry an article's text; navigation, headers, footers,
+# image captions and stray link text are dropped
+MAIN_CATEGORIES = {'Title', 'NarrativeText', 'ListItem', 'Table'}
+# below this much main text a page is probably rendered by JavaScript
+MIN_CHARS = 250
+JS_REQUIRED = re.compile(r'enable javascript|javascript is (?:disabled|required)|requires? javascript', re.I)
+
+
+def extract_html(html):
+    """
+    Runs in a worker process: the main text of a downloaded HTML page, one
+    paragraph per element, with unstructured's <article>/<main> assembly
+    doing the boilerplate removal. Repeated short lines (menus, share
+    buttons, cookie notices) are kept only once.
+    """
+    from unstructured.partition.html import partition_html
+
+    elements = partition_html(text=html, html_assemble_articles=True)
+    paragraphs = []
+    seen = set()
+    for element in elements:
+        if element.category not in MAIN_CATEGORIES:
+            continue
+        text = element.text.strip()
+        if not text:
+            continue
+        if len(text) < 200:
+            if text in seen:
+                continue
+            seen.add(text)
+        paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+
+def needs_js(html, text):
+    """Whether a page extracted to too little text to be the article, e.g. a JavaScript app shell."""
+    if len(text) < MIN_CHARS:
+        return True
+    return len(text) < 4 * MIN_CHARS and JS_REQUIRED.search(html) is not None
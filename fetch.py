@@ -0,0 +1,291 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+import pandas as pd
+from tqdm import tqdm
+from unstructured.cleaners.core import group_broken_paragraphs
+
+from dedup import mark_duplicates
+from extract import needs_js
+from metrics import classify_status, looks_paywalled, metrics
+from partition_pool import PartitionPool
+from results_io import Manifest, read_result
+from url_cache import UrlCache
+
+headers = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '3600',
+    'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
+}
+
+READER_URL = os.environ.get('READER_URL', "https://r.jina.ai/")
+MAX_BYTES = 50 * 1024 * 1024
+MAX_HTML_BYTES = 10 * 1024 * 1024
+MAX_CHARS = 10000
+
+failure_messages = {'timeout': 'Timed out', 'error': 'Could not access content'}
+
+
+def truncate_content(content, max_chars=MAX_CHARS):
+    """
+    This function takes in a string and truncates it to the first 10000 characters.
+    """
+    if len(content) > max_chars:
+        trunc_content = content[:max_chars] + "... Remaining content truncated. Full length: " + str(len(content)) + " characters."
+        return trunc_content
+    return content
+
+
+def mime_type_of(content_type, default='unknown'):
+    return (content_type or '').split(';')[0].strip().lower() or default
+
+
+async def read_body(response, max_bytes):
+    chunks = []
+    size = 0
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        size += len(chunk)
+        if size > max_bytes:
+            raise ValueError(f"Response larger than {max_bytes} bytes")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def decode_html(body, charset):
+    try:
+        return body.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+
+def format_full_text(end_result):
+    """The <doc> list of a plant's articles; near-duplicates (see dedup.py) only point to their first copy."""
+    return "\n".join([
+        f"<doc>\nArticle Letter: {r['article_letter']}\nDuplicate of article {r['duplicate_of']}\n</doc>"
+        if r.get('duplicate_of') else
+        f"<doc>\nArticle Letter: {r['article_letter']}\n{r['title']}\n{r['description']}\n{r['content']}\n</doc>"
+        for r in end_result
+    ])
+
+
+class FetchEngine:
+    """
+    Shared aiohttp sessions for scraping search results. Article hosts and the
+    r.jina.ai reader get separate connection pools so a burst of reader calls
+    never eats into the per-host limit of the article sites (and vice versa).
+    Connections are kept alive and reused across links and plants, and every
+    link is looked up in the shared URL cache before touching the network
+    (pass cache=False to disable it). Non-HTML links are parsed in a separate
+    process pool (see partition_pool.py) with `strategy` as the default
+    unstructured strategy and `strategies` as per-MIME-type overrides.
+
+    HTML pages are extracted from the downloaded body in the same pool (see
+    extract.py), so a link costs one request. With reader_fallback=True, pages
+    that extract to almost nothing (JavaScript-rendered) or that the site
+    refused are fetched again through the reader at `reader_url` (r.jina.ai).
+    """
+
+    def __init__(self, strategy="auto", deadline=30, limit=100, limit_per_host=4,
+                 reader_limit=20, max_plants=50, cache=None, max_chars=MAX_CHARS,
+                 strategies=None, partition_workers=None, partition_pool=None, reader_url=READER_URL,
+                 reader_fallback=False):
+        self.reader_url = reader_url
+        self.reader_fallback = reader_fallback
+        # a cache passed in is the caller's to close
+        self.owns_cache = cache is None
+        self.cache = UrlCache() if cache is None else cache
+        self.max_chars = max_chars
+        self.partition_pool = partition_pool or PartitionPool(
+            max_workers=partition_workers, strategies=strategies, default_strategy=strategy
+        )
+        self.deadline = deadline
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.reader_limit = reader_limit
+        self.plant_semaphore = asyncio.Semaphore(max_plants)
+        self.session = None
+        self.reader_session = None
+
+    async def __aenter__(self):
+        timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=10)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=300),
+            headers=headers,
+            timeout=timeout,
+        )
+        self.reader_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.reader_limit, limit_per_host=self.reader_limit),
+            timeout=timeout,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        await self.reader_session.close()
+        if self.owns_cache:
+            self.cache.close()
+
+    async def fetch_reader(self, link, mime_type):
+        async with asyncio.timeout(self.deadline):
+            async with self.reader_session.get(self.reader_url + link) as reader:
+                reader.raise_for_status()
+                text = await reader.text()
+        metrics.observe('fetch_bytes', len(text.encode('utf-8')), mime_type=mime_type_of(mime_type), via='reader')
+        return text
+
+    async def fetch_text(self, link):
+        # a single streamed GET: the headers tell us the content type, and the
+        # body we are already receiving is kept in memory (HTML) or spooled to
+        # disk (anything else) and handed to the partition pool. The deadline
+        # covers the network work only; time spent waiting for a free partition
+        # slot is added back onto it.
+        loop = asyncio.get_running_loop()
+        holding_slot = False
+        try:
+            async with asyncio.timeout(self.deadline) as deadline:
+                async with self.session.get(link) as r:
+                    content_type = r.headers.get('content-type', '')
+                    # unstructured detects the type itself when there is none
+                    mime_type = mime_type_of(content_type, None)
+                    if r.status >= 400:
+                        if not self.reader_fallback:
+                            # counted once, by fetch_content
+                            r.raise_for_status()
+                        # the site refused, but the link is still worth a try through the reader
+                        metrics.error('article', classify_status(r.status))
+                        html = path = None
+                    else:
+                        waiting_since = loop.time()
+                        await self.partition_pool.acquire()
+                        holding_slot = True
+                        deadline.reschedule(deadline.when() + loop.time() - waiting_since)
+                        if 'text/html' in content_type:
+                            html, path = decode_html(await read_body(r, MAX_HTML_BYTES), r.charset), None
+                        else:
+                            html, path = None, await self.partition_pool.spool(r, mime_type, MAX_BYTES)
+            if path is not None:
+                metrics.observe('fetch_bytes', os.path.getsize(path), mime_type=mime_type_of(mime_type),
+                                via='partition')
+                return await self.partition_pool.partition(path, mime_type), content_type
+            if html is not None:
+                metrics.observe('fetch_bytes', len(html.encode('utf-8')), mime_type=mime_type_of(mime_type),
+                                via='local')
+                text = await self.partition_pool.extract(html)
+                if not (self.reader_fallback and needs_js(html, text)):
+                    if not text:
+                        raise ValueError("No text extracted from the page")
+                    return text, content_type
+                metrics.inc('reader_fallbacks_total')
+        finally:
+            if holding_slot:
+                self.partition_pool.release()
+        return await self.fetch_reader(link, mime_type), content_type
+
+    async def fetch_content(self, link):
+        # SQLite calls run on a thread so a slow disk or a busy lock doesn't stall every other fetch
+        cached = await asyncio.to_thread(self.cache.get, link) if self.cache else None
+        if cached is not None:
+            metrics.inc('url_cache_hits_total', status=cached['status'])
+            if cached['status'] != 'ok':
+                return failure_messages[cached['status']]
+            if cached['max_chars'] == self.max_chars:
+                return cached['content']
+            return group_broken_paragraphs(truncate_content(cached['text'], self.max_chars))
+
+        content_type = None
+        start = time.monotonic()
+        try:
+            text, content_type = await self.fetch_text(link)
+        except TimeoutError:
+            status = 'timeout'
+            kind = metrics.error('fetch', 'timeout')
+        except Exception as e:
+            status = 'error'
+            kind = metrics.error('fetch', e)
+        else:
+            outcome = 'paywall' if looks_paywalled(text) else 'ok'
+            if outcome == 'paywall':
+                metrics.error('fetch', 'paywall')
+            metrics.observe('fetch_seconds', time.monotonic() - start, mime_type=mime_type_of(content_type),
+                            outcome=outcome)
+            content = group_broken_paragraphs(truncate_content(text, self.max_chars))
+            if self.cache:
+                await asyncio.to_thread(self.cache.put, link, 'ok', content_type, text, content, self.max_chars)
+            return content
+        metrics.observe('fetch_seconds', time.monotonic() - start, mime_type=mime_type_of(content_type), outcome=kind)
+        if self.cache:
+            await asyncio.to_thread(self.cache.put, link, status, content_type)
+        return failure_messages[status]
+
+    async def fetch_result(self, index, search_result):
+        current_result = {}
+        try:
+            current_result['content'] = await self.fetch_content(search_result['link'])
+        except Exception:
+            current_result['content'] = 'Could not access content'
+        current_result['article_letter'] = chr(65 + index)
+        current_result['link'] = search_result.get("link", "")
+        current_result['title'] = search_result.get("title", "")
+        current_result['description'] = search_result.get("description", "")
+        return current_result
+
+    async def partition_content(self, search_results):
+        """Fetch all organic results of one plant concurrently."""
+        organic_results = search_results.get('organic', [])
+        if organic_results == []:
+            return {
+                "full_text": "No organic results found.",
+                "individual_results": []
+            }
+        async with self.plant_semaphore:
+            end_result = await asyncio.gather(*[
+                self.fetch_result(index, search_result)
+                for index, search_result in enumerate(organic_results)
+            ])
+        duplicates = mark_duplicates(end_result)
+        metrics.inc('duplicate_articles_total', duplicates, where='content')
+        return {
+            "full_text": format_full_text(end_result),
+            "individual_results": list(end_result)
+        }
+
+    async def partition_all(self, plant_search_results):
+        """
+        Takes (plant_code, search_results) pairs and yields (plant_code, content)
+        as each plant finishes, sharing connection pools across all plants.
+        """
+        async def run(plant_code, search_results):
+            return plant_code, await self.partition_content(search_results)
+
+        tasks = [asyncio.create_task(run(pc, sr)) for pc, sr in plant_search_results]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+
+async def partition_content_async(search_results, **engine_kwargs):
+    async with FetchEngine(**engine_kwargs) as engine:
+        return await engine.partition_content(search_results)
+
+
+async def partition_plants(plant_codes, manifest, **engine_kwargs):
+    """Scrape content for plant codes locally and write results/content/{plant_code}.json through the manifest."""
+    async with FetchEngine(**engine_kwargs) as engine:
+        pairs = ((plant_code, read_result('search', plant_code)) for plant_code in plant_codes)
+        with tqdm(total=len(plant_codes), desc="Processing plant codes") as pbar:
+            async for plant_code, partitioned_result in engine.partition_all(pairs):
+                manifest.write('content', plant_code, partitioned_result)
+                pbar.update(1)
+
+
+if __name__ == "__main__":
+    manifest = Manifest()
+    plant_codes = [
+        str(pc) for pc in pd.read_csv('ready_to_search.csv')['plant_code']
+        if manifest.status(str(pc), 'content') is None
+    ]
+    asyncio.run(partition_plants(plant_codes, manifest))
+    manifest.close()
@@ -0,0 +1,192 @@
+import argparse
+import hashlib
+import os
+import re
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+COUNTY_SHAPEFILE = 'cb_2022_us_county_5m/cb_2022_us_county_5m.shp'
+DEMOGRAPHICS_SHAPEFILE = os.environ.get('DEMOGRAPHICS_SHAPEFILE', 'demographic_data/usa/usa.shp')
+GEO_JOIN_CACHE = os.environ.get('GEO_JOIN_CACHE', 'cache/geo_join.parquet')
+SQ_METERS_PER_SQ_MILE = 2589988.11
+
+# CEJST 1.0 tract fields (see demographic_data/1.0-shapefile-codebook) and the
+# labels used in the probit model. Tract values are averaged per county,
+# weighted by tract population (TPF).
+DEMOGRAPHIC_FIELDS = {
+    'DM_B': 'Percent Black',
+    'DM_H': 'Percent Hispanic',
+    'DM_W': 'Percent White',
+    'HSEF': 'Percent 25 or Older with Less Than HS Degree',
+    'AGE_OLD': 'Percent Above 64',
+    'AGE_MIDDLE': 'Percent Ages 10-64',
+    'EBF_PFS': 'Energy Burden Percentile',
+    'LMI_PFS': 'LMI Percentile Based on AMI',
+    'PM25F_PFS': 'PM2.5 in the Air Percentile',
+    'UF_PFS': 'Unemployment Percentile',
+}
+DEMOGRAPHIC_LABELS = {**DEMOGRAPHIC_FIELDS, 'population_density': 'Population Density (per sq mile)'}
+
+COUNTY_SUFFIXES = re.compile(r"\b(county|parish|borough|census area|municipality|city and borough)\b")
+
+
+def normalize_county(name):
+    """'St. Mary's Parish' -> 'saint marys', so EIA county names match the Census NAME/NAMELSAD fields."""
+    name = str(name).lower().replace('st.', 'saint').replace('ste.', 'sainte')
+    name = COUNTY_SUFFIXES.sub('', name)
+    return re.sub(r"[^a-z0-9]+", ' ', name).strip()
+
+
+def file_hash(*paths):
+    """Hash of the contents of the given files, skipping the ones that don't exist."""
+    digest = hashlib.sha256()
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sidecars(shapefile, extensions=('.shp', '.dbf')):
+    base, _ = os.path.splitext(shapefile)
+    return [base + extension for extension in extensions]
+
+
+@lru_cache(maxsize=None)
+def load_counties(path=COUNTY_SHAPEFILE):
+    """County polygons, read once per process."""
+    return gpd.read_file(path)
+
+
+class CountyIndex:
+    """
+    Resolves plants to county FIPS codes. Plants whose state and county names
+    match a Census county take the fast path (a dict lookup); the rest are
+    located by point-in-polygon against an STRtree of the county polygons,
+    which needs longitude/latitude columns in the plants table.
+    """
+
+    def __init__(self, counties):
+        self.counties = counties
+        self.geoids = counties['GEOID'].to_numpy()
+        self.by_name = {}
+        for state, name, name_lsad, geoid in counties[['STUSPS', 'NAME', 'NAMELSAD', 'GEOID']].itertuples(index=False):
+            self.by_name.setdefault((state, normalize_county(name)), geoid)
+            # independent cities (e.g. "Richmond city" next to Richmond County) only match on NAMELSAD
+            self.by_name[(state, normalize_county(name_lsad))] = geoid
+        self.tree = shapely.STRtree(counties.geometry.to_numpy())
+
+    def fips_for_names(self, states, counties):
+        return np.array([
+            self.by_name.get((state, normalize_county(county))) if isinstance(county, str) else None
+            for state, county in zip(states, counties)
+        ], dtype=object)
+
+    def fips_for_points(self, longitude, latitude):
+        points = shapely.points(np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float))
+        fips = np.full(len(points), None, dtype=object)
+        point_index, county_index = self.tree.query(points, predicate='within')
+        fips[point_index] = self.geoids[county_index]
+        return fips
+
+    def resolve(self, plants):
+        """Returns (county_fips, join_method) arrays aligned with the plants rows."""
+        fips = self.fips_for_names(plants['state'], plants['county'])
+        method = np.where(pd.notna(fips), 'fips', None).astype(object)
+        missing = pd.isna(fips)
+        if missing.any() and {'longitude', 'latitude'} <= set(plants.columns):
+            rows = plants[missing]
+            has_point = rows[['longitude', 'latitude']].notna().all(axis=1).to_numpy()
+            located = np.full(len(rows), None, dtype=object)
+            located[has_point] = self.fips_for_points(rows['longitude'][has_point], rows['latitude'][has_point])
+            fips[missing] = located
+            method[missing] = np.where(pd.notna(located), 'spatial', None)
+        return fips, method
+
+
+def county_demographics(path=DEMOGRAPHICS_SHAPEFILE):
+    """
+    Population-weighted county averages of the CEJST tract fields, keyed by the
+    county FIPS prefix of GEOID10_TR. Only the attribute table is read.
+    """
+    tracts = gpd.read_file(path, columns=['GEOID10_TR', 'TPF', *DEMOGRAPHIC_FIELDS], ignore_geometry=True)
+    tracts = pd.DataFrame(tracts)
+    fields = list(DEMOGRAPHIC_FIELDS)
+    values = tracts[fields].apply(pd.to_numeric, errors='coerce')
+    # missing values are stored as negative sentinels
+    values = values.where(values >= 0)
+    population = pd.to_numeric(tracts['TPF'], errors='coerce').fillna(0).clip(lower=0)
+    weights = values.notna().mul(population, axis=0)
+    county = tracts['GEOID10_TR'].astype(str).str.zfill(11).str[:5]
+    weighted = values.fillna(0).mul(population, axis=0).groupby(county).sum()
+    demographics = weighted / weights.groupby(county).sum().replace(0, np.nan)
+    demographics['TPF'] = population.groupby(county).sum()
+    return demographics.rename_axis('county_fips').reset_index()
+
+
+def join_plants(plants, counties_path=COUNTY_SHAPEFILE, demographics_path=DEMOGRAPHICS_SHAPEFILE):
+    """Plants with county_fips, join_method, land area, population density and the CEJST fields."""
+    counties = load_counties(counties_path)
+    fips, method = CountyIndex(counties).resolve(plants)
+    joined = pd.DataFrame({
+        'plant_code': plants['plant_code'].to_numpy(),
+        'county_fips': fips,
+        'join_method': method,
+    })
+    joined = joined.merge(
+        pd.DataFrame({'county_fips': counties['GEOID'], 'ALAND': counties['ALAND']}), on='county_fips', how='left'
+    )
+    if os.path.exists(demographics_path):
+        joined = joined.merge(county_demographics(demographics_path), on='county_fips', how='left')
+        joined['population_density'] = joined['TPF'] / (joined['ALAND'] / SQ_METERS_PER_SQ_MILE)
+    return joined
+
+
+def input_hash(plants, counties_path, demographics_path):
+    columns = [column for column in ('plant_code', 'state', 'county', 'longitude', 'latitude') if column in plants]
+    plants_hash = hashlib.sha256(pd.util.hash_pandas_object(plants[columns], index=False).to_numpy().tobytes())
+    return hashlib.sha256(''.join([
+        plants_hash.hexdigest(), file_hash(*sidecars(counties_path)), file_hash(*sidecars(demographics_path, ('.dbf',))),
+    ]).encode('utf-8')).hexdigest()
+
+
+def load_geo_join(plants, counties_path=COUNTY_SHAPEFILE, demographics_path=DEMOGRAPHICS_SHAPEFILE,
+                  cache_path=GEO_JOIN_CACHE):
+    """
+    join_plants, cached as Parquet. The cache stores the hash of the plants'
+    location columns and of the shapefiles it was built from, so it is reused
+    until one of them changes, e.g. not after a new scoring pass.
+    """
+    key = input_hash(plants, counties_path, demographics_path)
+    if os.path.exists(cache_path):
+        metadata = pq.read_schema(cache_path).metadata or {}
+        if metadata.get(b'input_hash', b'').decode() == key:
+            return pd.read_parquet(cache_path)
+    joined = join_plants(plants, counties_path, demographics_path)
+    table = pa.Table.from_pandas(joined, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'input_hash': key.encode()})
+    if os.path.dirname(cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    pq.write_table(table, cache_path)
+    return joined
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Join plants to counties and county demographics")
+    parser.add_argument('--plants', default='ready_to_search.csv')
+    parser.add_argument('--counties', default=COUNTY_SHAPEFILE)
+    parser.add_argument('--demographics', default=DEMOGRAPHICS_SHAPEFILE)
+    parser.add_argument('--cache', default=GEO_JOIN_CACHE)
+    args = parser.parse_args()
+
+    joined = load_geo_join(pd.read_csv(args.plants), args.counties, args.demographics, args.cache)
+    print(joined['join_method'].value_counts(dropna=False))
+    print(f"Wrote {len(joined)} plants to {args.cache}")
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+LABEL_STORE_PATH = os.environ.get('LABEL_STORE_PATH', 'cache/labels.db')
+LABEL_COLUMN = 'human'
+
+
+def column_letter(index):
+    """1 -> 'A', 27 -> 'AA'."""
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+class LabelStore:
+    """
+    Local SQLite store of labeling tasks, one per row of the labeling sheet
+    (`id` is the sheet row number). The app reads and writes only this store:
+
+    - `claim` hands a labeler the next unlabeled rows in one IMMEDIATE
+      transaction, so two labelers never get the same row. Claims expire after
+      `lease` seconds, so rows of a labeler who closed the tab go back in the pool.
+    - `submit` writes the one submitted label and marks it for syncing.
+    - `unsynced` / `mark_synced` let a sync target (e.g. SheetSync) push only
+      the labels it hasn't seen yet.
+
+    Every query is an index lookup, so page latency doesn't grow with the sheet.
+    """
+
+    def __init__(self, path=LABEL_STORE_PATH, lease=15 * 60):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY,
+                query TEXT,
+                result TEXT,
+                data TEXT NOT NULL,
+                label TEXT,
+                labeled_by TEXT,
+                labeled_at REAL,
+                claimed_by TEXT,
+                claimed_at REAL,
+                synced INTEGER NOT NULL DEFAULT 1
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_open ON tasks (id) WHERE label IS NULL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_unsynced ON tasks (id) WHERE synced = 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_claims ON tasks (claimed_by) WHERE label IS NULL")
+
+    def import_rows(self, records, first_row=2):
+        """
+        Upserts sheet records (dicts, e.g. from get_all_records) as tasks. New
+        rows are added; a label already in the sheet is taken over unless the
+        store has an unsynced one of its own. Returns the number of new tasks.
+        """
+        rows = []
+        for i, record in enumerate(records):
+            label = record.get(LABEL_COLUMN) or None
+            data = {k: v for k, v in record.items() if k != LABEL_COLUMN}
+            rows.append((first_row + i, record.get('query'), record.get('result'), json.dumps(data), label))
+        with self._lock:
+            before = self.conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("""
+                    INSERT INTO tasks (id, query, result, data, label) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        query = excluded.query, result = excluded.result, data = excluded.data,
+                        label = CASE WHEN tasks.synced = 0 THEN tasks.label ELSE excluded.label END
+                """, rows)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            return self.conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] - before
+
+    def claim(self, labeler, n=1):
+        """
+        Up to `n` unlabeled tasks for `labeler`: the ones it already holds first
+        (their lease is renewed), then new ones from the pool in sheet order.
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                held = [row['id'] for row in self.conn.execute(
+                    "SELECT id FROM tasks WHERE label IS NULL AND claimed_by = ? AND claimed_at >= ? ORDER BY id LIMIT ?",
+                    (labeler, now - self.lease, n),
+                )]
+                free = [row['id'] for row in self.conn.execute(
+                    "SELECT id FROM tasks WHERE label IS NULL AND (claimed_by IS NULL OR claimed_at < ?) "
+                    "ORDER BY id LIMIT ?",
+                    (now - self.lease, n - len(held)),
+                )] if len(held) < n else []
+                ids = held + free
+                self.conn.executemany(
+                    "UPDATE tasks SET claimed_by = ?, claimed_at = ? WHERE id = ?", [(labeler, now, i) for i in ids]
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            if not ids:
+                return []
+            placeholders = ','.join('?' * len(ids))
+            rows = self.conn.execute(f"SELECT id, query, result, data FROM tasks WHERE id IN ({placeholders}) ORDER BY id",
+                                     ids).fetchall()
+        return [{'id': row['id'], 'query': row['query'], 'result': row['result'], **json.loads(row['data'])}
+                for row in rows]
+
+    def submit(self, task_id, labeler, label):
+        """
+        Stores one label. Returns False if the task was labeled in the meantime
+        (e.g. by someone who picked it up after this labeler's lease expired).
+        """
+        with self._lock:
+            updated = self.conn.execute(
+                "UPDATE tasks SET label = ?, labeled_by = ?, labeled_at = ?, claimed_by = NULL, synced = 0 "
+                "WHERE id = ? AND label IS NULL",
+                (label, labeler, time.time(), task_id),
+            ).rowcount
+        return updated == 1
+
+    def release(self, labeler):
+        """Returns a labeler's claimed tasks to the pool."""
+        with self._lock:
+            self.conn.execute("UPDATE tasks SET claimed_by = NULL, claimed_at = NULL "
+                              "WHERE claimed_by = ? AND label IS NULL", (labeler,))
+
+    def unsynced(self, limit=None):
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(
+                "SELECT id, label FROM tasks WHERE synced = 0 ORDER BY id LIMIT ?", (limit or -1,)
+            )]
+
+    def mark_synced(self, ids):
+        with self._lock:
+            self.conn.executemany("UPDATE tasks SET synced = 1 WHERE id = ?", [(i,) for i in ids])
+
+    def stats(self):
+        with self._lock:
+            total, labeled, unsynced = self.conn.execute(
+                "SELECT COUNT(*), COUNT(label), COALESCE(SUM(synced = 0), 0) FROM tasks"
+            ).fetchone()
+            claimed = self.conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE label IS NULL AND claimed_at >= ?", (time.time() - self.lease,)
+            ).fetchone()[0]
+        return {'tasks': total, 'labeled': labeled, 'claimed': claimed, 'unsynced': unsynced}
+
+    def close(self):
+        self.conn.close()
+
+
+class SheetSync:
+    """
+    Optional sync target: pushes new labels from a LabelStore to the label
+    column of a gspread worksheet in batched cell updates (one API call per
+    `batch_size` labels), and pulls new sheet rows into the store. `start`
+    runs the pushes on one background thread, woken by `notify`.
+    """
+
+    def __init__(self, worksheet, store, batch_size=50, interval=60):
+        self.worksheet = worksheet
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.last_push = 0
+        self._lock = threading.Lock()
+        self._column = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def label_column(self):
+        if self._column is None:
+            header = self.worksheet.row_values(1)
+            self._column = column_letter(header.index(LABEL_COLUMN) + 1)
+        return self._column
+
+    def pull(self):
+        """Imports the whole sheet; only needed on first use or when rows were added to the sheet."""
+        return self.store.import_rows(self.worksheet.get_all_records())
+
+    def push(self):
+        """Writes every unsynced label to the sheet. Returns the number of cells written."""
+        with self._lock:
+            pushed = 0
+            while True:
+                rows = self.store.unsynced(self.batch_size)
+                if not rows:
+                    break
+                column = self.label_column()
+                self.worksheet.batch_update([
+                    {'range': f"{column}{row['id']}", 'values': [[row['label']]]} for row in rows
+                ])
+                self.store.mark_synced([row['id'] for row in rows])
+                pushed += len(rows)
+            self.last_push = time.time()
+            return pushed
+
+    def maybe_push(self):
+        """Pushes once a batch has built up or `interval` seconds have passed since the last push."""
+        if len(self.store.unsynced(self.batch_size)) >= self.batch_size or time.time() - self.last_push > self.interval:
+            return self.push()
+        return 0
+
+    def start(self):
+        """Starts the background pusher, once; it checks after every `notify` and every `interval` seconds."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return self
+
+    def notify(self):
+        """Tells the background pusher a label was stored."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.maybe_push()
+            except Exception as e:
+                # the labels stay unsynced and go out with the next push
+                print(f"Pushing labels to the sheet failed: {e!r}")
+
+
+def open_worksheet(url, credentials='gcloud.json'):
+    import gspread
+
+    return gspread.service_account(filename=credentials).open_by_url(url).sheet1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync the local label store with the labeling sheet")
+    parser.add_argument('command', choices=['pull', 'push', 'stats'])
+    parser.add_argument('--path', default=LABEL_STORE_PATH)
+    parser.add_argument('--sheet', help="labeling sheet url (pull/push)")
+    parser.add_argument('--credentials', default='gcloud.json')
+    args = parser.parse_args()
+
+    store = LabelStore(args.path)
+    if args.command == 'stats':
+        print(store.stats())
+    else:
+        sync = SheetSync(open_worksheet(args.sheet, args.credentials), store)
+        if args.command == 'pull':
+            print(f"Imported {sync.pull()} new rows")
+        else:
+            print(f"Pushed {sync.push()} labels")
+    store.close()
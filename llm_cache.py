@@ -0,0 +1,120 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from sqlite_cache import SqliteCache
+
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', 'cache/llm.db')
+
+
+def schema_hash(response_model):
+    """Hash of the pydantic JSON schema, field descriptions included, since they are part of the prompt."""
+    schema = json.dumps(response_model.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(schema.encode('utf-8')).hexdigest()
+
+
+def request_key(request):
+    """
+    Cache key for a request in the *_request form (model, response_model,
+    temperature, messages and optionally system): the hash of the rendered
+    prompt together with the schema hash.
+    """
+    payload = {
+        'model': request['model'],
+        'temperature': request.get('temperature'),
+        'system': request.get('system'),
+        'messages': request['messages'],
+        'schema': schema_hash(request['response_model']),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class LLMCache(SqliteCache):
+    """
+    Local SQLite cache of parsed LLM responses. Identical requests are answered
+    from disk, and because the response schema is part of the key, editing one
+    model's field descriptions only misses for the calls using that model; the
+    old entries are left behind until `evict_stale` (or the LRU bound) drops them.
+    """
+
+    table = 'responses'
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            schema_name TEXT NOT NULL,
+            schema_hash TEXT NOT NULL,
+            response BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)",
+        "CREATE INDEX IF NOT EXISTS responses_schema ON responses (schema_name, schema_hash)",
+    )
+
+    def __init__(self, path=LLM_CACHE_PATH, max_bytes=1024 ** 3):
+        super().__init__(path, max_bytes)
+
+    def get(self, request):
+        """Returns the cached response validated against request['response_model'], or None on a miss."""
+        key = request_key(request)
+        with self._lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return request['response_model'].model_validate_json(zlib.decompress(row[0]))
+
+    def put(self, request, response):
+        response_model = request['response_model']
+        blob = zlib.compress(response.model_dump_json().encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._put((request_key(request), request['model'], response_model.__name__, schema_hash(response_model),
+                       blob, len(blob), now, now))
+
+    def evict_stale(self, response_models):
+        """Drops entries of the given schemas that were stored under an older version of the schema."""
+        with self._lock:
+            return sum(
+                self.conn.execute(
+                    "DELETE FROM responses WHERE schema_name = ? AND schema_hash != ?",
+                    (response_model.__name__, schema_hash(response_model)),
+                ).rowcount
+                for response_model in response_models
+            )
+
+    def stats(self):
+        with self._lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            by_schema = dict(self.conn.execute(
+                "SELECT schema_name, COUNT(*) FROM responses GROUP BY schema_name"
+            ).fetchall())
+        return {'entries': entries, 'bytes': size, 'by_schema': by_schema, 'hits': self.hits, 'misses': self.misses}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or trim the LLM response cache")
+    parser.add_argument('command', choices=['stats', 'evict'])
+    parser.add_argument('--path', default=LLM_CACHE_PATH)
+    parser.add_argument('--stale', action='store_true',
+                        help="also drop entries whose response schema has changed since they were stored")
+    args = parser.parse_args()
+
+    cache = LLMCache(args.path)
+    if args.command == 'stats':
+        print(cache.stats())
+    else:
+        evicted = cache.evict()
+        if args.stale:
+            from local_parallel import ArticleRelevanceScores, ContentRelevance, ProjectSummary
+            evicted += cache.evict_stale([ArticleRelevanceScores, ContentRelevance, ProjectSummary])
+        print(f"Evicted {evicted} entries")
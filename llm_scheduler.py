@@ -0,0 +1,377 @@
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from json import JSONDecodeError
+
+import anthropic
+import instructor
+from pydantic import ValidationError
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt
+
+from llm_cache import LLMCache
+from metrics import metrics
+
+# Starting limits per model; they are replaced by the anthropic-ratelimit-* headers
+# as soon as the first response for a model comes back.
+DEFAULT_LIMITS = {
+    "claude-3-haiku-20240307": (4000, 400000, 80000),
+    "claude-3-sonnet-20240229": (4000, 400000, 80000),
+    "claude-3-opus-20240229": (4000, 400000, 80000),
+}
+
+USAGE_LOG_PATH = os.environ.get('LLM_USAGE_LOG', 'results/llm_usage.jsonl')
+
+RETRYABLE_ERRORS = (
+    anthropic.RateLimitError,
+    anthropic.InternalServerError,
+    anthropic.APIConnectionError,
+    anthropic.APITimeoutError,
+)
+
+
+def estimate_tokens(*texts):
+    """Rough token count (~4 characters per token) used before the real usage is known."""
+    return sum(len(str(text)) for text in texts) // 4 + 1
+
+
+def find_api_error(e):
+    """
+    Instructor wraps API errors (InstructorRetryException around a tenacity
+    RetryError), so search the exception chain and wrapped exceptions for the
+    anthropic one.
+    """
+    stack, seen = [e], set()
+    while stack:
+        e = stack.pop()
+        if e is None or id(e) in seen:
+            continue
+        seen.add(id(e))
+        if isinstance(e, anthropic.APIError):
+            return e
+        stack.extend([e.__cause__, e.__context__])
+        stack.extend(arg for arg in e.args if isinstance(arg, BaseException))
+        last_attempt = getattr(e, 'last_attempt', None)
+        if last_attempt is not None:
+            stack.append(last_attempt.exception())
+    return None
+
+
+def combine_usage(usages):
+    """
+    Sums the usage of every completion in one call (instructor re-asks included).
+    instructor's own running total drops the prompt cache fields.
+    """
+    return anthropic.types.Usage(
+        input_tokens=sum(usage.input_tokens for usage in usages),
+        output_tokens=sum(usage.output_tokens for usage in usages),
+        cache_creation_input_tokens=sum(usage.cache_creation_input_tokens or 0 for usage in usages),
+        cache_read_input_tokens=sum(usage.cache_read_input_tokens or 0 for usage in usages),
+    )
+
+
+def is_retryable(e):
+    return isinstance(find_api_error(e), RETRYABLE_ERRORS)
+
+
+def is_throttled(e):
+    """429 rate limited or 529 overloaded: the signal to back off concurrency."""
+    api_error = find_api_error(e)
+    return isinstance(api_error, anthropic.APIStatusError) and api_error.status_code in (429, 529)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) * 60 / self.capacity
+
+
+@dataclass
+class ModelStats:
+    requests: int = 0
+    throttled: int = 0
+    errors: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+
+
+class ModelLimiter:
+    """
+    Admission control for one model: token buckets for requests, input tokens and
+    output tokens per minute, plus an AIMD concurrency window that grows by about
+    one slot per window of successful calls and halves on every 429/529.
+    """
+
+    def __init__(self, rpm, itpm, otpm, initial_concurrency=4, max_concurrency=64):
+        self.requests = TokenBucket(rpm)
+        self.input_tokens = TokenBucket(itpm)
+        self.output_tokens = TokenBucket(otpm)
+        self.concurrency = float(initial_concurrency)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.paused_until = 0
+        self.avg_output_tokens = None
+        self.stats = ModelStats()
+        self.cond = threading.Condition()
+
+    def expected_output(self, max_tokens):
+        if self.avg_output_tokens is None:
+            return max_tokens
+        return min(max_tokens, int(self.avg_output_tokens * 1.2) + 1)
+
+    def acquire(self, input_tokens, output_tokens):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                for bucket in (self.requests, self.input_tokens, self.output_tokens):
+                    bucket.refill(now)
+                wait = max(
+                    self.paused_until - now,
+                    self.requests.wait_time(1),
+                    self.input_tokens.wait_time(input_tokens),
+                    self.output_tokens.wait_time(output_tokens),
+                )
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    self.requests.level -= 1
+                    self.input_tokens.level -= input_tokens
+                    self.output_tokens.level -= output_tokens
+                    self.in_flight += 1
+                    return
+                # releases notify the condition, so only sleep long when the buckets are the bottleneck
+                self.cond.wait(timeout=max(wait, 0.05))
+
+    def release(self, estimated_output=0, usage=None, throttled=False, retry_after=None):
+        with self.cond:
+            self.in_flight -= 1
+            self.stats.requests += 1
+            if throttled:
+                self.stats.throttled += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + (retry_after or 1))
+            elif usage is not None:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.stats.input_tokens += usage.input_tokens
+                self.stats.output_tokens += usage.output_tokens
+                self.stats.cache_creation_input_tokens += usage.cache_creation_input_tokens or 0
+                self.stats.cache_read_input_tokens += usage.cache_read_input_tokens or 0
+                # give back the part of the output reservation that wasn't used
+                self.output_tokens.level += estimated_output - usage.output_tokens
+                if self.avg_output_tokens is None:
+                    self.avg_output_tokens = usage.output_tokens
+                else:
+                    self.avg_output_tokens = 0.9 * self.avg_output_tokens + 0.1 * usage.output_tokens
+            else:
+                self.stats.errors += 1
+            self.cond.notify_all()
+
+    def observe_headers(self, headers):
+        """Syncs the buckets with the anthropic-ratelimit-* response headers."""
+        with self.cond:
+            for bucket, name in ((self.requests, 'requests'), (self.input_tokens, 'input-tokens'),
+                                 (self.output_tokens, 'output-tokens')):
+                limit = headers.get(f'anthropic-ratelimit-{name}-limit')
+                remaining = headers.get(f'anthropic-ratelimit-{name}-remaining')
+                if limit:
+                    bucket.capacity = int(limit)
+                if remaining:
+                    bucket.level = min(bucket.level, int(remaining))
+            self.cond.notify_all()
+
+
+class LLMScheduler:
+    """
+    Shared scheduler for every Anthropic call in the pipeline. Each model gets its
+    own ModelLimiter, rate-limit headers are read from every response through an
+    httpx hook, and only retryable errors (429, 5xx/529, connection errors and
+    timeouts) are retried, with full jitter. Everything else is raised to the caller.
+
+    The token usage of every successful call, including prompt cache writes and
+    reads, is appended to `usage_log` (set it to None to turn the log off).
+
+    Parsed responses are memoized in an LLMCache, opened on first use when
+    `cache` is None; pass cache=False to always call the API.
+    """
+
+    def __init__(self, max_attempts=8, base_delay=1, max_delay=60, usage_log=USAGE_LOG_PATH, cache=None,
+                 **limiter_kwargs):
+        self.max_attempts = max_attempts
+        self.usage_log = usage_log
+        self.cache = cache
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter_kwargs = limiter_kwargs
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def limiter(self, model):
+        with self.lock:
+            if model not in self.limiters:
+                rpm, itpm, otpm = DEFAULT_LIMITS.get(model, (1000, 100000, 20000))
+                self.limiters[model] = ModelLimiter(rpm, itpm, otpm, **self.limiter_kwargs)
+            return self.limiters[model]
+
+    def on_response(self, response):
+        # the hook runs in the calling thread, which has set the model it is calling
+        model = getattr(self.local, 'model', None)
+        if model is not None:
+            self.limiter(model).observe_headers(response.headers)
+
+    def anthropic_client(self, **kwargs):
+        """An Anthropic client whose retries and rate-limit headers are handled by this scheduler."""
+        http_client = anthropic.DefaultHttpxClient(event_hooks={'response': [self.on_response]})
+        return anthropic.Anthropic(max_retries=0, http_client=http_client, **kwargs)
+
+    def response_cache(self):
+        with self.lock:
+            if self.cache is None:
+                self.cache = LLMCache()
+            return self.cache or None
+
+    def on_completion(self, response):
+        # instructor hook: runs before instructor swaps in its own usage total
+        usages = getattr(self.local, 'usages', None)
+        if usages is not None and getattr(response, 'usage', None) is not None:
+            usages.append(response.usage)
+
+    def instructor_client(self, **kwargs):
+        """An instructor client on top of anthropic_client that reports per-completion usage here."""
+        client = instructor.from_anthropic(self.anthropic_client(**kwargs))
+        client.on('completion:response', self.on_completion)
+        return client
+
+    def backoff(self, attempt, e):
+        api_error = find_api_error(e)
+        retry_after = None
+        if isinstance(api_error, anthropic.APIStatusError):
+            retry_after = api_error.response.headers.get('retry-after')
+        if retry_after:
+            return float(retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def create(self, client, model, messages, max_tokens, **kwargs):
+        """
+        Runs client.messages.create_with_completion (an instructor client) under the
+        model's limits and returns the parsed response model, or the cached one if
+        the same request has been answered before.
+        """
+        cache = self.response_cache()
+        request = dict(kwargs, model=model, messages=messages)
+        if cache is not None and 'response_model' in kwargs:
+            cached = cache.get(request)
+            if cached is not None:
+                metrics.inc('llm_cache_hits_total', model=model, schema=kwargs['response_model'].__name__)
+                return cached
+        limiter = self.limiter(model)
+        # instructor re-asks on invalid output only; API errors come straight back here
+        kwargs.setdefault('max_retries', Retrying(
+            stop=stop_after_attempt(3), retry=retry_if_exception_type((ValidationError, JSONDecodeError)), reraise=True
+        ))
+        response_model = kwargs.get('response_model')
+        schema = response_model.model_json_schema() if response_model else ''
+        input_estimate = estimate_tokens(messages, kwargs.get('system', ''), schema)
+        for attempt in range(self.max_attempts):
+            output_estimate = limiter.expected_output(max_tokens)
+            limiter.acquire(input_estimate, output_estimate)
+            self.local.model = model
+            self.local.usages = []
+            start = time.monotonic()
+            try:
+                response, completion = client.messages.create_with_completion(
+                    model=model, messages=messages, max_tokens=max_tokens, **kwargs
+                )
+            except Exception as e:
+                metrics.error('llm', e, model=model)
+                delay = self.backoff(attempt, e)
+                limiter.release(throttled=is_throttled(e), retry_after=delay)
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    raise
+                time.sleep(delay)
+                continue
+            finally:
+                self.local.model = None
+            usage = combine_usage(self.local.usages) if self.local.usages else completion.usage
+            self.local.usages = None
+            limiter.release(estimated_output=output_estimate, usage=usage)
+            self.log_usage(model, response_model, usage, time.monotonic() - start)
+            if cache is not None and response_model is not None:
+                cache.put(request, response)
+            return response
+
+    def log_usage(self, model, response_model, usage, latency=None, mode='sync'):
+        """Appends one call's token accounting to the usage log and the metrics."""
+        schema = response_model.__name__ if response_model else None
+        if latency is not None:
+            metrics.observe('llm_seconds', latency, model=model, schema=schema, mode=mode)
+        metrics.observe('llm_output_tokens', usage.output_tokens, model=model, schema=schema, mode=mode)
+        for kind, tokens in [('input', usage.input_tokens), ('output', usage.output_tokens),
+                             ('cache_creation', usage.cache_creation_input_tokens or 0),
+                             ('cache_read', usage.cache_read_input_tokens or 0)]:
+            metrics.inc('llm_tokens_total', tokens, model=model, schema=schema, mode=mode, type=kind)
+        if self.usage_log is None:
+            return
+        entry = {
+            'time': time.time(),
+            'model': model,
+            'schema': schema,
+            'mode': mode,
+            'input_tokens': usage.input_tokens,
+            'output_tokens': usage.output_tokens,
+            'cache_creation_input_tokens': usage.cache_creation_input_tokens or 0,
+            'cache_read_input_tokens': usage.cache_read_input_tokens or 0,
+            'latency': round(latency, 3) if latency is not None else None,
+        }
+        with self.lock:
+            os.makedirs(os.path.dirname(self.usage_log) or '.', exist_ok=True)
+            with open(self.usage_log, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def stats(self):
+        return {
+            model: {**limiter.stats.__dict__, 'concurrency': round(limiter.concurrency, 2)}
+            for model, limiter in self.limiters.items()
+        }
+
+
+scheduler = LLMScheduler()
+
+
+def summarize_usage(path=USAGE_LOG_PATH):
+    """Token totals and prompt cache hit rate per model and schema from the usage log."""
+    totals = {}
+    with open(path, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            key = (entry['model'], entry['schema'], entry['mode'])
+            total = totals.setdefault(key, dict.fromkeys(
+                ['calls', 'input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'], 0))
+            total['calls'] += 1
+            for name in total:
+                if name != 'calls':
+                    total[name] += entry[name]
+    for (model, schema, mode), total in sorted(totals.items()):
+        # input_tokens only counts the uncached part of the prompt
+        prompt_tokens = total['input_tokens'] + total['cache_creation_input_tokens'] + total['cache_read_input_tokens']
+        hit_rate = total['cache_read_input_tokens'] / prompt_tokens if prompt_tokens else 0
+        print(f"{model} {schema} ({mode}): {total['calls']} calls, {prompt_tokens} prompt tokens "
+              f"({hit_rate:.0%} read from cache, {total['cache_creation_input_tokens']} written), "
+              f"{total['output_tokens']} output tokens")
+
+
+if __name__ == "__main__":
+    summarize_usage()
@@ -1,24 +1,19 @@
 from tqdm import tqdm
-import backoff
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import urllib.request
-import urllib.parse
-import os
-import json
 from modal import Image
 import pandas as pd
 import modal
-import requests
-from unstructured.partition.auto import partition
-from unstructured.cleaners.core import group_broken_paragraphs
-from pydantic import BaseModel, Field, ValidationError, conint, SkipValidation
+import asyncio
+from fetch import partition_content_async
+from serp import get_search_results  # noqa: F401 (re-exported, it used to live here)
+from pydantic import BaseModel, Field, SkipValidation
 from typing import List
-from anthropic import Anthropic
-from openai import OpenAI
-import instructor
-
-# load dotenv
-from dotenv import load_dotenv
+from functools import lru_cache
+from llm_scheduler import scheduler
+from context_packer import format_docs, pack_articles
+from dedup import mark_duplicates, search_duplicates
+from metrics import metrics
+from backends import get_backend
+from results_io import Manifest, read_result
 
 opus = "claude-3-opus-20240229" #200k context window
 sonnet = "claude-3-sonnet-20240229" #200k context window
@@ -36,87 +31,25 @@ bright_data_search_image = (
     Image.debian_slim(python_version="3.11")
     .apt_install("libmagic-dev")
     .pip_install('unstructured[all-docs]')
-    .pip_install("pandas", "numpy", "urllib3", "requests", "tqdm", "python-dotenv"
+    .pip_install("pandas", "numpy", "urllib3", "requests", "tqdm", "python-dotenv", "aiohttp"
                  #"boto3", "pydantic", "typing", "openai", "anthropic", "instructor")
                 )
     .apt_install("libgl1-mesa-glx", "libglib2.0-0", "python3-opencv")
     .run_commands("apt-get install -y poppler-utils tesseract-ocr")
     .pip_install("nltk")
+    # llm_scheduler is imported at module level; the rest are the store, geo join, probit and preclassifier deps
+    .pip_install("anthropic", "instructor", "pydantic", "tenacity", "pyarrow", "geopandas", "shapely",
+                 "statsmodels", "scipy", "scikit-learn", "joblib")
     # .run_function(pull_unstructured)
 )
 
 stub = modal.Stub("bright_data_search", image=bright_data_search_image)
+# Modal, or the local job queue with EXECUTION_BACKEND=local (see backends.py)
+backend = get_backend(stub)
 
-@stub.function(concurrency_limit=10)
+@backend.function(concurrency_limit=10)
 def partition_content(search_results):
-    headers = {
-    'Access-Control-Allow-Origin': '*',
-    'Access-Control-Allow-Methods': 'GET',
-    'Access-Control-Allow-Headers': 'Content-Type',
-    'Access-Control-Max-Age': '3600',
-    'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
-    }
-    def truncate_content(content, max_chars=10000):
-        """
-        This function takes in a string and truncates it to the first 10000 characters.
-        """
-        if len(content) > max_chars:
-            trunc_content = content[:max_chars] + "... Remaining content truncated. Full length: " + str(len(content)) + " characters."
-            return trunc_content
-        return content
-
-    current_results = search_results
-    organic_results = current_results.get('organic', [])
-    if organic_results == []:
-        return {
-            "full_text": "No organic results found.",
-            "individual_results": []
-        }
-
-    end_result = []
-
-    for index, search_result in enumerate(organic_results):
-        current_result = {}
-        try:
-            # print(search_result['link'])
-            current_result['link'] = search_result['link']
-            r = requests.get(search_result['link'], headers, timeout=30)
-            content_type = r.headers.get('content-type')
-            if 'text/html' in content_type:
-                text = requests.get(f"https://r.jina.ai/" + search_result['link'], timeout=30).text
-                # elements = partition_html(url=search_result['link'], headers=headers, html_assemble_articles=True, timeout=30)
-            else:
-                elements = partition(url=search_result['link'], headers=headers, timeout=30)
-                text = "\n".join(element.text for element in elements)
-            current_result['content'] = group_broken_paragraphs(truncate_content(text)) # might not want to truncate here
-        except requests.exceptions.Timeout:
-            current_result['content'] = 'Timed out'
-        except:
-            current_result['content'] = 'Could not access content'
-        current_result['article_letter'] = chr(65 + index)
-        current_result['link'] = search_result.get("link", "")
-        current_result['title'] = search_result.get("title", "")
-        current_result['description'] = search_result.get("description", "")
-        end_result.append(current_result)
-    
-    return {
-        "full_text": "\n".join([
-            f"<doc>\nArticle Letter: {r['article_letter']}\n{r['title']}\n{r['description']}\n{r['content']}\n</doc>"
-            for r in end_result
-        ]),
-        "individual_results": end_result
-    }
-
-@backoff.on_exception(backoff.expo, Exception, max_time=120)
-def get_search_results(search_query: str):
-    opener = urllib.request.build_opener(
-        urllib.request.ProxyHandler(
-            {'http': os.environ['BRIGHTDATA_SERP_KEY'],
-            'https': os.environ['BRIGHTDATA_SERP_KEY']}))
-    search_query = urllib.parse.quote_plus(search_query)
-
-    results = json.loads(opener.open(f'http://www.google.com/search?q={search_query}&brd_json=1').read())
-    return results
+    return asyncio.run(partition_content_async(search_results, strategy="auto", deadline=60))
 
 class ArticleScoreandJustification(BaseModel):
     article_letter: str = Field(..., description="The letter of the article (A, B, C, etc.)")
@@ -133,66 +66,149 @@ class RelevanceScoreandJustification(BaseModel):
 class ContentRelevance(BaseModel):
     score_and_justification: List[RelevanceScoreandJustification]
 
-# @backoff.on_exception(backoff.expo, Exception, max_time=30)
+@lru_cache(maxsize=None)
+def get_client():
+    """Shared instructor client; retries and rate limits are handled by llm_scheduler."""
+    return scheduler.instructor_client()
+
+def format_search_results(organic_results):
+    """Formats organic search results as the <article> list used in the relevance prompts."""
+    formatted_results = []
+    for index, article in enumerate(organic_results):
+        formatted_article = f"Article Letter: {article.get('article_letter', chr(65 + index))}, Title: {article.get('title', 'No article title')}, Display URL: {article.get('display_link', 'No article display link.')}, Description: {article.get('description', 'No article description.')}"
+        formatted_results.append(formatted_article)
+    return "<article>" + "</article>\n<article>".join(formatted_results) + "</article>"
+
+def cached_system_prompt(text):
+    """
+    System prompt as a single block marked for prompt caching. The instructions
+    (and the tool schema, which comes before the system prompt) are identical for
+    every plant, so all calls after the first read them from the cache; the
+    per-plant query, project and content go in the user message after it.
+    Only worth it where the tool schema and instructions together clear the
+    model's minimum cacheable prompt (1024 tokens for Opus and Sonnet, 2048 for
+    Haiku) and the model supports caching at all: the summary stage. The two
+    relevance stages send a plain system prompt.
+    """
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+RESEARCH_QUESTION = ("What is the narrative surrounding the development of this renewable energy project in this location, "
+                     "and what evidence of opposition or support for the project can be identified?")
+
+RELEVANCE_SCORES_INSTRUCTIONS = (
+    f"You are an expert on public perceptions on large renewable energy projects. "
+    f"Your aim is to take a set of search results from Google corresponding "
+    f"to a search query for a specific project and determine whether or not the search results are "
+    f"relevant to our research question. Based on the title, display link, and description of each URL, we would "
+    f"like to identify which search results are most relevant to this research question: '{RESEARCH_QUESTION}' "
+    f"Score each search result based on the article letter with a number between 1-5, "
+    f"with 1 meaning that the article is least relevant and 5 being the most relevant to the research question. "
+    f"Here are examples of what might receive the following scores:"
+    f"\n1 - an article that does not mention renewable energy or the project in question, but may have info about a different project or ordinance"
+    f"\n2 - an article that might be related to renewable energy near the location in question but does not mention the specific project"
+    f"\n3 - an article that mentions the specific project and location in question, but only provides basic information about the project and no information on opposition or support"
+    f"\n4 - an article that you are EXTREMELY CONFIDENT mentons the exact project and location in question"
+    f"\n5 - an article that you are EXTREMELY CONFIDENT describes the narrative of the specific project development, including mentions of opposition and support."
+    f"\nThe search query, the project in question and the search results are given by the user."
+)
+
+def relevance_scores_request(search_query, search_results, plant_info):
+    """Model, schema and messages for get_relevance_scores, shared with the batch mode in batch.py."""
+    return dict(
+        model=haiku,
+        response_model=ArticleRelevanceScores,
+        max_tokens=4096,
+        temperature=0,
+        messages=[
+            {"role": "system", "content": RELEVANCE_SCORES_INSTRUCTIONS},
+            {"role": "user", "content": f"Search query: {search_query}\nProject in question: {plant_info}\n"
+             f"Here are the search results: {search_results}"},
+        ],
+    )
+
 def get_relevance_scores(search_query, search_results, plant_info):
-    try:
-        client = instructor.from_anthropic(Anthropic())
-        relevance_scores = client.messages.create(
-            model="claude-3-haiku-20240307",
-            response_model=ArticleRelevanceScores,
-            max_tokens=4096,
-            temperature=0,
-            messages=[
-                {"role": "system", "content": f"You are an expert on public perceptions on large renewable energy projects. "
-                f"Your aim is to take a set of search results from Google corresponding "
-                f"to the following search query: {search_query} and determine whether or not the search results are "
-                f"relevant to our research question. Here are the search results: {search_results}"},
-                {"role": "user", "content": f"Based on the title, display link, and description of each URL, we would "
-                f"like to identify which search results are most relevant to this research question: 'What is the narrative "
-                f"surrounding the development of this renewable energy project in this location, and what evidence of opposition "
-                f"or support for the project can be identified?' Score each search result based on the article letter with a number between 1-5, "
-                f"with 1 meaning that the article is least relevant and 5 being the most relevant to the research question. "
-                f"Here are examples of what might receive the following scores:"
-                f"\n1 - an article that does not mention renewable energy or the project in question ({plant_info}), but may have info about a different project or ordinance"
-                f"\n2 - an article that might be related to renewable energy near the location in question but does not mention the specific project ({plant_info})"
-                f"\n3 - an article that mentions the specific project and location in question ({plant_info}), but only provides basic information about the project and no information on opposition or support"
-                f"\n4 - an article that you are EXTREMELY CONFIDENT mentons the exact project and location in question ({plant_info})"
-                f"\n5 - an article that you are EXTREMELY CONFIDENT describes the narrative of the specific project development ({plant_info}), including mentions of opposition and support."
-                },
-            ],
-        )
-        assert isinstance(relevance_scores, ArticleRelevanceScores)
-        return relevance_scores
-    except Exception as e:
-        print("Error occurred: ", str(e))
-        breakpoint()
-
-@backoff.on_exception(backoff.expo, Exception, max_time=30)
-def get_content_relevance(search_query, search_results, plant_info):
-    client = instructor.from_anthropic((Anthropic))
-    relevance_scores = client.messages.create(
-        model="claude-3-sonnet-20240229",
+    relevance_scores = scheduler.create(get_client(), **relevance_scores_request(search_query, search_results, plant_info))
+    assert isinstance(relevance_scores, ArticleRelevanceScores)
+    return relevance_scores
+
+def get_relevance_scores_deduped(search_query, organic_results, plant_info, grade_cache=None, preclassifier=None):
+    """
+    get_relevance_scores for the organic results of one plant, sending each
+    distinct result to the model once: a repeat of an earlier result (same
+    canonical URL or near-identical snippet, see dedup.py) takes that result's
+    grade, and results graded before for the same plant_info come from
+    grade_cache (a dedup.GradeCache). With a preclassifier (see
+    preclassifier.py), results it is confident are a 1 or a 5 are graded
+    locally and only the rest go to the model. Returns the model_dump() layout
+    with a grade for every letter, or [] if there are no results.
+    """
+    if organic_results == []:
+        return []
+    letters = [result.get('article_letter', chr(65 + index)) for index, result in enumerate(organic_results)]
+    originals = search_duplicates(organic_results)
+    grades, to_grade = {}, {}
+    for index, result in enumerate(organic_results):
+        if originals[index] is not None:
+            metrics.inc('duplicate_search_results_total', source='duplicate')
+            continue
+        cached = grade_cache.get(plant_info, result) if grade_cache is not None else None
+        if cached is not None:
+            metrics.inc('duplicate_search_results_total', source='grade_cache')
+            grades[letters[index]] = cached
+        else:
+            to_grade[letters[index]] = {**result, 'article_letter': letters[index]}
+    if to_grade and preclassifier is not None:
+        for letter, decision in zip(list(to_grade), preclassifier.decide(search_query, list(to_grade.values()), plant_info)):
+            metrics.inc('preclassifier_decisions_total', outcome='llm' if decision is None else f"grade_{decision['grade']}")
+            if decision is not None:
+                grades[letter] = decision
+                del to_grade[letter]
+    if to_grade:
+        scores = get_relevance_scores(search_query, format_search_results(list(to_grade.values())), plant_info)
+        for item in scores.scores_and_justifications:
+            grades[item.article_letter] = {'grade': item.grade, 'justification': item.justification}
+            if grade_cache is not None and item.article_letter in to_grade:
+                grade_cache.put(plant_info, to_grade[item.article_letter], item.grade, item.justification)
+    scores_and_justifications = []
+    for index, letter in enumerate(letters):
+        source = letter if originals[index] is None else letters[originals[index]]
+        if source in grades:
+            scores_and_justifications.append({'article_letter': letter, **grades[source]})
+    return {'scores_and_justifications': scores_and_justifications}
+
+CONTENT_RELEVANCE_INSTRUCTIONS = (
+    f"You are an expert on public perceptions on large renewable energy projects. "
+    f"Your aim is to take a set of search results from Google corresponding "
+    f"to a search query for a specific project and determine whether or not the search results are "
+    f"relevant to our research question. Based on the description of each URL and other metadata, we would "
+    f"like to identify which search results are most relevant to this research question: '{RESEARCH_QUESTION}' "
+    f"Score all of the search results as a whole with a number between 1-5, "
+    f"with 1 meaning that the content is least relevant and 5 being the most relevant to the research question. "
+    f"Here are examples of what might receive the following scores:"
+    f"\n1 - NONE of the articles mention the specific project or renewable energy near the location, but they might refer to a different project or ordinance"
+    f"\n2 - SOME of the articles might be related to renewable energy near the location in question but does not mention the specific project"
+    f"\n3 - AT LEAST ONE article mentions the specific project"
+    f"\n4 - MOST of the articles mention the specific project"
+    f"\n5 - MOST of the articles mention the specific project, AND there are also mentions of opposition or support"
+    f"\nThe search query, the specific project and the search results are given by the user."
+)
+
+def content_relevance_request(search_query, search_results, plant_info):
+    """Model, schema and messages for get_content_relevance, shared with the batch mode in batch.py."""
+    return dict(
+        model=sonnet,
         response_model=ContentRelevance,
         max_tokens=4096,
         temperature=0.1,
         messages=[
-            {"role": "system", "content": f"You are an expert on public perceptions on large renewable energy projects. "
-             f"Your aim is to take a set of search results from Google corresponding "
-             f"to the following search query: {search_query} and determine whether or not the search results are "
-             f"relevant to our research question. Here are the search results: {search_results}"},
-            {"role": "user", "content": f"Based on the description of each URL and other metadata, we would "
-             f"like to identify which search results are most relevant to this research question: 'What is the narrative "
-             f"surrounding the development of this renewable energy project in this location, and what evidence of opposition "
-             f"or support for the project can be identified?' Score all of the search results as a whole with a number between 1-5, "
-             f"with 1 meaning that the content is least relevant and 5 being the most relevant to the research question. "
-             f"Here are examples of what might receive the following scores:"
-             f"\n1 - NONE of the articles mention the specific project {plant_info} or renewable energy near the location, but they might refer to a different project or ordinance"
-             f"\n2 - SOME of the articles might be related to renewable energy near the location in question but does not mention the specific project {plant_info}"
-             f"\n3 - AT LEAST ONE article mentions the specific project: {plant_info} "
-             f"\n4 - MOST of the articles mention the specific project: {plant_info}"
-             f"\n5 - MOST of the articles mention the specific project {plant_info}, AND there are also mentions of opposition or support"},
+            {"role": "system", "content": CONTENT_RELEVANCE_INSTRUCTIONS},
+            {"role": "user", "content": f"Search query: {search_query}\nSpecific project: {plant_info}\n"
+             f"Here are the search results: {search_results}"},
         ],
     )
+
+def get_content_relevance(search_query, search_results, plant_info):
+    relevance_scores = scheduler.create(get_client(), **content_relevance_request(search_query, search_results, plant_info))
     assert isinstance(relevance_scores, ContentRelevance)
     return relevance_scores
 
@@ -254,55 +270,92 @@ class ProjectPerceptionVariables(BaseModel):
 class ProjectSummary(BaseModel):
     all_scores_and_sources: List[ProjectPerceptionVariables]
 
-#@backoff.on_exception(backoff.expo, Exception, max_time=120)
+PROJECT_SUMMARY_INSTRUCTIONS = (
+    'You are an expert on public perceptions on large renewable energy projects. Our aim is to understand the public opinion '
+    'and perceptions of a particular renewable energy project based solely on online media evidence from a search engine query on the project. '
+    'The user gives the name and location of the project in question, followed by the search result content generated from it. '
+    'Based on the full text content of all relevant search results, we would like to answer several binary questions about whether or not '
+    'there is evidence of opposition or support for the project. Use only the text content provided to answer these questions with a “1” '
+    'if evidence is found and “0” if not, and finally to create a one-paragraph summary of public perceptions of the project. Note that none '
+    'of the info in the content may be relevant to the project in question, and if so, all integers should be 0 and narrative should be '
+    '"No relevant info found." Remember: ONLY SCORE 1 if you are EXTREMELY CONFIDENT that there is evidence to support the score for the '
+    'specific project and location.'
+)
+
+def project_summary_request(plant_info, content):
+    """Model, schema and messages for get_project_summary, shared with the batch mode in batch.py."""
+    return dict(
+        model=opus,
+        response_model=ProjectSummary,
+        max_tokens=4096,
+        temperature=0.1,
+        messages=[
+            {"role": "system", "content": cached_system_prompt(PROJECT_SUMMARY_INSTRUCTIONS)},
+            {"role": "user", "content": f'Project in question: {plant_info}\nSearch result content: {content}'},
+        ],
+    )
+
 def get_project_summary(plant_info, content):
-    try:
-        client = instructor.from_anthropic(Anthropic())
-        project_perceptions = client.messages.create(
-            model=opus,
-            response_model=ProjectSummary,
-            max_tokens=4096,
-            temperature=0.1,
-            messages=[
-                {"role": "system", "content": f'You are an expert on public perceptions on large renewable energy projects. Here is the name and location of the project in question ({plant_info}) from which the following search result content is generated: {content}.'},
-                {"role": "user", "content": f'Our aim is to understand the public opinion and perceptions of a particular renewable energy project ({plant_info}) based solely on online media evidence from a search engine query on the project. Based on the full text content of all relevant search results, we would like to answer several binary questions about whether or not there is evidence of opposition or support for the project. Use only the text content provided to answer these questions with a “1” if evidence is found and “0” if not, and finally to create a one-paragraph summary of public perceptions of the project. Note that none of the info in the content may be relevant to the project in question, and if so, all integers should be 0 and narrative should be "No relevant info found." Remember: ONLY SCORE 1 if you are EXTREMELY CONFIDENT that there is evidence to support the score for the specific project and location ({plant_info}).'},
-            ],
-        )
-        #if not isinstance(project_perceptions, ProjectSummary):
-            # print("Project perceptions is not an instance of ProjectSummary.")
-        return project_perceptions
-    except Exception as e:
-        print("Error occurred: ", str(e))
-        breakpoint()
-    # except ValidationError as e:
-    #     print("Validation error occurred: ", str(e))
-    #     breakpoint()
-    # except Exception as e:
-    #     print("Other error occurred: ", str(e))
-    #     breakpoint()
-
-
-@stub.local_entrypoint()
+    project_perceptions = scheduler.create(get_client(), **project_summary_request(plant_info, content))
+    return project_perceptions
+
+
+def build_relevant_content(relevance_data, content_data, min_grade=3, plant_info=None, token_budget=None,
+                           text_index=None, plant_code=None):
+    """
+    Keeps the articles of a plant graded >= min_grade in article_relevance and adds
+    them to the content json as "relevant_content_text". With a token_budget, the
+    text is packed down to the paragraphs that best match plant_info and the
+    opposition keywords (see context_packer.py), ranked by the full-text index
+    when one with this plant's content is given (see text_index.py). Returns None
+    if the plant has no relevant articles.
+    """
+    if relevance_data == []:
+        return None
+    # also covers content scraped before fetch.py marked duplicates
+    mark_duplicates(content_data['individual_results'])
+    relevant_content = []
+    for item in relevance_data.get('scores_and_justifications', []):
+        if item['grade'] >= min_grade:
+            article = next((article for article in content_data['individual_results'] if article['article_letter'] == item['article_letter']), None)
+            if article:
+                article['grade'] = item['grade']
+                article['justification'] = item['justification']
+                relevant_content.append(article)
+    # a near-duplicate adds nothing if the article it repeats is already in
+    relevant_letters = {article['article_letter'] for article in relevant_content}
+    kept = [article for article in relevant_content if article.get('duplicate_of') not in relevant_letters]
+    metrics.inc('duplicate_articles_total', len(relevant_content) - len(kept), where='relevant_content')
+    relevant_content = kept
+    if relevant_content == []:
+        return None
+    if token_budget and text_index is not None:
+        content_data['relevant_content_text'] = text_index.pack(plant_code, relevant_content, plant_info or '',
+                                                                token_budget)
+        return content_data
+    if token_budget:
+        content_data['relevant_content_text'] = pack_articles(relevant_content, plant_info or '', token_budget)
+        return content_data
+    content_data['relevant_content_text'] = format_docs(relevant_content)
+    return content_data
+
+
+@backend.local_entrypoint()
 def main():
     print("This code is running locally!")
-    plant_codes = pd.read_csv('ready_to_search.csv')['plant_code']
-
+    manifest = Manifest()
     plant_codes = [
-        pc for pc in plant_codes
-        if not os.path.exists(f'results/content/{pc}.json')
+        str(pc) for pc in pd.read_csv('ready_to_search.csv')['plant_code']
+        if manifest.status(str(pc), 'content') is None
     ]
 
-    search_results = []
-    for plant_code in plant_codes[:1]:
-        with open(f'results/search/{plant_code}.json', 'r') as f:
-            search_result = json.load(f)
-            search_results.append(search_result)
-    
+    search_results = [read_result('search', plant_code) for plant_code in plant_codes[:1]]
+
     partitioned_results = partition_content.map(search_results)
 
     for plant_code, partitioned_result in tqdm(zip(plant_codes, partitioned_results), desc="Processing plant codes"):
-        with open(f'results/content/{plant_code}.json', 'w') as f:
-            json.dump(partitioned_result, f)
+        manifest.write('content', plant_code, partitioned_result)
+    manifest.close()
 
 #     df = pd.read_csv('ready_to_search.csv')
 #     # run the function remotely on modal
@@ -312,138 +365,6 @@ def main():
 
 
 if __name__ == "__main__":
-    load_dotenv()
-    ### CODE BELOW IS FOR RUNNING THE get_search_results FUNCTION IN PARALLEL ###
-    # df = pd.read_csv('ready_to_search.csv')
-    # queries = list(df['search_query'])
-    # plant_codes = list(df['plant_code'])
-    
-    # code for running the search engine results function in parallel
-    # with ThreadPoolExecutor(max_workers=100) as executor:
-    #     future_to_plant_code = {executor.submit(get_search_results, query): plant_code
-    #                        for plant_code, query in zip(plant_codes, queries)
-    #                        if not os.path.exists(f'results/search/{plant_code}.json')}
-    #     for future in tqdm(as_completed(future_to_plant_code), total=len(future_to_plant_code)):
-    #         plant_code = future_to_plant_code[future]
-    #         result = future.result()
-    #         with open(f'results/search/{plant_code}.json', 'w') as f:
-    #             json.dump(result, f)
-
-    ### CODE BELOW IS FOR RUNNING THE get_relevance_scores FUNCTION IN PARALLEL ###
-    # df = pd.read_csv('post_content_plants.csv')
-    # plant_codes = list(df['plant_code'])
-    # plant_codes = [
-    #     pc for pc in plant_codes
-    #     if not os.path.exists(f'results/article_relevance/{pc}.json')
-    # ]
-    # search_queries = [query for code, query in zip(df['plant_code'], df['search_query']) if code in plant_codes]
-    # plant_infos = [info for code, info in zip(df['plant_code'], df['plant_info']) if code in plant_codes]
-
-    # def process_plant_code(plant_code, search_query, plant_info):
-    #     search_file_path = f'results/search/{plant_code}.json'
-    #     with open(search_file_path, 'r') as f:
-    #         search_data = json.load(f)
-    #         organic_results = search_data.get('organic', [])
-    #         if organic_results == []:
-    #             return []
-    #         formatted_results = []
-    #         for index, article in enumerate(organic_results):
-    #             formatted_article = f"Article Letter: {article.get('article_letter', 'No article letter')}, Title: {article.get('title', 'No article title')}, Display URL: {article.get('display_link', 'No article display link.')}, Description: {article.get('description', 'No article description.')}"
-    #             formatted_results.append(formatted_article)
-    #         search_result_string = "<article>" + "</article>\n<article>".join(formatted_results) + "</article>"
-    #         return get_relevance_scores(search_query, search_result_string, plant_info)
-
-    # with ThreadPoolExecutor(max_workers=1) as executor:
-    #     future_to_plant_code = {
-    #         executor.submit(process_plant_code, plant_code, search_query, plant_info): plant_code
-    #         for plant_code, search_query, plant_info in zip(plant_codes, search_queries, plant_infos)
-    #         if not os.path.exists(f'results/article_relevance/{plant_code}.json')
-    #     }
-    #     for future in tqdm(as_completed(future_to_plant_code), total=len(future_to_plant_code)):
-    #         plant_code = future_to_plant_code[future]
-    #         relevance_score = future.result()
-    #         if relevance_score == []:
-    #             print("Plant code: ", plant_code, " has no organic results.")
-    #             with open(f'results/article_relevance/{plant_code}.json', 'w') as f:
-    #                 json.dump(relevance_score, f)
-    #         else:
-    #             # print("Plant code: ", plant_code, " has organic results.")
-    #             with open(f'results/article_relevance/{plant_code}.json', 'w') as f:
-    #                 json.dump(relevance_score.model_dump(), f)
-    
-
-    ### CODE BELOW IS FOR RUNNING THE get_content_relevance FUNCTION IN PARALLEL ###
-    # df = pd.read_csv('post_content_plants.csv')
-    # plant_codes = list(df['plant_code'])
-
-    # plant_codes = [
-    #     pc for pc in plant_codes
-    #     if not os.path.exists(f'results/content_relevance/{pc}.json')
-    # ]
-    # # find the search queries and plant infos for each plant code based on the new list plant_codes
-    # search_queries = [query for code, query in zip(df['plant_code'], df['search_query']) if code in plant_codes]
-    # plant_infos = [info for code, info in zip(df['plant_code'], df['plant_info']) if code in plant_codes]
-
-    # def process_content_relevance(plant_code, search_query, plant_info):
-    #     search_file_path = f'results/search/{plant_code}.json'
-    #     # print plant code, search query, and plant info to make sure everything matches up
-    #     print(plant_code, search_query, plant_info)
-    #     with open(search_file_path, 'r') as f:
-    #         search_data = json.load(f)
-    #         # print(search_data)
-    #         organic_results = search_data.get('organic', [])
-    #         if organic_results == []:
-    #             print("No organic results found.")
-    #             return []
-    #         formatted_results = []
-    #         for index, article in enumerate(organic_results):
-    #             formatted_article = f"Article Letter: {article['article_letter']}, Title: {article['title']}, Display URL: {article['display_link']}, Description: {article['description']}"
-    #             formatted_results.append(formatted_article)
-    #         search_result_string = "<article>" + "</article>\n<article>".join(formatted_results) + "</article>"
-    #         return get_content_relevance(search_query, search_result_string, plant_info)
-
-    # with ThreadPoolExecutor(max_workers=5) as executor:
-    #     future_to_plant_code = {
-    #         executor.submit(process_content_relevance, plant_code, search_query, plant_info): plant_code
-    #         for plant_code, search_query, plant_info in zip(plant_codes[:1], search_queries[:1], plant_infos[:1])
-    #         if not os.path.exists(f'results/content_relevance/{plant_code}.json')
-    #     }
-    #     for future in tqdm(as_completed(future_to_plant_code), total=len(future_to_plant_code)):
-    #         plant_code = future_to_plant_code[future]
-    #         content_relevance = future.result()
-    #         with open(f'results/content_relevance/{plant_code}.json', 'w') as f:
-    #             json.dump(content_relevance.model_dump(), f)
-    
-    
-    
-    ### CODE BELOW IS FOR RUNNING THE get_project_summary FUNCTION IN PARALLEL ###
-    df = pd.read_csv('post_relevance_plants.csv')
-    queries = list(df['search_query'])
-    plant_codes = list(df['plant_code'])
-
-    plant_codes = [
-        pc for pc in plant_codes
-        if not os.path.exists(f'results/scores/{pc}.json')
-    ]
-
-    plant_infos = [info for code, info in zip(df['plant_code'], df['plant_info']) if code in plant_codes]
-    all_content = []
-    for plant_code in plant_codes:
-        with open(f'results/relevant_content/{plant_code}.json', 'r') as f:
-            content = json.load(f)
-            all_content.append(content['relevant_content_text'])
-    print("Finished appending all content.")
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        future_to_plant_code = {
-            executor.submit(get_project_summary, plant_info, content): plant_code
-            for plant_code, plant_info, content in zip(plant_codes, plant_infos, all_content)
-            if not os.path.exists(f'results/scores/{plant_code}.json')
-        }
-        for future in tqdm(as_completed(future_to_plant_code), total=len(future_to_plant_code)):
-            plant_code = future_to_plant_code[future]
-            summary = future.result()
-            with open(f'results/scores/{plant_code}.json', 'w') as f:
-                json.dump(summary.model_dump(), f)
-    
-
-    
+    # Stages are run with the pipeline runner, e.g. `python pipeline.py run --stages scores`
+    from pipeline import main as run_pipeline
+    run_pipeline()
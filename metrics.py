@@ -0,0 +1,271 @@
+import argparse
+import bisect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_LOG_PATH = os.environ.get('METRICS_LOG', 'cache/metrics.jsonl')
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 5e7)
+TOKENS_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+# the error taxonomy: every failure recorded here falls in exactly one of these
+ERROR_KINDS = ('dns', 'tls', 'connect', 'timeout', '4xx', '5xx', 'rate_limit', 'paywall', 'too_large', 'parse',
+               'validation', 'other')
+
+# phrases of subscription walls that come back as a 200 with a teaser instead of the article
+PAYWALL_MARKERS = (
+    'subscribe to continue', 'subscribe to read', 'subscribers only', 'subscriber-only', 'subscriber exclusive',
+    'to continue reading', 'already a subscriber', 'create a free account to continue', 'sign in to read',
+)
+
+
+def looks_paywalled(text, max_chars=3000):
+    """Short pages that mostly ask the reader to subscribe. Long pages that mention it in a footer are fine."""
+    head = text[:max_chars].lower()
+    return len(text) < max_chars and any(marker in head for marker in PAYWALL_MARKERS)
+
+
+def exception_chain(e):
+    """The exception, its causes/contexts and anything wrapped in its args (instructor/tenacity wrappers)."""
+    stack, seen = [e], set()
+    while stack:
+        e = stack.pop()
+        if e is None or id(e) in seen:
+            continue
+        seen.add(id(e))
+        yield e
+        stack.extend([e.__cause__, e.__context__])
+        stack.extend(arg for arg in getattr(e, 'args', ()) if isinstance(arg, BaseException))
+        last_attempt = getattr(e, 'last_attempt', None)
+        if last_attempt is not None:
+            stack.append(last_attempt.exception())
+
+
+def classify_status(status):
+    if status == 429:
+        return 'rate_limit'
+    if status == 402:
+        return 'paywall'
+    if 400 <= status < 500:
+        return '4xx'
+    if status >= 500:
+        return '5xx'
+    return 'other'
+
+
+def classify_error(e):
+    """
+    Maps an exception from aiohttp, httpx/anthropic, instructor, pydantic or
+    unstructured to one of ERROR_KINDS. Matching is by class name so this
+    module doesn't need any of those libraries installed.
+    """
+    for error in exception_chain(e):
+        names = {cls.__name__ for cls in type(error).__mro__}
+        if names & {'ClientConnectorDNSError', 'gaierror'}:
+            return 'dns'
+        if names & {'ClientConnectorCertificateError', 'ClientSSLError', 'SSLError', 'SSLCertVerificationError'}:
+            return 'tls'
+        if names & {'TimeoutError', 'APITimeoutError', 'ServerTimeoutError', 'TimeoutException'}:
+            return 'timeout'
+        if 'RateLimitError' in names:
+            return 'rate_limit'
+        status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+        if isinstance(status, int) and status >= 400:
+            return classify_status(status)
+        if names & {'ValidationError', 'InstructorRetryException'}:
+            return 'validation'
+    for error in exception_chain(e):
+        names = {cls.__name__ for cls in type(error).__mro__}
+        if names & {'ClientConnectorError', 'ClientOSError', 'ServerDisconnectedError', 'APIConnectionError',
+                    'ConnectError', 'ConnectionError'}:
+            return 'connect'
+        if names & {'PartitionError', 'JSONDecodeError', 'ClientPayloadError', 'PDFSyntaxError',
+                    'UnicodeDecodeError'}:
+            return 'parse'
+        if 'larger than' in str(error):
+            return 'too_large'
+    return 'other'
+
+
+def buckets_for(name):
+    if name.endswith('_seconds'):
+        return SECONDS_BUCKETS
+    if name.endswith('_bytes'):
+        return BYTES_BUCKETS
+    if name.endswith('_tokens'):
+        return TOKENS_BUCKETS
+    return SECONDS_BUCKETS
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"'.replace('\n', ' ') for k, v in pairs) + '}'
+
+
+class Metrics:
+    """
+    Process-wide counters and histograms, keyed by metric name and labels.
+    Every observation is also appended to `path` as a json line (set it to None
+    to keep metrics in memory only), and `serve(port)` exposes the current
+    values in the Prometheus text format on /metrics.
+
+    Names follow Prometheus conventions: `*_total` counters, and histograms in
+    `*_seconds`, `*_bytes` or `*_tokens` with matching buckets.
+    """
+
+    def __init__(self, path=METRICS_LOG_PATH):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.server = None
+
+    def write(self, metric, value, labels):
+        if self.path is None:
+            return
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.file = open(self.path, 'a', buffering=1)
+        self.file.write(json.dumps({'time': round(time.time(), 3), 'metric': metric, 'value': value, **labels}) + '\n')
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+            self.write(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = (name, label_key(labels))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets_for(name))
+            self.histograms[key].observe(value)
+            self.write(name, value, labels)
+
+    def error(self, where, e, **labels):
+        """Counts a failure under its classified kind and returns the kind."""
+        kind = e if isinstance(e, str) else classify_error(e)
+        self.inc('errors_total', where=where, kind=kind, **labels)
+        return kind
+
+    def render(self):
+        """The current values in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            typed = set()
+            for (name, key), value in counters:
+                if name not in typed:
+                    lines.append(f'# TYPE {name} counter')
+                    typed.add(name)
+                lines.append(f'{name}{format_labels(key)} {value:g}')
+            for (name, key), histogram in histograms:
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else f'{bound:g}'
+                    lines.append(f'{name}_bucket{format_labels(key, [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(key)} {histogram.sum:g}')
+                lines.append(f'{name}_count{format_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves render() on http://host:port/metrics from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+
+metrics = Metrics()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize_metrics(path=METRICS_LOG_PATH, group_by=None):
+    """
+    Totals from the metrics log: count, sum, p50 and p99 per metric and label
+    set (or only the labels in `group_by`), largest total first, so the stages,
+    hosts and MIME types that take the most time come out on top.
+    """
+    groups = defaultdict(list)
+    with open(path, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            metric, value = entry.pop('metric'), entry.pop('value')
+            entry.pop('time', None)
+            if group_by is not None:
+                entry = {k: v for k, v in entry.items() if k in group_by}
+            groups[(metric, label_key(entry))].append(value)
+    rows = sorted(groups.items(), key=lambda item: (item[0][0], -sum(item[1])))
+    for (metric, key), values in rows:
+        labels = format_labels(key)
+        if metric.endswith('_total'):
+            print(f"{metric}{labels}: {sum(values):g}")
+        else:
+            print(f"{metric}{labels}: n={len(values)} sum={sum(values):.1f} "
+                  f"p50={percentile(values, 0.5):.3g} p99={percentile(values, 0.99):.3g}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the pipeline metrics log")
+    parser.add_argument('--path', default=METRICS_LOG_PATH)
+    parser.add_argument('--group-by', nargs='*', default=None, help="only keep these labels, e.g. stage kind")
+    args = parser.parse_args()
+    summarize_metrics(args.path, args.group_by)
@@ -0,0 +1,152 @@
+import asyncio
+import mimetypes
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from extract import extract_html
+from metrics import metrics
+
+SPOOL_DIR = os.environ.get('SPOOL_DIR', 'cache/spool')
+
+_executors = {}
+
+
+class PartitionError(Exception):
+    """unstructured could not parse a spooled document."""
+
+
+def partition_file(path, content_type, strategy):
+    """Runs in a worker process: partition a spooled download with unstructured."""
+    from unstructured.partition.auto import partition
+
+    elements = partition(filename=path, content_type=content_type, strategy=strategy)
+    return "\n".join(element.text for element in elements)
+
+
+def get_executor(max_workers=None):
+    """
+    Process pools are shared per worker count, so Modal containers and repeated
+    asyncio.run calls don't pay the worker start-up (and unstructured import) again.
+    """
+    max_workers = max_workers or os.cpu_count()
+    if max_workers not in _executors:
+        _executors[max_workers] = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executors[max_workers]
+
+
+def recycle_executor(executor):
+    """
+    Kills the workers of a pool and drops it, so the next get_executor starts
+    a fresh one. Documents still parsing in it fail with BrokenProcessPool.
+    """
+    for max_workers, shared in list(_executors.items()):
+        if shared is executor:
+            del _executors[max_workers]
+    for process in list((executor._processes or {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PartitionPool:
+    """
+    Second stage of the content pipeline. Non-HTML downloads are streamed into
+    `spool_dir` and partitioned in a bounded process pool, so CPU-heavy PDF and
+    Office parsing (and OCR) never blocks the event loop that does the fetching.
+    HTML pages are extracted in the same pool (see extract.py).
+
+    At most `max_pending` documents can be downloading, spooled or parsing at
+    once; further downloads wait for a slot, which keeps the spool from
+    growing faster than the workers can drain it.
+
+    `strategies` maps MIME types to an unstructured partition strategy
+    ('fast', 'hi_res', 'ocr_only', 'auto'); anything else uses `default_strategy`.
+    """
+
+    def __init__(self, max_workers=None, max_pending=None, spool_dir=SPOOL_DIR,
+                 strategies=None, default_strategy='auto', timeout=120):
+        self.max_workers = max_workers or os.cpu_count()
+        self.slots = asyncio.Semaphore(max_pending or 2 * self.max_workers)
+        self.spool_dir = spool_dir
+        self.strategies = strategies or {}
+        self.default_strategy = default_strategy
+        self.timeout = timeout
+        os.makedirs(spool_dir, exist_ok=True)
+
+    async def acquire(self):
+        await self.slots.acquire()
+
+    def release(self):
+        self.slots.release()
+
+    @property
+    def executor(self):
+        # looked up on every use: a timeout replaces the shared pool
+        return get_executor(self.max_workers)
+
+    def strategy_for(self, content_type):
+        return self.strategies.get(content_type, self.default_strategy)
+
+    async def spool(self, response, content_type, max_bytes):
+        """Stream a response body to a file in the spool directory and return its path."""
+        suffix = mimetypes.guess_extension(content_type or '') or ''
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.spool_dir)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError(f"Response larger than {max_bytes} bytes")
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    async def partition(self, path, content_type):
+        """Partition a spooled file in the process pool, removing it afterwards."""
+        strategy = self.strategy_for(content_type)
+        try:
+            return await self.run(content_type, strategy, partition_file, path, content_type, strategy)
+        finally:
+            os.remove(path)
+
+    async def extract(self, html):
+        """Main text of an HTML page, extracted in the process pool."""
+        return await self.run('text/html', 'html', extract_html, html)
+
+    async def run(self, content_type, strategy, fn, *args):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        outcome = 'ok'
+        try:
+            for attempt in range(2):
+                executor = self.executor
+                try:
+                    return await asyncio.wait_for(loop.run_in_executor(executor, fn, *args), timeout=self.timeout)
+                except TimeoutError:
+                    # wait_for only stops waiting; the hung parse would keep its worker busy for good
+                    recycle_executor(executor)
+                    raise
+                except BrokenProcessPool:
+                    # recycled under this document because another one hung, or a worker died (e.g. out of
+                    # memory); either way the pool is unusable, so it is replaced and the document tried once more
+                    recycle_executor(executor)
+                    if attempt:
+                        raise
+        except Exception as e:
+            # anything but a timeout is unstructured failing on the document
+            outcome = 'timeout' if isinstance(e, TimeoutError) else 'parse'
+            metrics.error('partition', outcome, mime_type=content_type or 'unknown')
+            if outcome == 'timeout':
+                raise
+            raise PartitionError(f"{content_type}: {e!r}") from e
+        finally:
+            metrics.observe('partition_seconds', time.monotonic() - start, mime_type=content_type or 'unknown',
+                            strategy=strategy, outcome=outcome)
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List
+
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from context_packer import DEFAULT_TOKEN_BUDGET
+from corpus import Corpus
+from dedup import GradeCache
+from deps import Dependencies, fingerprint, stage_settings
+from fetch import FetchEngine
+from metrics import metrics
+from preclassifier import PRECLASSIFIER_PATH, Preclassifier
+from results_io import Manifest, iter_plants, read_result, result_path
+from results_store import ResultsStore, load_plant_partitions
+from local_parallel import (build_relevant_content, format_search_results, get_content_relevance,
+                            get_project_summary, get_relevance_scores_deduped)
+from serp import SerpClient
+from text_index import TEXT_INDEX_PATH, TextIndex, json_version
+
+def read_content(plant_code, corpus=None):
+    """The content json of a plant: results/content if it's there, otherwise the corpus (see corpus.py)."""
+    if corpus is not None and plant_code in corpus and not os.path.exists(result_path('content', plant_code)):
+        return corpus.content(plant_code)
+    return read_result('content', plant_code)
+
+
+async def run_search(plant, ctx):
+    return await ctx['serp'].search(plant['search_query'])
+
+
+async def run_content(plant, ctx):
+    return await ctx['engine'].partition_content(read_result('search', plant['plant_code']))
+
+
+def search_result_string(plant):
+    """The formatted organic results of a plant, or None if the search found nothing."""
+    organic_results = read_result('search', plant['plant_code']).get('organic', [])
+    if organic_results == []:
+        return None
+    return format_search_results(organic_results)
+
+
+def run_article_relevance(plant, ctx):
+    organic_results = read_result('search', plant['plant_code']).get('organic', [])
+    return get_relevance_scores_deduped(plant['search_query'], organic_results, plant['plant_info'], ctx['grades'],
+                                        ctx['preclassifier'])
+
+
+def run_content_relevance(plant, ctx):
+    search_results = search_result_string(plant)
+    if search_results is None:
+        return []
+    return get_content_relevance(plant['search_query'], search_results, plant['plant_info']).model_dump()
+
+
+def run_relevant_content(plant, ctx):
+    plant_code = plant['plant_code']
+    text_index = ctx['text_index']
+    # only if the index has this version of the plant's content; otherwise the packer scores the paragraphs itself
+    if text_index is not None and text_index.version(plant_code) != json_version(result_path('content', plant_code)):
+        text_index = None
+    return build_relevant_content(read_result('article_relevance', plant_code),
+                                  read_content(plant_code, ctx['corpus']), plant_info=plant['plant_info'],
+                                  token_budget=ctx['token_budget'], text_index=text_index, plant_code=plant_code)
+
+
+def run_scores(plant, ctx):
+    content = read_result('relevant_content', plant['plant_code'])
+    return get_project_summary(plant['plant_info'], content['relevant_content_text']).model_dump()
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable
+    deps: List[str] = field(default_factory=list)
+    concurrency: int = 1
+
+
+STAGES = [
+    Stage('search', run_search, [], 100),
+    Stage('content', run_content, ['search'], 50),
+    # LLM stages can have many workers: llm_scheduler decides how many calls are actually in flight
+    Stage('article_relevance', run_article_relevance, ['search'], 64),
+    Stage('content_relevance', run_content_relevance, ['search'], 64),
+    Stage('relevant_content', run_relevant_content, ['article_relevance', 'content'], 8),
+    Stage('scores', run_scores, ['relevant_content'], 64),
+]
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+class Pipeline:
+    """
+    Streams plants through the selected stages. Every stage has its own queue and
+    pool of workers, and a plant is queued for a stage as soon as all of that
+    stage's dependencies are done for it, so e.g. scoring starts while other
+    plants are still being scraped. Dependencies outside the selected stages must
+    already be complete in the manifest.
+
+    With `dependencies` (a deps.Dependencies), results are recorded with their
+    inputs, and completed results whose inputs changed are recomputed, once
+    the dependencies being recomputed in this run are done.
+    """
+
+    def __init__(self, stages, manifest, concurrency=None, engine_kwargs=None, token_budget=DEFAULT_TOKEN_BUDGET,
+                 store=None, serp_kwargs=None, grades=None, preclassifier=None, dependencies=None):
+        self.stages = stages
+        self.manifest = manifest
+        self.concurrency = {stage.name: stage.concurrency for stage in stages}
+        self.concurrency.update(concurrency or {})
+        self.engine_kwargs = engine_kwargs or {}
+        self.serp_kwargs = serp_kwargs or {}
+        self.token_budget = token_budget
+        self.store = store
+        # relevance grades shared by plants with the same plant_info (see dedup.GradeCache)
+        self.grades = grades
+        self.preclassifier = preclassifier
+        self.dependencies = dependencies
+        self.queued = set()
+        self.running = set()
+        self.pending = 0
+        self.failures = Counter()
+
+    def advance(self, plant):
+        plant_code = plant['plant_code']
+        for stage in self.stages:
+            key = (plant_code, stage.name)
+            if key in self.queued or not self.outdated(plant, stage):
+                continue
+            if any((plant_code, dep) in self.running for dep in stage.deps):
+                continue
+            if all(self.manifest.status(plant_code, dep) == 'done' for dep in stage.deps):
+                self.queued.add(key)
+                self.running.add(key)
+                self.pending += 1
+                # workers may have drained the queues while later plants were still being read
+                self.idle.clear()
+                self.bars[stage.name].total += 1
+                self.bars[stage.name].refresh()
+                self.queues[stage.name].put_nowait(plant)
+
+    def outdated(self, plant, stage):
+        if self.manifest.status(plant['plant_code'], stage.name) is None:
+            return True
+        return self.dependencies is not None and bool(self.dependencies.changed(stage.name, plant))
+
+    async def call(self, stage, plant):
+        if asyncio.iscoroutinefunction(stage.run):
+            return await stage.run(plant, self.ctx)
+        return await asyncio.to_thread(stage.run, plant, self.ctx)
+
+    def fail(self, name, plant_code, e):
+        """Counts a plant as failed for `name` (a stage, or 'queue') and logs why; it is retried next run."""
+        self.failures[name] += 1
+        kind = metrics.error('stage', e, stage=name)
+        tqdm.write(f"{name} failed for plant code {plant_code} ({kind}): {e}")
+        return kind
+
+    async def worker(self, stage):
+        # nothing may escape the loop: a dead worker would leave its queue
+        # undrained and run() waiting for `idle` forever
+        queue = self.queues[stage.name]
+        while True:
+            plant = await queue.get()
+            plant_code = plant['plant_code']
+            start = time.monotonic()
+            outcome = None
+            try:
+                inputs = None if self.dependencies is None else self.dependencies.inputs(stage.name, plant)
+                result = await self.call(stage, plant)
+                outcome = 'empty' if result is None else 'done'
+                metrics.observe('stage_seconds', time.monotonic() - start, stage=stage.name, outcome=outcome)
+                if result is None:
+                    self.manifest.record(plant_code, stage.name, 'empty', inputs=inputs)
+                else:
+                    self.manifest.write(stage.name, plant_code, result, inputs)
+                    if self.store is not None:
+                        self.store.add(stage.name, plant_code, result)
+                # downstream stages held back for this one can go now
+                self.running.discard((plant_code, stage.name))
+                self.advance(plant)
+            except Exception as e:
+                # the stage itself, recording its result or queueing the stages after it
+                self.running.discard((plant_code, stage.name))
+                kind = self.fail(stage.name, plant_code, e)
+                if outcome is None:
+                    metrics.observe('stage_seconds', time.monotonic() - start, stage=stage.name, outcome=kind)
+            finally:
+                self.pending -= 1
+                self.bars[stage.name].update(1)
+                if self.pending == 0:
+                    self.idle.set()
+
+    async def run(self, plants):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=sum(self.concurrency.values())))
+        self.queues = {stage.name: asyncio.Queue() for stage in self.stages}
+        self.bars = {stage.name: tqdm(total=0, desc=stage.name, position=i) for i, stage in enumerate(self.stages)}
+        self.idle = asyncio.Event()
+        async with FetchEngine(**self.engine_kwargs) as engine, SerpClient(**self.serp_kwargs) as serp:
+            self.ctx = {'engine': engine, 'serp': serp, 'token_budget': self.token_budget, 'grades': self.grades,
+                        'preclassifier': self.preclassifier, 'corpus': Corpus(),
+                        'text_index': TextIndex() if os.path.exists(TEXT_INDEX_PATH) else None}
+            workers = [
+                asyncio.create_task(self.worker(stage))
+                for stage in self.stages
+                for _ in range(self.concurrency[stage.name])
+            ]
+            for plant in plants:
+                try:
+                    self.advance(plant)
+                except Exception as e:
+                    self.fail('queue', plant['plant_code'], e)
+                # let workers start on early plants while the rest are still being read
+                await asyncio.sleep(0)
+            if self.pending == 0:
+                self.idle.set()
+            await self.idle.wait()
+            for task in workers:
+                task.cancel()
+        self.ctx['corpus'].close()
+        if self.ctx['text_index'] is not None:
+            self.ctx['text_index'].close()
+        if self.store is not None:
+            self.store.flush()
+        for bar in self.bars.values():
+            bar.close()
+        return self.failures
+
+
+def parse_concurrency(values):
+    concurrency = {}
+    for value in values or []:
+        name, n = value.split('=')
+        concurrency[name] = int(n)
+    return concurrency
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the dispute characterization pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # shared by run and plan, which has to know the settings a run would use
+    settings_parser = argparse.ArgumentParser(add_help=False)
+    settings_parser.add_argument('--stages', nargs='+', choices=list(STAGES_BY_NAME), default=list(STAGES_BY_NAME))
+    settings_parser.add_argument('--plants', default='ready_to_search.csv',
+                                 help="csv with plant_code, search_query, plant_info")
+    settings_parser.add_argument('--limit', type=int, default=None)
+    settings_parser.add_argument('--strategy', default='auto', help="unstructured strategy for non-HTML content")
+    settings_parser.add_argument('--reader-fallback', action='store_true',
+                                 help="fetch HTML pages that need JavaScript through the r.jina.ai reader")
+    settings_parser.add_argument('--token-budget', type=int, default=DEFAULT_TOKEN_BUDGET,
+                                 help="approximate token budget of the packed relevant content (0 keeps every article in full)")
+    settings_parser.add_argument('--preclassifier', default=PRECLASSIFIER_PATH,
+                                 help="local relevance gate from `python preclassifier.py train`, used if the file exists")
+    settings_parser.add_argument('--no-preclassifier', action='store_true', help="send every search result to the LLM")
+
+    run_parser = subparsers.add_parser('run', parents=[settings_parser], help="stream plants through the selected stages")
+    run_parser.add_argument('--concurrency', nargs='*', metavar='STAGE=N', help="override per-stage worker counts")
+    run_parser.add_argument('--store', action='store_true', help="also append results to the Parquet store")
+    run_parser.add_argument('--metrics-port', type=int, default=None,
+                            help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics during the run")
+    run_parser.add_argument('--no-grade-cache', action='store_true',
+                            help="grade every search result, even ones already graded for the same plant_info")
+
+    plan_parser = subparsers.add_parser('plan', parents=[settings_parser],
+                                        help="list the plant/stage results a run would recompute")
+    plan_parser.add_argument('--adopt', action='store_true',
+                             help="record the current inputs on results from before inputs were recorded")
+    subparsers.add_parser('status', help="count completed plants per stage")
+    subparsers.add_parser('rebuild-manifest', help="reseed the manifest from the results directories")
+    args = parser.parse_args()
+
+    manifest = Manifest(rebuild=args.command == 'rebuild-manifest')
+    if args.command == 'rebuild-manifest':
+        print(f"Recorded {len(manifest.entries)} completed plant/stage pairs")
+        return
+    if args.command == 'status':
+        counts = Counter((stage, entry['status']) for (_, stage), entry in manifest.entries.items())
+        for stage in STAGES:
+            print(f"{stage.name}: {counts[(stage.name, 'done')]} done, {counts[(stage.name, 'empty')]} empty")
+        return
+    preclassifier_path = None
+    if not args.no_preclassifier and os.path.exists(args.preclassifier):
+        preclassifier_path = args.preclassifier
+    settings = stage_settings(args.strategy, args.token_budget, args.reader_fallback, preclassifier_path)
+    dependencies = Dependencies(STAGES, manifest, settings)
+    if args.command == 'plan':
+        if args.adopt:
+            print(f"Recorded inputs on {dependencies.adopt(iter_plants(args.plants, args.limit))} results")
+        stale = dependencies.plan(iter_plants(args.plants, args.limit), args.stages)
+        for plant_code, stage, reason in stale:
+            print(f"{stage} {plant_code}: {reason}")
+        counts = Counter(stage for _, stage, _ in stale)
+        for stage in STAGES:
+            if stage.name in args.stages:
+                print(f"{stage.name}: {counts[stage.name]} to recompute")
+        manifest.close()
+        return
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    # CLI order doesn't matter: stages always run in dependency order
+    stages = [stage for stage in STAGES if stage.name in args.stages]
+    store = ResultsStore(partitions=load_plant_partitions(args.plants)) if args.store else None
+    # grades from an older prompt, model or response schema are not reused
+    grades = None if args.no_grade_cache else GradeCache(version=fingerprint(settings['article_relevance']['request']))
+    preclassifier = Preclassifier.load(preclassifier_path) if preclassifier_path else None
+    pipeline = Pipeline(stages, manifest, parse_concurrency(args.concurrency),
+                        {'strategy': args.strategy, 'reader_fallback': args.reader_fallback},
+                        args.token_budget, store, grades=grades, preclassifier=preclassifier,
+                        dependencies=dependencies)
+    failures = asyncio.run(pipeline.run(iter_plants(args.plants, args.limit)))
+    manifest.close()
+    if grades is not None:
+        grades.close()
+    metrics.close()
+    for stage, count in failures.items():
+        print(f"{stage}: {count} plants failed and will be retried on the next run")
+
+
+if __name__ == "__main__":
+    main()
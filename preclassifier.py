@@ -0,0 +1,312 @@
+import argparse
+import json
+import math
+import os
+import sqlite3
+from dataclasses import dataclass, field
+
+import joblib
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+
+from context_packer import OPPOSITION_KEYWORDS, query_terms, tokenize
+from label_store import LABEL_STORE_PATH
+
+PRECLASSIFIER_PATH = os.environ.get('PRECLASSIFIER_PATH', 'cache/preclassifier.joblib')
+GRADES = (1, 2, 3, 4, 5)
+# only the ends of the scale are decided locally; 2-4 always go to the model
+LOCAL_GRADES = (1, 5)
+TARGET_PRECISION = 0.95
+# the labeling app's checkbox asks whether a result is worth clicking for the
+# project, which the grading rubric puts at "mentions the exact project". An
+# unchecked box isn't a rubric grade 1, so human labels are only compared with
+# the gate on the relevance cut, never fitted or calibrated on
+HUMAN_GRADES = {False: 1, True: 4}
+# grades written by the gate are marked so they are never trained on again
+LOCAL_JUSTIFICATION = "Pre-classifier"
+
+
+@dataclass
+class Example:
+    search_query: str
+    plant_info: str
+    result: dict
+    grade: int
+    group: str
+    source: str = 'llm'
+
+
+def result_text(result):
+    return f"{result.get('title', '')} {result.get('description', '')} {result.get('display_link', '')}"
+
+
+def overlap_features(search_query, result, plant_info):
+    """Dense features the hashed text can't see: how much of the project's names and places the result mentions."""
+    tokens = set(tokenize(f"{result.get('title', '')} {result.get('description', '')}"))
+    link_tokens = set(tokenize(result.get('display_link', '') or result.get('link', '')))
+    plant_terms = query_terms(plant_info or '')
+    query_terms_ = query_terms(search_query or '')
+    opposition = sum(any(token.startswith(keyword) for keyword in OPPOSITION_KEYWORDS) for token in tokens)
+    return [
+        len(tokens & plant_terms) / max(len(plant_terms), 1),
+        math.log1p(len(tokens & plant_terms)),
+        len(tokens & query_terms_) / max(len(query_terms_), 1),
+        len(link_tokens & plant_terms) / max(len(plant_terms), 1),
+        math.log1p(opposition),
+        float(bool(result.get('description'))),
+        math.log1p(len(tokens)),
+    ]
+
+
+@dataclass
+class Preclassifier:
+    """
+    Local relevance model for search results: hashed word 1-2 grams of the
+    title, description and display link plus plant_info overlap features,
+    fed to a multinomial logistic regression over the 1-5 grades.
+
+    `decide` returns a grade only for LOCAL_GRADES whose predicted probability
+    reaches that grade's threshold; `calibrate` picks the thresholds on held-out
+    examples so locally decided grades agree with the LLM at `target_precision`.
+    """
+    n_features: int = 2 ** 17
+    C: float = 1.0
+    thresholds: dict = field(default_factory=lambda: {grade: math.inf for grade in LOCAL_GRADES})
+
+    def __post_init__(self):
+        self.vectorizer = HashingVectorizer(n_features=self.n_features, ngram_range=(1, 2), alternate_sign=False)
+        self.model = None
+
+    def features(self, examples):
+        text = self.vectorizer.transform([result_text(e.result) for e in examples])
+        dense = sparse.csr_matrix([overlap_features(e.search_query, e.result, e.plant_info) for e in examples])
+        return sparse.hstack([text, dense], format='csr')
+
+    def fit(self, examples):
+        # newton-cg converges in a few iterations where lbfgs crawls on the wide hashed features
+        self.model = LogisticRegression(C=self.C, solver='newton-cg', max_iter=200)
+        self.model.fit(self.features(examples), [e.grade for e in examples])
+        return self
+
+    def predict_proba(self, examples):
+        """n x 5 probabilities in GRADES order (zero for grades missing from the training data)."""
+        proba = np.zeros((len(examples), len(GRADES)))
+        if examples:
+            columns = [GRADES.index(grade) for grade in self.model.classes_]
+            proba[:, columns] = self.model.predict_proba(self.features(examples))
+        return proba
+
+    def calibrate(self, examples, target_precision=TARGET_PRECISION, min_support=20):
+        """
+        For each local grade, the lowest probability threshold at which the
+        examples predicted as that grade match their label at least
+        `target_precision` of the time (over at least `min_support` examples).
+        Grades that never get there are left to the LLM.
+        """
+        proba = self.predict_proba(examples)
+        labels = np.array([e.grade for e in examples])
+        for grade in LOCAL_GRADES:
+            p = proba[:, GRADES.index(grade)]
+            order = np.argsort(-p)
+            hits = np.cumsum(labels[order] == grade)
+            precision = hits / np.arange(1, len(order) + 1)
+            ok = np.nonzero((precision >= target_precision) & (np.arange(1, len(order) + 1) >= min_support))[0]
+            # the largest prefix of the ranking that is still precise enough
+            self.thresholds[grade] = float(p[order[ok[-1]]]) if len(ok) else math.inf
+        return self.thresholds
+
+    def decide_many(self, examples):
+        """A {'grade', 'justification'} dict for each example decided locally, None for the rest."""
+        proba = self.predict_proba(examples)
+        decisions = []
+        for row in proba:
+            decision = None
+            for grade in LOCAL_GRADES:
+                p = row[GRADES.index(grade)]
+                if p >= self.thresholds[grade] and p == row.max():
+                    decision = {'grade': grade, 'justification': f"{LOCAL_JUSTIFICATION} (p={p:.2f})"}
+            decisions.append(decision)
+        return decisions
+
+    def decide(self, search_query, results, plant_info):
+        return self.decide_many([Example(search_query, plant_info, result, 0, '') for result in results])
+
+    def save(self, path=PRECLASSIFIER_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(self, path)
+
+    @classmethod
+    def load(cls, path=PRECLASSIFIER_PATH):
+        return joblib.load(path)
+
+
+def llm_examples(plants='ready_to_search.csv'):
+    """(search result, grade) pairs from results/article_relevance, leaving out grades the gate made itself."""
+    from results_io import RESULTS_DIR, iter_plants, read_result
+
+    examples = []
+    for plant in iter_plants(plants):
+        plant_code = plant['plant_code']
+        if not os.path.exists(f'{RESULTS_DIR}/article_relevance/{plant_code}.json'):
+            continue
+        relevance = read_result('article_relevance', plant_code)
+        if not relevance:
+            continue
+        organic = read_result('search', plant_code).get('organic', [])
+        by_letter = {result.get('article_letter', chr(65 + i)): result for i, result in enumerate(organic)}
+        for item in relevance.get('scores_and_justifications', []):
+            result = by_letter.get(item['article_letter'])
+            if result is None or item['grade'] not in GRADES or \
+                    (item.get('justification') or '').startswith(LOCAL_JUSTIFICATION):
+                continue
+            examples.append(Example(plant['search_query'], plant['plant_info'], result, item['grade'], plant_code))
+    return examples
+
+
+def human_examples(path=LABEL_STORE_PATH):
+    """Search results checked (or not) in the labeling app, graded through HUMAN_GRADES."""
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT id, query, result, data, label FROM tasks WHERE label IS NOT NULL").fetchall()
+    conn.close()
+    examples = []
+    for task_id, query, result, data, label in rows:
+        try:
+            results = json.loads(result)
+            submission = json.loads(label)['submission']
+        except (TypeError, ValueError, KeyError):
+            continue
+        plant_info = json.loads(data).get('plant_info') or query or ''
+        for j, checked in submission.items():
+            if int(j) < len(results):
+                examples.append(Example(query or '', plant_info, results[int(j)], HUMAN_GRADES[bool(checked)],
+                                        f'human-{task_id}', 'human'))
+    return examples
+
+
+def split_groups(examples, fractions, seed=0):
+    """Splits by plant (or labeling task), so no plant's results are on both sides of a split."""
+    groups = sorted({e.group for e in examples})
+    np.random.default_rng(seed).shuffle(groups)
+    bounds = np.cumsum([0] + [round(f * len(groups)) for f in fractions[:-1]] + [len(groups)])
+    bounds[-1] = len(groups)
+    splits = [set(groups[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+    return [[e for e in examples if e.group in split] for split in splits]
+
+
+def calibration_report(model, examples, human=(), bins=10):
+    """
+    How far the gate can be trusted on the LLM-graded `examples`: reliability
+    of the top predicted probability (with the expected calibration error), and
+    for each local grade its threshold, coverage, precision and the share that
+    crosses the relevance cut (>= 3) used by build_relevant_content. Also the
+    share of results, and of plants, that would need no LLM call at all. The
+    `human` examples are reported on their own: how many the gate would decide,
+    and how often it lands on the same side of the relevance cut as the checkbox.
+    """
+    proba = model.predict_proba(examples)
+    labels = np.array([e.grade for e in examples])
+    confidence = proba.max(axis=1)
+    predicted = np.array(GRADES)[proba.argmax(axis=1)]
+    reliability = []
+    ece = 0.0
+    for low in np.linspace(0, 1, bins, endpoint=False):
+        mask = (confidence >= low) & (confidence < low + 1 / bins)
+        if mask.any():
+            accuracy = float(np.mean(predicted[mask] == labels[mask]))
+            reliability.append({'bin': f'{low:.1f}-{low + 1 / bins:.1f}', 'n': int(mask.sum()),
+                                'confidence': float(confidence[mask].mean()), 'accuracy': accuracy})
+            ece += mask.sum() / len(labels) * abs(confidence[mask].mean() - accuracy)
+
+    decisions = model.decide_many(examples)
+    decided = np.array([d['grade'] if d else 0 for d in decisions])
+    local = {}
+    for grade in LOCAL_GRADES:
+        mask = decided == grade
+        relevant = labels[mask] >= 3
+        local[grade] = {
+            'threshold': model.thresholds[grade],
+            'coverage': float(mask.mean()) if len(mask) else 0.0,
+            'precision': float(np.mean(labels[mask] == grade)) if mask.any() else None,
+            'relevance_flips': float(np.mean(relevant if grade == 1 else ~relevant)) if mask.any() else None,
+        }
+    human_decided = np.array([d['grade'] if d else 0 for d in model.decide_many(list(human))])
+    human_relevant = np.array([e.grade >= 3 for e in human], dtype=bool)
+    mask = human_decided > 0
+    human_report = {
+        'examples': len(human),
+        'decided': int(mask.sum()),
+        'agreement': float(np.mean((human_decided[mask] >= 3) == human_relevant[mask])) if mask.any() else None,
+    }
+    plants = {}
+    for e, d in zip(examples, decided):
+        plants[e.group] = plants.get(e.group, True) and d > 0
+    return {
+        'examples': len(examples),
+        'accuracy': float(np.mean(predicted == labels)) if len(labels) else None,
+        'ece': float(ece),
+        'reliability': reliability,
+        'local': local,
+        'human': human_report,
+        'decided_locally': float(np.mean(decided > 0)) if len(decided) else 0.0,
+        'plants_without_llm_call': float(np.mean(list(plants.values()))) if plants else 0.0,
+    }
+
+
+def train(examples, target_precision=TARGET_PRECISION, seed=0, human=(), **model_kwargs):
+    """
+    Fits on 60% of the plants, picks the thresholds on 20% and reports on the
+    last 20%, all of it LLM grades only; the `human` labels are reported on
+    separately. The returned model is the one that was calibrated and reported
+    on: refitting on more plants would shift its probabilities away from the
+    thresholds, so more data means retraining, not reusing them.
+    """
+    fit_split, calibration_split, test_split = split_groups(examples, [0.6, 0.2, 0.2], seed)
+    model = Preclassifier(**model_kwargs).fit(fit_split)
+    model.calibrate(calibration_split, target_precision)
+    return model, calibration_report(model, test_split, human)
+
+
+def print_report(report):
+    print(f"{report['examples']} held-out results, accuracy {report['accuracy']:.3f}, ECE {report['ece']:.3f}")
+    for row in report['reliability']:
+        print(f"  p {row['bin']}: n={row['n']} confidence={row['confidence']:.3f} accuracy={row['accuracy']:.3f}")
+    for grade, row in report['local'].items():
+        precision = 'n/a' if row['precision'] is None else f"{row['precision']:.3f}"
+        flips = 'n/a' if row['relevance_flips'] is None else f"{row['relevance_flips']:.3f}"
+        print(f"  grade {grade}: threshold={row['threshold']:.3f} coverage={row['coverage']:.1%} "
+              f"precision={precision} across relevance cut={flips}")
+    human = report['human']
+    if human['examples']:
+        agreement = 'n/a' if human['agreement'] is None else f"{human['agreement']:.3f}"
+        print(f"  labeling app: {human['decided']} of {human['examples']} decided locally, "
+              f"same side of relevance cut as the checkbox {agreement}")
+    print(f"decided locally: {report['decided_locally']:.1%} of results, "
+          f"{report['plants_without_llm_call']:.1%} of plants need no LLM call")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local relevance gate in front of get_relevance_scores")
+    parser.add_argument('command', choices=['train', 'report'])
+    parser.add_argument('--plants', default='ready_to_search.csv')
+    parser.add_argument('--labels', default=LABEL_STORE_PATH, help="label store of the labeling app")
+    parser.add_argument('--path', default=PRECLASSIFIER_PATH)
+    parser.add_argument('--target-precision', type=float, default=TARGET_PRECISION)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    examples = llm_examples(args.plants)
+    human = human_examples(args.labels)
+    print(f"{len(examples)} LLM-graded results, {len(human)} from the labeling app (reported on, not trained on)")
+    if args.command == 'train':
+        model, report = train(examples, args.target_precision, args.seed, human)
+        model.save(args.path)
+        print_report(report)
+        print(f"Saved to {args.path}")
+    else:
+        # includes the training data, so this is optimistic; `train` reports on held-out plants
+        print_report(calibration_report(Preclassifier.load(args.path), examples, human))
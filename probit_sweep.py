@@ -0,0 +1,216 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from statsmodels.discrete.discrete_model import Probit
+
+DEPENDENT = 'Opposition'
+# the specification of visualizations/probit_model_extended_summary.txt
+BASE_REGRESSORS = [
+    'Population Density (per sq mile)', 'Percent Black', 'Percent Hispanic', 'Percent White',
+    'Percent 25 or Older with Less Than HS Degree', 'Percent Above 64', 'Percent Ages 10-64',
+    'Energy Burden Percentile', 'LMI Percentile Based on AMI', 'PM2.5 in the Air Percentile',
+    'Unemployment Percentile', 'capacity', 'Compensation', 'Delay', 'Co-Use',
+]
+SWEEP_OUTPUT = os.path.join('results', 'probit_sweep.parquet')
+
+# attached shared arrays of a worker process
+_shared = {}
+
+
+@dataclass
+class Spec:
+    name: str
+    regressors: List[str]
+    tech_type: Optional[str] = None
+    bootstrap: bool = False
+
+
+@dataclass
+class SharedArrays:
+    """numpy arrays copied once into shared memory; workers map them instead of receiving copies."""
+    arrays: dict
+    handles: list = field(default_factory=list)
+
+    @classmethod
+    def create(cls, **arrays):
+        shared = cls({})
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+            shared.handles.append(shm)
+            shared.arrays[name] = (shm.name, array.shape, array.dtype.str)
+        return shared
+
+    def close(self):
+        for shm in self.handles:
+            shm.close()
+            shm.unlink()
+
+
+def attach(layout):
+    """Worker initializer: map the shared arrays described by SharedArrays.arrays."""
+    for name, (shm_name, shape, dtype) in layout.items():
+        shm = SharedMemory(name=shm_name)
+        _shared.setdefault('_handles', []).append(shm)
+        _shared[name] = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+
+def default_specs(regressors=BASE_REGRESSORS, tech_types=('PV', 'WT')):
+    """The base model (bootstrapped), every leave-one-out variant and the base model per tech_type."""
+    specs = [Spec('base', list(regressors), bootstrap=True)]
+    specs += [Spec(f'drop {regressor}', [r for r in regressors if r != regressor]) for regressor in regressors]
+    specs += [Spec(f'tech_type {tech_type}', list(regressors), tech_type) for tech_type in tech_types]
+    return specs
+
+
+def fit_task(task):
+    """
+    Fits one specification on the full sample or on a chunk of bootstrap
+    resamples. Each fit starts from the coefficients of the previous one (or
+    from `start_params`), which cuts the Newton iterations on resamples to a few.
+    """
+    spec_name, columns, tech_code, replicates, start_params, cov_type = task
+    X, y, tech = _shared['X'], _shared['y'], _shared['tech']
+    columns = np.asarray(columns)
+    rows = np.arange(len(y)) if tech_code < 0 else np.flatnonzero(tech == tech_code)
+    rows = rows[~np.isnan(X[np.ix_(rows, columns)]).any(axis=1) & ~np.isnan(y[rows])]
+    params = start_params
+    fits = []
+    for replicate, seed in replicates:
+        sample = rows if seed is None else rows[np.random.default_rng(seed).integers(0, len(rows), len(rows))]
+        try:
+            result = Probit(y[sample], X[np.ix_(sample, columns)]).fit(
+                start_params=params, method='newton', maxiter=100, disp=0, cov_type=cov_type
+            )
+        except Exception as e:
+            fits.append({'spec': spec_name, 'replicate': replicate, 'n_obs': len(sample), 'error': str(e)})
+            continue
+        params = result.params
+        fits.append({
+            'spec': spec_name, 'replicate': replicate, 'n_obs': len(sample),
+            'params': result.params, 'bse': result.bse, 'pvalues': result.pvalues,
+            'llf': result.llf, 'pseudo_r2': result.prsquared,
+            'converged': bool(result.mle_retvals.get('converged', True)), 'error': None,
+        })
+    return fits
+
+
+def build_table(plants, store=None):
+    """Plants joined with their county demographics and first-summary scores, with the probit labels as columns."""
+    from aggregate import VARIABLE_LABELS, load_scores
+    from geo_join import DEMOGRAPHIC_LABELS, load_geo_join
+    from results_store import SCORE_VARIABLES
+
+    plants = plants.assign(plant_code=plants['plant_code'].astype(np.int64))
+    scores = load_scores(store)
+    score_table = pd.DataFrame(scores.values, columns=SCORE_VARIABLES).rename(columns=VARIABLE_LABELS)
+    score_table['plant_code'] = scores.plant_codes
+    geo = load_geo_join(plants).rename(columns=DEMOGRAPHIC_LABELS)
+    geo['plant_code'] = geo['plant_code'].astype(np.int64)
+    return (plants[['plant_code', 'capacity', 'tech_type', 'state']]
+            .merge(geo, on='plant_code', how='left')
+            .merge(score_table, on='plant_code', how='inner'))
+
+
+def tidy(fits, terms_by_spec, tech_type_by_spec):
+    rows = []
+    for fit in fits:
+        spec = fit['spec']
+        common = {'spec': spec, 'tech_type': tech_type_by_spec[spec], 'replicate': fit['replicate'],
+                  'n_obs': fit['n_obs'], 'llf': fit.get('llf'), 'pseudo_r2': fit.get('pseudo_r2'),
+                  'converged': fit.get('converged', False), 'error': fit['error']}
+        for i, term in enumerate(terms_by_spec[spec]):
+            if fit['error'] is None:
+                rows.append({**common, 'term': term, 'coef': fit['params'][i], 'std_err': fit['bse'][i],
+                             'p_value': fit['pvalues'][i]})
+            else:
+                rows.append({**common, 'term': term, 'coef': np.nan, 'std_err': np.nan, 'p_value': np.nan})
+    return pd.DataFrame(rows)
+
+
+def run_sweep(table, specs=None, n_bootstrap=1000, workers=None, chunk_size=25, seed=0, cov_type='nonrobust'):
+    """
+    Fits every specification on its full sample, then `n_bootstrap` resamples of
+    the specs marked bootstrap=True, warm-started from their full-sample fit.
+    The design matrix lives in shared memory for the whole sweep. Returns a tidy
+    table with one row per (spec, replicate, term); replicate 0 is the full sample.
+    """
+    specs = specs or default_specs()
+    regressors = list(dict.fromkeys(r for spec in specs for r in spec.regressors))
+    X = np.column_stack([np.ones(len(table))] + [table[r].to_numpy(dtype=np.float64) for r in regressors])
+    y = table[DEPENDENT].to_numpy(dtype=np.float64)
+    tech_types = sorted(table['tech_type'].dropna().astype(str).unique())
+    tech = table['tech_type'].astype(str).map({t: i for i, t in enumerate(tech_types)}).fillna(-1).to_numpy(np.int16)
+
+    columns_by_spec = {spec.name: [0] + [regressors.index(r) + 1 for r in spec.regressors] for spec in specs}
+    terms_by_spec = {spec.name: ['const'] + spec.regressors for spec in specs}
+    tech_by_spec = {spec.name: spec.tech_type for spec in specs}
+
+    def tech_code(spec):
+        return tech_types.index(spec.tech_type) if spec.tech_type in tech_types else (-1 if spec.tech_type is None else -2)
+
+    shared = SharedArrays.create(X=X, y=y, tech=tech)
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=attach, initargs=(shared.arrays,)) as executor:
+            full_tasks = [(spec.name, columns_by_spec[spec.name], tech_code(spec), [(0, None)], None, cov_type)
+                          for spec in specs]
+            fits = [fit for fits in executor.map(fit_task, full_tasks) for fit in fits]
+            start_params = {fit['spec']: fit['params'] for fit in fits if fit['error'] is None}
+
+            seeds = np.random.SeedSequence(seed).generate_state(max(n_bootstrap, 1))
+            bootstrap_tasks = []
+            for spec in specs:
+                if not spec.bootstrap or n_bootstrap <= 0:
+                    continue
+                for start in range(0, n_bootstrap, chunk_size):
+                    replicates = [(i + 1, int(seeds[i])) for i in range(start, min(start + chunk_size, n_bootstrap))]
+                    bootstrap_tasks.append((spec.name, columns_by_spec[spec.name], tech_code(spec), replicates,
+                                            start_params.get(spec.name), cov_type))
+            fits += [fit for fits in executor.map(fit_task, bootstrap_tasks) for fit in fits]
+    finally:
+        shared.close()
+    return tidy(fits, terms_by_spec, tech_by_spec)
+
+
+def bootstrap_summary(results, alpha=0.05):
+    """Full-sample estimates next to bootstrap standard errors and percentile intervals per spec and term."""
+    full = results[results['replicate'] == 0].set_index(['spec', 'term'])[['coef', 'std_err', 'p_value']]
+    boot = results[(results['replicate'] > 0) & results['coef'].notna()].groupby(['spec', 'term'])['coef']
+    summary = pd.DataFrame({
+        'bootstrap_se': boot.std(),
+        'ci_low': boot.quantile(alpha / 2),
+        'ci_high': boot.quantile(1 - alpha / 2),
+        'share_positive': boot.apply(lambda coef: (coef > 0).mean()),
+        'replicates': boot.count(),
+    })
+    return full.join(summary, how='inner').reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bootstrap and specification sweep of the opposition probit model")
+    parser.add_argument('--plants', default='ready_to_search.csv')
+    parser.add_argument('--bootstrap', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cov-type', default='nonrobust', help="statsmodels cov_type, e.g. HC1")
+    parser.add_argument('--output', default=SWEEP_OUTPUT)
+    args = parser.parse_args()
+
+    table = build_table(pd.read_csv(args.plants))
+    start = time.time()
+    results = run_sweep(table, n_bootstrap=args.bootstrap, workers=args.workers, seed=args.seed, cov_type=args.cov_type)
+    print(f"{results[['spec', 'replicate']].drop_duplicates().shape[0]} fits in {time.time() - start:.1f}s")
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    results.to_parquet(args.output, index=False)
+    summary = bootstrap_summary(results)
+    print(summary[summary['term'].isin(['Compensation', 'Delay', 'Co-Use'])].to_string(index=False))
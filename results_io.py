@@ -0,0 +1,289 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+RESULTS_DIR = 'results'
+MANIFEST_PATH = os.path.join(RESULTS_DIR, 'manifest.jsonl')
+
+# bump a stage's version when the layout of its json changes; `verify` flags
+# results written under an older version so they are recomputed
+SCHEMA_VERSIONS = {
+    'search': 1,
+    'content': 1,
+    'article_relevance': 1,
+    'content_relevance': 1,
+    'relevant_content': 1,
+    'scores': 1,
+}
+
+
+def schema_version(stage):
+    return SCHEMA_VERSIONS.get(stage, 1)
+
+
+def result_path(stage, plant_code, results_dir=RESULTS_DIR):
+    return os.path.join(results_dir, stage, f'{plant_code}.json')
+
+
+def encode(result):
+    return json.dumps(result).encode('utf-8')
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def fsync_path(path, directory=False):
+    fd = os.open(path, os.O_RDONLY | (getattr(os, 'O_DIRECTORY', 0) if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data, fsync=True):
+    """
+    Writes `data` to a temporary file next to `path` and renames it over
+    `path`, so readers (and a resume after a crash) see either the old file or
+    the whole new one, never a truncated one. With fsync=False the caller is
+    responsible for syncing the file before relying on it surviving a power loss.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f'.{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if fsync:
+        fsync_path(directory, directory=True)
+
+
+def read_result(stage, plant_code):
+    with open(result_path(stage, plant_code), 'r') as f:
+        return json.load(f)
+
+
+def write_result(stage, plant_code, result):
+    """Atomic write of a result outside the manifest; Manifest.write also records it."""
+    atomic_write(result_path(stage, plant_code), encode(result))
+
+
+def iter_plants(path, limit=None, chunksize=1000):
+    """Streams plant rows from a csv with plant_code, search_query and plant_info columns."""
+    count = 0
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        for plant in chunk.to_dict('records'):
+            if limit is not None and count >= limit:
+                return
+            plant['plant_code'] = str(plant['plant_code'])
+            count += 1
+            yield plant
+
+
+class Manifest:
+    """
+    Append-only record of completed (plant_code, stage) pairs, so resume checks
+    are a dict lookup instead of an os.path.exists per plant. Status is "done"
+    when the stage wrote results/<stage>/{plant_code}.json and "empty" when it
+    finished without output (e.g. no relevant articles), which stops the plant
+    from going further down the pipeline. "done" entries also carry the size,
+    content hash and schema version of the result, which `verify` checks, and
+    entries written by a run record the inputs of the result (see deps.py).
+
+    `write` stores a result with an atomic rename and records it. Syncing is
+    batched: results and their manifest lines are fsynced together every
+    `batch_size` records or `interval` seconds (and on flush/close), and a line
+    only reaches the manifest after its result is on disk. A crash therefore
+    loses at most the last batch, which is recomputed on the next run, and never
+    leaves a truncated result marked as done.
+    """
+
+    def __init__(self, path=MANIFEST_PATH, rebuild=False, results_dir=RESULTS_DIR, batch_size=64, interval=1.0):
+        self.path = path
+        self.results_dir = results_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self.entries = {}
+        self.pending_lines = []
+        self.pending_files = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+        line = '\n'
+        if os.path.exists(path) and not rebuild:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut off by a crash; its result is redone
+                        continue
+                    self.apply(entry)
+        else:
+            self.rebuild()
+        self.file = open(path, 'a')
+        if not line.endswith('\n'):
+            # start after the cut-off line instead of appending to it
+            self.file.write('\n')
+
+    def apply(self, entry):
+        key = (entry['plant_code'], entry['stage'])
+        if entry['status'] == 'invalid':
+            self.entries.pop(key, None)
+        else:
+            self.entries[key] = entry
+
+    def rebuild(self, stages=None):
+        """
+        Seeds the manifest from existing results directories, one listdir per
+        stage. Every file is read once to record its hash; files that aren't
+        valid json (e.g. truncated by a crash of an older version) are left out.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        stages = stages or list(SCHEMA_VERSIONS)
+        with open(self.path, 'w') as f:
+            for stage in stages:
+                stage_dir = os.path.join(self.results_dir, stage)
+                if not os.path.isdir(stage_dir):
+                    continue
+                for filename in os.listdir(stage_dir):
+                    plant_code, ext = os.path.splitext(filename)
+                    if ext != '.json' or not plant_code.isdigit():
+                        continue
+                    with open(os.path.join(stage_dir, filename), 'rb') as result_file:
+                        data = result_file.read()
+                    try:
+                        json.loads(data)
+                    except ValueError:
+                        continue
+                    entry = self.done_entry(plant_code, stage, data)
+                    self.entries[(plant_code, stage)] = entry
+                    f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def done_entry(plant_code, stage, data):
+        return {'plant_code': str(plant_code), 'stage': stage, 'status': 'done', 'size': len(data),
+                'hash': content_hash(data), 'schema': schema_version(stage)}
+
+    def status(self, plant_code, stage):
+        entry = self.entries.get((str(plant_code), stage))
+        return None if entry is None else entry['status']
+
+    def record(self, plant_code, stage, status, entry=None, result_file=None, inputs=None):
+        entry = entry or {'plant_code': str(plant_code), 'stage': stage, 'status': status}
+        if inputs is not None:
+            # fingerprints of what the result was computed from, see deps.py
+            entry['inputs'] = inputs
+        with self.lock:
+            self.apply(entry)
+            self.pending_lines.append(json.dumps(entry) + '\n')
+            if result_file is not None:
+                self.pending_files.append(result_file)
+            if len(self.pending_lines) >= self.batch_size or time.monotonic() - self.last_flush >= self.interval:
+                self.flush()
+
+    def write(self, stage, plant_code, result, inputs=None):
+        """Writes results/<stage>/{plant_code}.json atomically and records the stage as done."""
+        data = encode(result)
+        path = result_path(stage, plant_code, self.results_dir)
+        atomic_write(path, data, fsync=False)
+        self.record(plant_code, stage, 'done', self.done_entry(plant_code, stage, data), path, inputs)
+
+    def flush(self):
+        """Syncs the results written since the last flush, then appends and syncs their manifest lines."""
+        with self.lock:
+            directories = set()
+            for path in self.pending_files:
+                try:
+                    fsync_path(path)
+                except FileNotFoundError:
+                    continue
+                directories.add(os.path.dirname(path) or '.')
+            for directory in directories:
+                fsync_path(directory, directory=True)
+            if self.pending_lines:
+                self.file.writelines(self.pending_lines)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.pending_lines = []
+            self.pending_files = []
+            self.last_flush = time.monotonic()
+
+    def verify(self, deep=True, stored_elsewhere=None):
+        """
+        Checks every "done" entry against its file: missing, a different size,
+        or an outdated schema version, and with deep=True a different content
+        hash (or invalid json, for entries from before hashes were recorded).
+        A missing file is fine if stored_elsewhere(plant_code, stage) says so
+        (e.g. content moved into the corpus). Returns (plant_code, stage, problem) tuples.
+        """
+        problems = []
+        for (plant_code, stage), entry in sorted(self.entries.items()):
+            if entry['status'] != 'done':
+                continue
+            path = result_path(stage, plant_code, self.results_dir)
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                if stored_elsewhere is None or not stored_elsewhere(plant_code, stage):
+                    problems.append((plant_code, stage, 'missing'))
+                continue
+            if entry.get('schema', schema_version(stage)) != schema_version(stage):
+                problems.append((plant_code, stage, 'schema'))
+            elif 'size' in entry and size != entry['size']:
+                problems.append((plant_code, stage, 'size'))
+            elif deep:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if 'hash' in entry:
+                    if content_hash(data) != entry['hash']:
+                        problems.append((plant_code, stage, 'hash'))
+                else:
+                    try:
+                        json.loads(data)
+                    except ValueError:
+                        problems.append((plant_code, stage, 'json'))
+        return problems
+
+    def requeue(self, problems):
+        """Drops the entries of `problems` so the next run recomputes them."""
+        for plant_code, stage, _ in problems:
+            self.record(plant_code, stage, 'invalid')
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the results directories against the manifest")
+    parser.add_argument('--path', default=MANIFEST_PATH)
+    parser.add_argument('--quick', action='store_true', help="only check existence, size and schema version")
+    parser.add_argument('--requeue', action='store_true', help="drop the bad entries so the next run redoes them")
+    args = parser.parse_args()
+
+    from corpus import Corpus
+
+    manifest = Manifest(args.path)
+    corpus = Corpus()
+    start = time.time()
+    problems = manifest.verify(deep=not args.quick,
+                               stored_elsewhere=lambda plant_code, stage: stage == 'content' and plant_code in corpus)
+    for plant_code, stage, problem in problems:
+        print(f"{stage}/{plant_code}.json: {problem}")
+    print(f"Checked {sum(entry['status'] == 'done' for entry in manifest.entries.values())} results "
+          f"in {time.time() - start:.1f}s, {len(problems)} bad")
+    if args.requeue and problems:
+        manifest.requeue(problems)
+        print(f"Re-queued {len(problems)} plant/stage pairs")
+    manifest.close()
@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import shutil
+import time
+import uuid
+from collections import defaultdict
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+RESULTS_DIR = 'results'
+STORE_DIR = os.environ.get('RESULTS_STORE', os.path.join(RESULTS_DIR, 'store'))
+PARTITIONING = ['state', 'tech_type']
+UNKNOWN = 'unknown'
+
+# the 15 binary variables of ProjectPerceptionVariables; mention_support and
+# mention_opp come with sources as well
+SCORE_VARIABLES = [
+    'mention_support', 'mention_opp', 'physical_opp', 'policy_opp', 'legal_opp', 'opinion_opp',
+    'environmental_opp', 'participation_opp', 'tribal_opp', 'health_opp', 'intergov_opp', 'property_opp',
+    'compensation', 'delay', 'co_land_use',
+]
+
+COMMON_FIELDS = [
+    pa.field('plant_code', pa.int64()),
+    pa.field('state', pa.string()),
+    pa.field('tech_type', pa.string()),
+    pa.field('ingested_at', pa.float64()),
+    # marks a result without rows (e.g. no relevant articles), so it still supersedes the plant's older rows
+    pa.field('empty', pa.bool_()),
+]
+
+SCHEMAS = {
+    'search': pa.schema(COMMON_FIELDS + [
+        pa.field('rank', pa.int16()),
+        pa.field('title', pa.string()),
+        pa.field('link', pa.string()),
+        pa.field('display_link', pa.string()),
+        pa.field('description', pa.string()),
+    ]),
+    'content': pa.schema(COMMON_FIELDS + [
+        pa.field('article_letter', pa.string()),
+        pa.field('link', pa.string()),
+        pa.field('title', pa.string()),
+        pa.field('description', pa.string()),
+        pa.field('content', pa.large_string()),
+    ]),
+    'article_relevance': pa.schema(COMMON_FIELDS + [
+        pa.field('article_letter', pa.string()),
+        pa.field('grade', pa.int8()),
+        pa.field('justification', pa.string()),
+    ]),
+    'content_relevance': pa.schema(COMMON_FIELDS + [
+        pa.field('entry', pa.int16()),
+        pa.field('score', pa.int8()),
+        pa.field('justification', pa.string()),
+    ]),
+    'relevant_content': pa.schema(COMMON_FIELDS + [
+        pa.field('articles', pa.string()),
+        pa.field('relevant_content_text', pa.large_string()),
+    ]),
+    'scores': pa.schema(COMMON_FIELDS + [pa.field('entry', pa.int16())] + [
+        pa.field(variable, pa.int8()) for variable in SCORE_VARIABLES
+    ] + [
+        pa.field('mention_support_sources', pa.string()),
+        pa.field('mention_opp_sources', pa.string()),
+        pa.field('narrative', pa.string()),
+    ]),
+}
+
+# columns that identify a row within a stage's result for one plant; a plant's
+# latest result replaces all of its earlier rows (see `latest`)
+KEYS = {
+    'search': ['plant_code', 'rank'],
+    'content': ['plant_code', 'article_letter'],
+    'article_relevance': ['plant_code', 'article_letter'],
+    'content_relevance': ['plant_code', 'entry'],
+    'relevant_content': ['plant_code'],
+    'scores': ['plant_code', 'entry'],
+}
+
+
+def latest(df, stage):
+    """The rows of each plant's most recently ingested result, which may have fewer rows than an older one."""
+    newest = df.groupby('plant_code')['ingested_at'].transform('max')
+    df = df[df['ingested_at'] == newest]
+    return df.sort_values('ingested_at').drop_duplicates(KEYS[stage], keep='last')
+
+
+def flatten_score(value):
+    """mention_support/mention_opp are a list of {score, sources}; older results have a bare int."""
+    if isinstance(value, list):
+        value = value[0] if value else {}
+    if isinstance(value, dict):
+        return value.get('score'), value.get('sources')
+    return value, None
+
+
+def flatten(stage, result):
+    """Rows (dicts without the common fields) for one plant's json result of a stage."""
+    if result == [] or result is None:
+        return []
+    if stage == 'search':
+        return [
+            {'rank': rank, 'title': item.get('title'), 'link': item.get('link'),
+             'display_link': item.get('display_link'), 'description': item.get('description')}
+            for rank, item in enumerate(result.get('organic', []))
+        ]
+    if stage == 'content':
+        if not isinstance(result, dict):
+            return []
+        return [
+            {key: article.get(key) for key in ('article_letter', 'link', 'title', 'description', 'content')}
+            for article in result.get('individual_results', [])
+        ]
+    if stage == 'article_relevance':
+        return [
+            {'article_letter': item['article_letter'], 'grade': item['grade'], 'justification': item['justification']}
+            for item in result.get('scores_and_justifications', [])
+        ]
+    if stage == 'content_relevance':
+        return [
+            {'entry': entry, 'score': item['score'], 'justification': item['justification']}
+            for entry, item in enumerate(result.get('score_and_justification', []))
+        ]
+    if stage == 'relevant_content':
+        letters = [article['article_letter'] for article in result.get('individual_results', []) if 'grade' in article]
+        return [{'articles': ','.join(letters), 'relevant_content_text': result.get('relevant_content_text')}]
+    if stage == 'scores':
+        rows = []
+        for entry, item in enumerate(result.get('all_scores_and_sources', [])):
+            row = {'entry': entry, 'narrative': item.get('narrative')}
+            for variable in SCORE_VARIABLES:
+                row[variable], sources = flatten_score(item.get(variable))
+                if variable in ('mention_support', 'mention_opp'):
+                    row[f'{variable}_sources'] = sources
+            rows.append(row)
+        return rows
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def load_plant_partitions(path):
+    """plant_code -> (state, tech_type) from the plants csv."""
+    plants = pd.read_csv(path, usecols=['plant_code', 'state', 'tech_type'])
+    return {
+        int(row.plant_code): (row.state, row.tech_type)
+        for row in plants.itertuples(index=False)
+    }
+
+
+class ResultsStore:
+    """
+    One Parquet dataset per stage under `root/<stage>/`, hive-partitioned by
+    state and tech_type, with the nested json results flattened into typed
+    columns (one row per article, per relevance score or per summary).
+
+    `append` writes new part files without touching existing ones; `load`
+    returns only the rows of each plant's latest result, so a re-scored plant
+    supersedes all of its old rows (also when it now has fewer, or none) until
+    `compact` rewrites the stage without them.
+    """
+
+    def __init__(self, root=STORE_DIR, partitions=None):
+        self.root = root
+        self.partitions = partitions or {}
+        self.buffers = defaultdict(list)
+
+    def stage_dir(self, stage):
+        return os.path.join(self.root, stage)
+
+    def rows_for(self, stage, plant_code, result, ingested_at=None):
+        state, tech_type = self.partitions.get(int(plant_code), (UNKNOWN, UNKNOWN))
+        common = {
+            'plant_code': int(plant_code),
+            'state': state if isinstance(state, str) else UNKNOWN,
+            'tech_type': tech_type if isinstance(tech_type, str) else UNKNOWN,
+            'ingested_at': ingested_at or time.time(),
+        }
+        rows = [{**common, **row} for row in flatten(stage, result)]
+        return rows or [{**common, 'empty': True}]
+
+    def write(self, stage, rows, existing_data_behavior='overwrite_or_ignore'):
+        if not rows:
+            return
+        table = pa.Table.from_pylist(rows, schema=SCHEMAS[stage])
+        ds.write_dataset(
+            table, self.stage_dir(stage), format='parquet',
+            partitioning=PARTITIONING, partitioning_flavor='hive',
+            basename_template=f'part-{int(time.time())}-{uuid.uuid4().hex[:8]}-{{i}}.parquet',
+            existing_data_behavior=existing_data_behavior,
+        )
+
+    def add(self, stage, plant_code, result, flush_every=500):
+        """Buffers one plant's result and appends the buffer once it holds `flush_every` rows."""
+        self.buffers[stage].extend(self.rows_for(stage, plant_code, result))
+        if len(self.buffers[stage]) >= flush_every:
+            self.flush(stage)
+
+    def flush(self, stage=None):
+        for name in [stage] if stage else list(self.buffers):
+            self.write(name, self.buffers.pop(name, []))
+
+    def append(self, stage, results):
+        """Appends {plant_code: result} as new part files."""
+        ingested_at = time.time()
+        self.write(stage, [
+            row for plant_code, result in results.items()
+            for row in self.rows_for(stage, plant_code, result, ingested_at)
+        ])
+
+    def dataset(self, stage):
+        return ds.dataset(self.stage_dir(stage), format='parquet', schema=SCHEMAS[stage], partitioning='hive')
+
+    def load(self, stage, columns=None, filter=None):
+        """
+        Loads a stage as a DataFrame with the rows of each plant's latest
+        result. `filter` is a pyarrow expression, e.g. ds.field('state') == 'CA',
+        and only the matching partitions are read.
+        """
+        if not os.path.isdir(self.stage_dir(stage)):
+            return pd.DataFrame(columns=columns or SCHEMAS[stage].names)
+        read_columns = None if columns is None else list(dict.fromkeys(columns + KEYS[stage] + ['ingested_at', 'empty']))
+        df = latest(self.dataset(stage).to_table(columns=read_columns, filter=filter).to_pandas(), stage)
+        # `empty` is null on rows written before the column existed
+        df = df[~df['empty'].eq(True)]
+        return df[columns] if columns is not None else df
+
+    def compact(self, stage, results_dir=RESULTS_DIR):
+        """
+        Rewrites a stage as one file per partition: existing rows plus every json
+        result in results/<stage>/, keeping each plant's latest result.
+        """
+        rows = []
+        stage_results = os.path.join(results_dir, stage)
+        if os.path.isdir(stage_results):
+            for filename in os.listdir(stage_results):
+                plant_code, ext = os.path.splitext(filename)
+                if ext != '.json' or not plant_code.isdigit():
+                    continue
+                path = os.path.join(stage_results, filename)
+                with open(path, 'r') as f:
+                    result = json.load(f)
+                rows.extend(self.rows_for(stage, plant_code, result, os.path.getmtime(path)))
+        tables = [pa.Table.from_pylist(rows, schema=SCHEMAS[stage])]
+        if os.path.isdir(self.stage_dir(stage)):
+            tables.append(self.dataset(stage).to_table())
+        df = pa.concat_tables(tables).to_pandas()
+        df = latest(df, stage)
+        table = pa.Table.from_pandas(df, schema=SCHEMAS[stage], preserve_index=False)
+        tmp_dir = self.stage_dir(stage) + '.compacting'
+        ds.write_dataset(
+            table, tmp_dir, format='parquet', partitioning=PARTITIONING, partitioning_flavor='hive',
+            basename_template='part-compacted-{i}.parquet', existing_data_behavior='delete_matching',
+        )
+        if os.path.isdir(self.stage_dir(stage)):
+            old_dir = self.stage_dir(stage) + '.old'
+            os.rename(self.stage_dir(stage), old_dir)
+            os.rename(tmp_dir, self.stage_dir(stage))
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(tmp_dir, self.stage_dir(stage))
+        return len(df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidated Parquet store of the pipeline results")
+    parser.add_argument('command', choices=['compact', 'stats'])
+    parser.add_argument('--stages', nargs='+', choices=list(SCHEMAS), default=list(SCHEMAS))
+    parser.add_argument('--plants', default='ready_to_search.csv', help="csv with plant_code, state and tech_type")
+    parser.add_argument('--root', default=STORE_DIR)
+    args = parser.parse_args()
+
+    partitions = load_plant_partitions(args.plants) if os.path.exists(args.plants) else {}
+    store = ResultsStore(args.root, partitions)
+    for stage in args.stages:
+        if args.command == 'compact':
+            start = time.time()
+            print(f"{stage}: {store.compact(stage)} rows ({time.time() - start:.1f}s)")
+        else:
+            df = store.load(stage, columns=['plant_code'])
+            print(f"{stage}: {len(df)} rows, {df['plant_code'].nunique()} plants")
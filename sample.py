@@ -1,6 +1,9 @@
 import modal
 
+from backends import get_backend
+
 stub = modal.Stub("example-get-started")
+backend = get_backend(stub)
 
 modal.Image.debian_slim(python_version="3.10").run_commands(
     "apt-get update",
@@ -9,12 +12,12 @@ modal.Image.debian_slim(python_version="3.10").run_commands(
 )
 
 
-@stub.function()
+@backend.function()
 def square(x):
     print("This code is running on a remote worker!")
     return x**2
 
 
-@stub.local_entrypoint()
+@backend.local_entrypoint()
 def main():
     print("the square is", square.remote(42))
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import urllib.parse
+
+import aiohttp
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from metrics import metrics
+from results_io import Manifest, iter_plants, write_result
+
+SEARCH_URL = os.environ.get('SERP_URL', 'http://www.google.com/search')
+
+# proxy responses worth retrying: rate limits, BrightData-side failures and upstream 5xx
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504, 520, 522, 524}
+# bad credentials or a blocked zone: every other query would fail the same way
+FATAL_STATUS = {401, 403, 407}
+
+
+class SerpError(Exception):
+    """A query that failed for good (e.g. a 400 for a malformed query, or retries ran out)."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class FatalSerpError(SerpError):
+    """The proxy rejected the credentials or zone; the client refuses further queries."""
+
+
+class RetryableSerpError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def normalize_query(query):
+    """Case-, whitespace- and quote-insensitive form of a search_query, used for de-duplication."""
+    query = str(query).replace('"', '').lower()
+    return re.sub(r"\s+", ' ', query).strip()
+
+
+def search_url(query, base_url=SEARCH_URL):
+    return f'{base_url}?q={urllib.parse.quote_plus(query)}&brd_json=1'
+
+
+class SerpClient:
+    """
+    Async client for the BrightData SERP proxy. All queries share one pooled
+    aiohttp session, so proxy connections are kept alive instead of opening a
+    new one per query, and at most `concurrency` queries are in flight.
+
+    Identical queries (after normalize_query) are sent once: concurrent callers
+    await the same request, and finished results are remembered for the life
+    of the client. Connection errors, timeouts, truncated bodies and
+    RETRYABLE_STATUS responses are retried with jittered exponential backoff;
+    other 4xx responses fail the query, and FATAL_STATUS responses fail it and
+    every query after it.
+
+    `base_url` may point at a local fake endpoint; pass proxy=None (or leave
+    BRIGHTDATA_SERP_KEY unset) to talk to it directly.
+    """
+
+    def __init__(self, proxy=..., base_url=SEARCH_URL, concurrency=100, timeout=60, max_tries=6,
+                 max_time=120, backoff_base=1.0):
+        self.proxy = os.environ.get('BRIGHTDATA_SERP_KEY') if proxy is ... else proxy
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.max_time = max_time
+        self.backoff_base = backoff_base
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.requests = {}
+        self.fatal = None
+        self.session = None
+        self.stats = {'requests': 0, 'retries': 0, 'deduplicated': 0}
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=10),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def fetch(self, query):
+        self.stats['requests'] += 1
+        async with self.semaphore:
+            start = time.monotonic()
+            try:
+                result = await self.fetch_json(query)
+            except Exception as e:
+                metrics.error('serp', e)
+                metrics.observe('serp_seconds', time.monotonic() - start, outcome='error')
+                raise
+            metrics.observe('serp_seconds', time.monotonic() - start, outcome='ok')
+            return result
+
+    async def fetch_json(self, query):
+        async with self.session.get(search_url(query, self.base_url), proxy=self.proxy) as r:
+            if r.status in FATAL_STATUS:
+                self.fatal = FatalSerpError(
+                    f"proxy returned {r.status}: {r.headers.get('x-luminati-error', r.reason)}", r.status)
+                raise self.fatal
+            if r.status in RETRYABLE_STATUS:
+                raise RetryableSerpError(f"proxy returned {r.status}", r.status)
+            if r.status >= 400:
+                raise SerpError(
+                    f"proxy returned {r.status} for {query!r}: {r.headers.get('x-luminati-error', r.reason)}", r.status)
+            body = await r.read()
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise RetryableSerpError(f"invalid json: {e}") from e
+
+    async def fetch_with_retries(self, query):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for attempt in range(self.max_tries):
+            if self.fatal is not None:
+                raise self.fatal
+            try:
+                return await self.fetch(query)
+            except (RetryableSerpError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError) as e:
+                error = e
+            except SerpError:
+                raise
+            except Exception as e:
+                # anything else (a redirect loop, an invalid URL, ...) fails this query only
+                raise SerpError(f"{query!r} failed: {e!r}") from e
+            delay = random.uniform(0, self.backoff_base * 2 ** attempt)
+            if attempt + 1 == self.max_tries or loop.time() - start + delay > self.max_time:
+                break
+            self.stats['retries'] += 1
+            await asyncio.sleep(delay)
+        raise SerpError(f"giving up on {query!r} after {attempt + 1} attempts: {error!r}") from error
+
+    async def search(self, query):
+        """The SERP json of a query; duplicate queries share one request."""
+        if self.fatal is not None:
+            raise self.fatal
+        key = normalize_query(query)
+        task = self.requests.get(key)
+        if task is None:
+            task = self.requests[key] = asyncio.ensure_future(self.fetch_with_retries(query))
+        else:
+            self.stats['deduplicated'] += 1
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            # let a later caller try a failed query again
+            if self.requests.get(key) is task:
+                del self.requests[key]
+            raise
+
+    async def search_all(self, plant_queries):
+        """Takes (plant_code, query) pairs and yields (plant_code, result or exception) as they arrive."""
+        async def run(plant_code, query):
+            try:
+                return plant_code, await self.search(query)
+            except SerpError as e:
+                return plant_code, e
+
+        tasks = [asyncio.create_task(run(plant_code, query)) for plant_code, query in plant_queries]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+
+async def search_async(query, **client_kwargs):
+    async with SerpClient(**client_kwargs) as client:
+        return await client.search(query)
+
+
+def get_search_results(search_query: str):
+    """Blocking single query, for callers outside an event loop."""
+    return asyncio.run(search_async(search_query))
+
+
+async def search_plants(plants, manifest=None, **client_kwargs):
+    """Searches (plant_code, query) pairs and writes results/search/{plant_code}.json as each arrives."""
+    failures = 0
+    async with SerpClient(**client_kwargs) as client:
+        with tqdm(total=len(plants), desc="search") as pbar:
+            async for plant_code, result in client.search_all(plants):
+                pbar.update(1)
+                if isinstance(result, Exception):
+                    failures += 1
+                    tqdm.write(f"search failed for plant code {plant_code}: {result}")
+                    continue
+                if manifest is not None:
+                    manifest.write('search', plant_code, result)
+                else:
+                    write_result('search', plant_code, result)
+    return client.stats, failures
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Search results for every plant through the BrightData SERP proxy")
+    parser.add_argument('--plants', default='ready_to_search.csv')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--base-url', default=SEARCH_URL, help="search endpoint, e.g. a local fake for testing")
+    parser.add_argument('--no-proxy', action='store_true', help="talk to --base-url directly")
+    args = parser.parse_args()
+
+    manifest = Manifest()
+    plants = [
+        (plant['plant_code'], plant['search_query']) for plant in iter_plants(args.plants, args.limit)
+        if manifest.status(plant['plant_code'], 'search') is None
+    ]
+    kwargs = {'proxy': None} if args.no_proxy else {}
+    stats, failures = asyncio.run(search_plants(plants, manifest, base_url=args.base_url,
+                                                concurrency=args.concurrency, **kwargs))
+    manifest.close()
+    print(f"{len(plants)} plants, {stats['requests']} requests ({stats['deduplicated']} duplicate queries, "
+          f"{stats['retries']} retries), {failures} failed")
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import threading
+
+
+class SqliteCache:
+    """
+    Base of the local SQLite caches (LLMCache, UrlCache, dedup.GradeCache): a
+    single WAL connection shared by threads behind a lock, hit and miss
+    counters, and optionally an LRU bound. Subclasses set `table` and the
+    `schema` statements; a bounded table needs `size` and `last_access`
+    columns, and is trimmed every 100 puts once it exceeds `max_bytes`.
+    """
+    table = None
+    schema = ()
+
+    def __init__(self, path, max_bytes=None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.schema:
+            self.conn.execute(statement)
+
+    def _put(self, row):
+        """Inserts or replaces a row; call with the lock held."""
+        self.conn.execute(f"INSERT OR REPLACE INTO {self.table} VALUES ({', '.join('?' * len(row))})", row)
+        self._puts += 1
+        if self.max_bytes is not None and self._puts % 100 == 0:
+            self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return 0
+        total = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        # trim to 90% of the bound so we don't evict on every put
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        evicted = []
+        for key, size in self.conn.execute(f"SELECT key, size FROM {self.table} ORDER BY last_access"):
+            evicted.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        self.conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", evicted)
+        return len(evicted)
+
+    def evict(self):
+        """Drops least recently used entries until under max_bytes."""
+        with self._lock:
+            return self._evict()
+
+    def close(self):
+        self.conn.close()
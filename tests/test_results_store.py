@@ -0,0 +1,34 @@
+from results_store import ResultsStore
+
+
+def relevance(*grades):
+    return {'scores_and_justifications': [
+        {'article_letter': chr(65 + i), 'grade': grade, 'justification': ''} for i, grade in enumerate(grades)
+    ]}
+
+
+def rescore(store, results, ingested_at):
+    store.write('article_relevance', [
+        row for plant_code, result in results.items()
+        for row in store.rows_for('article_relevance', plant_code, result, ingested_at)
+    ])
+
+
+def test_rescore_with_fewer_rows_supersedes_old_rows(tmp_path):
+    store = ResultsStore(str(tmp_path / 'store'))
+    rescore(store, {'1': relevance(5, 4, 3), '2': relevance(2, 2)}, ingested_at=1.0)
+    rescore(store, {'1': relevance(1), '2': []}, ingested_at=2.0)
+
+    df = store.load('article_relevance', columns=['plant_code', 'article_letter', 'grade'])
+    assert df.values.tolist() == [[1, 'A', 1]]
+
+
+def test_compact_keeps_only_the_latest_result(tmp_path):
+    store = ResultsStore(str(tmp_path / 'store'))
+    rescore(store, {'1': relevance(5, 4, 3), '2': relevance(2, 2)}, ingested_at=1.0)
+    rescore(store, {'1': relevance(1), '2': []}, ingested_at=2.0)
+    store.compact('article_relevance', results_dir=str(tmp_path / 'results'))
+
+    df = store.load('article_relevance', columns=['plant_code', 'article_letter', 'grade'])
+    assert df.values.tolist() == [[1, 'A', 1]]
+    assert len(store.dataset('article_relevance').to_table()) == 2  # plant 2's empty marker
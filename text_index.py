@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+from context_packer import OPPOSITION_KEYWORDS, article_header, format_docs, query_terms, split_paragraphs
+from llm_scheduler import estimate_tokens
+
+TEXT_INDEX_PATH = os.environ.get('TEXT_INDEX_PATH', 'cache/text_index.db')
+FAILURE_CONTENT = {'Could not access content', 'Timed out'}
+
+
+@dataclass
+class Hit:
+    plant_code: str
+    article_letter: str
+    score: float
+    title: str
+    snippet: str
+
+
+def json_version(path):
+    """Version of a results/content json as recorded by `build`, or None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"json:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def any_of(terms):
+    """An FTS5 query matching any of `terms`; multi-word terms are phrases ("zoning appeal")."""
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def summary_query(plant_info):
+    """Passages worth sending to get_project_summary: the project's names and places or the opposition keywords."""
+    terms = [f'"{term}"' for term in sorted(query_terms(plant_info or ''))]
+    return ' OR '.join(terms + [f'{keyword}*' for keyword in OPPOSITION_KEYWORDS])
+
+
+class TextIndex:
+    """
+    Full-text index over the articles of results/content, one row per
+    paragraph (context_packer.split_paragraphs), in an SQLite FTS5 table: its
+    positional postings answer phrase and prefix queries, and bm25() ranks the
+    matches. Words are Porter-stemmed, so "moratorium" also finds "moratoriums".
+
+    Each plant's paragraphs get consecutive rowids, recorded in `plants` with
+    the version of the content they came from, so `add_plant` only reindexes
+    plants that changed and per-plant queries are a rowid range of the index.
+    """
+
+    def __init__(self, path=TEXT_INDEX_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS passages USING fts5(
+                title, text, plant_code UNINDEXED, article_letter UNINDEXED, passage UNINDEXED,
+                tokenize = 'porter unicode61 remove_diacritics 2'
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS plants (
+                plant_code TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                first_rowid INTEGER,
+                last_rowid INTEGER
+            )
+        """)
+
+    def version(self, plant_code):
+        with self._lock:
+            row = self.conn.execute("SELECT version FROM plants WHERE plant_code = ?", (str(plant_code),)).fetchone()
+        return None if row is None else row[0]
+
+    def __contains__(self, plant_code):
+        return self.version(plant_code) is not None
+
+    def add_plant(self, plant_code, individual_results, version):
+        """(Re)indexes the articles of one plant unless `version` is already indexed. Returns True if it did."""
+        plant_code = str(plant_code)
+        rows = []
+        for article in individual_results:
+            content = article.get('content') or ''
+            if article.get('duplicate_of') or content in FAILURE_CONTENT:
+                continue
+            paragraphs = split_paragraphs(content) or ['']
+            for j, paragraph in enumerate(paragraphs):
+                # the title goes with the first paragraph only, so it counts once per article
+                title = f"{article.get('title') or ''}\n{article.get('description') or ''}" if j == 0 else ''
+                rows.append((title, paragraph, plant_code, article['article_letter'], j))
+        with self._lock:
+            previous = self.conn.execute("SELECT version, first_rowid, last_rowid FROM plants WHERE plant_code = ?",
+                                         (plant_code,)).fetchone()
+            if previous is not None and previous[0] == version:
+                return False
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if previous is not None and previous[1] is not None:
+                    self.conn.execute("DELETE FROM passages WHERE rowid BETWEEN ? AND ?", previous[1:])
+                first = last = None
+                if rows:
+                    first = (self.conn.execute("SELECT MAX(rowid) FROM passages").fetchone()[0] or 0) + 1
+                    last = first + len(rows) - 1
+                    self.conn.executemany(
+                        "INSERT INTO passages (rowid, title, text, plant_code, article_letter, passage) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [(first + i, *row) for i, row in enumerate(rows)],
+                    )
+                self.conn.execute("INSERT OR REPLACE INTO plants VALUES (?, ?, ?, ?)", (plant_code, version, first, last))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def search(self, query, limit=20, plant_codes=None):
+        """
+        The best-matching articles for an FTS5 query (see any_of), one hit per
+        article with the snippet of its best paragraph, best first.
+        """
+        params = [query]
+        where = ''
+        if plant_codes is not None:
+            plant_codes = [str(plant_code) for plant_code in plant_codes]
+            where = f" AND plant_code IN ({','.join('?' * len(plant_codes))})"
+            params += plant_codes
+        hits, seen = [], set()
+        with self._lock:
+            # rank first, then build snippets only for the rows that are returned
+            rows = self.conn.execute(
+                f"SELECT rowid, plant_code, article_letter, passage, bm25(passages, 2.0, 1.0) FROM passages "
+                f"WHERE passages MATCH ?{where} ORDER BY rank LIMIT ?",
+                params + [limit * 5],
+            ).fetchall()
+            for rowid, plant_code, letter, passage, score in rows:
+                if (plant_code, letter) in seen:
+                    continue
+                seen.add((plant_code, letter))
+                snippet = self.conn.execute(
+                    "SELECT snippet(passages, 1, '[', ']', '...', 16) FROM passages WHERE passages MATCH ? AND rowid = ?",
+                    (query, rowid),
+                ).fetchone()[0]
+                # an article's paragraphs have consecutive rowids, the first one holds the title
+                title = self.conn.execute("SELECT title FROM passages WHERE rowid = ?", (rowid - passage,)).fetchone()
+                hits.append(Hit(plant_code, letter, -score, title[0].split('\n')[0] if title else '', snippet))
+                if len(hits) == limit:
+                    break
+        return hits
+
+    def plants(self, query, limit=None):
+        """Plant codes with at least one article matching `query`, with their number of matching articles."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT plant_code, article_letter FROM passages WHERE passages MATCH ? ORDER BY rank", (query,)
+            ).fetchall()
+        # bm25() can't be aggregated in SQL; plants come in the order of their best paragraph
+        articles = {}
+        for plant_code, letter in rows:
+            articles.setdefault(plant_code, set()).add(letter)
+        return [(plant_code, len(letters)) for plant_code, letters in articles.items()][:limit]
+
+    def bounds(self, plant_code):
+        """First and last rowid of a plant's paragraphs, or None. Lookups by plant_code would scan the whole table."""
+        row = self.conn.execute("SELECT first_rowid, last_rowid FROM plants WHERE plant_code = ?",
+                                (str(plant_code),)).fetchone()
+        return None if row is None or row[0] is None else row
+
+    def passages(self, plant_code, query, letters=None):
+        """(article_letter, passage, text, score) of one plant's paragraphs matching `query`, best first."""
+        with self._lock:
+            bounds = self.bounds(plant_code)
+            if bounds is None:
+                return []
+            rows = self.conn.execute(
+                "SELECT article_letter, passage, text, bm25(passages, 2.0, 1.0) FROM passages "
+                "WHERE passages MATCH ? AND rowid BETWEEN ? AND ? ORDER BY rank",
+                (query, *bounds),
+            ).fetchall()
+        return [(letter, passage, text, -score) for letter, passage, text, score in rows
+                if letters is None or letter in letters]
+
+    def pack(self, plant_code, articles, plant_info, token_budget):
+        """
+        Same output as context_packer.pack_articles, but with the paragraphs
+        ranked by the index (bm25 of summary_query, weighted by the article's
+        grade) instead of re-scoring every paragraph of the plant.
+        """
+        full_text = format_docs(articles)
+        if estimate_tokens(full_text) <= token_budget:
+            return full_text
+        grades = {article['article_letter']: article.get('grade', 3) for article in articles}
+        used = sum(estimate_tokens(article_header(article)) for article in articles)
+        ranked = sorted(
+            ((score * grades[letter] / 5, letter, passage, text)
+             for letter, passage, text, score in self.passages(plant_code, summary_query(plant_info), set(grades))),
+            reverse=True,
+        )
+        selected = {}
+        for _, letter, passage, text in ranked:
+            cost = estimate_tokens(text)
+            if used + cost > token_budget:
+                continue
+            selected.setdefault(letter, {})[passage] = text
+            used += cost
+        with self._lock:
+            counts = dict(self.conn.execute(
+                "SELECT article_letter, MAX(passage) + 1 FROM passages WHERE rowid BETWEEN ? AND ? GROUP BY article_letter",
+                self.bounds(plant_code) or (0, -1),
+            ).fetchall())
+        docs = []
+        for article in articles:
+            letter = article['article_letter']
+            kept = []
+            for j in range(counts.get(letter, 1)):
+                if j in selected.get(letter, {}):
+                    kept.append(selected[letter][j])
+                elif not kept or kept[-1] != '...':
+                    kept.append('...')
+            body = "\n".join(kept)
+            docs.append(f"<doc>\n{article_header(article)}\n{body}\n</doc>")
+        return "\n".join(docs)
+
+    def optimize(self):
+        """Merges the index segments written by incremental adds, which speeds up queries after a large build."""
+        with self._lock:
+            self.conn.execute("INSERT INTO passages (passages) VALUES ('optimize')")
+
+    def close(self):
+        self.conn.close()
+
+
+def build(index, content_dir='results/content', corpus=None):
+    """
+    Indexes every plant of `content_dir` (and of the corpus, for plants whose
+    json was migrated away) whose content changed since it was last indexed.
+    Returns (indexed, unchanged).
+    """
+    indexed = unchanged = 0
+    filenames = os.listdir(content_dir) if os.path.isdir(content_dir) else []
+    json_codes = set()
+    for filename in filenames:
+        plant_code, ext = os.path.splitext(filename)
+        if ext != '.json' or not plant_code.isdigit():
+            continue
+        json_codes.add(plant_code)
+        version = json_version(os.path.join(content_dir, filename))
+        if index.version(plant_code) == version:
+            unchanged += 1
+            continue
+        with open(os.path.join(content_dir, filename), 'r') as f:
+            try:
+                content = json.load(f)
+            except ValueError:
+                continue
+        if isinstance(content, dict):
+            index.add_plant(plant_code, content.get('individual_results', []), version)
+            indexed += 1
+    if corpus is not None:
+        for plant_code, (start, _) in corpus.plants.items():
+            if str(plant_code) in json_codes:
+                continue
+            version = f"corpus:{int(corpus.index[start]['offset'])}"
+            if index.add_plant(plant_code, corpus.content(plant_code)['individual_results'], version):
+                indexed += 1
+            else:
+                unchanged += 1
+    return indexed, unchanged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Full-text index over the scraped articles")
+    parser.add_argument('--path', default=TEXT_INDEX_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="index new and changed plants of results/content and the corpus")
+    build_parser.add_argument('--content-dir', default='results/content')
+    search_parser = subparsers.add_parser('search', help="articles mentioning any of the terms, best first")
+    search_parser.add_argument('terms', nargs='*', help='words or phrases, e.g. moratorium referendum "zoning appeal"')
+    search_parser.add_argument('--query', help="a raw FTS5 query instead, e.g. 'moratori* NEAR(zoning appeal, 5)'")
+    search_parser.add_argument('--limit', type=int, default=20)
+    search_parser.add_argument('--plants', action='store_true', help="list matching plants instead of articles")
+    args = parser.parse_args()
+
+    index = TextIndex(args.path)
+    start = time.time()
+    if args.command == 'build':
+        from corpus import Corpus
+
+        corpus = Corpus()
+        indexed, unchanged = build(index, args.content_dir, corpus)
+        corpus.close()
+        if indexed:
+            index.optimize()
+        print(f"Indexed {indexed} plants ({unchanged} unchanged) in {time.time() - start:.1f}s")
+    else:
+        query = args.query or any_of(args.terms)
+        if args.plants:
+            results = index.plants(query, args.limit)
+            for plant_code, articles in results:
+                print(f"{plant_code}: {articles} articles")
+        else:
+            results = index.search(query, args.limit)
+            for hit in results:
+                print(f"{hit.plant_code} {hit.article_letter} ({hit.score:.2f}) {hit.title}\n    {hit.snippet}")
+        print(f"{len(results)} results in {(time.time() - start) * 1000:.0f} ms")
+    index.close()
@@ -0,0 +1,135 @@
+import argparse
+import hashlib
+import os
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from sqlite_cache import SqliteCache
+
+URL_CACHE_PATH = os.environ.get('URL_CACHE_PATH', 'cache/urls.db')
+
+TRACKING_PARAMS = {'gclid', 'fbclid', 'msclkid', 'mc_cid', 'mc_eid', 'ref_src', 'ocid', 'cmpid'}
+
+
+def normalize_url(url):
+    """
+    Canonical form of a URL so that the same article reached through different
+    search results maps to the same cache entry: lowercase scheme and host, no
+    default port, no fragment, no tracking parameters, sorted query.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and (scheme, parts.port) not in {('http', 80), ('https', 443)}:
+        host = f"{host}:{parts.port}"
+    path = parts.path or '/'
+    if path != '/' and path.endswith('/'):
+        path = path.rstrip('/')
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith('utm_') and k.lower() not in TRACKING_PARAMS
+    )
+    return urlunsplit((scheme, host, path, urlencode(query), ''))
+
+
+def url_key(url):
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+
+
+class UrlCache(SqliteCache):
+    """
+    Local SQLite cache of scraped links shared across plants, keyed by the hash
+    of the normalized URL. Entries expire after `ttl` seconds (`error_ttl` for
+    links that timed out or could not be accessed) and the least recently used
+    entries are evicted once the stored text exceeds `max_bytes`.
+    """
+
+    table = 'urls'
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS urls (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            status TEXT NOT NULL,
+            content_type TEXT,
+            text BLOB,
+            content BLOB,
+            max_chars INTEGER,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS urls_last_access ON urls (last_access)",
+    )
+
+    def __init__(self, path=URL_CACHE_PATH, max_bytes=2 * 1024 ** 3, ttl=30 * 24 * 3600, error_ttl=24 * 3600):
+        super().__init__(path, max_bytes)
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+
+    def get(self, url):
+        """Returns a dict with status, content_type, text and content, or None on a miss."""
+        key = url_key(url)
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT status, content_type, text, content, max_chars, created_at FROM urls WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            status, content_type, text, content, max_chars, created_at = row
+            ttl = self.ttl if status == 'ok' else self.error_ttl
+            if now - created_at > ttl:
+                self.conn.execute("DELETE FROM urls WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE urls SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return {
+            'status': status,
+            'content_type': content_type,
+            'text': zlib.decompress(text).decode('utf-8') if text is not None else None,
+            'content': zlib.decompress(content).decode('utf-8') if content is not None else None,
+            'max_chars': max_chars,
+        }
+
+    def put(self, url, status, content_type=None, text=None, content=None, max_chars=None):
+        text_blob = zlib.compress(text.encode('utf-8')) if text is not None else None
+        content_blob = zlib.compress(content.encode('utf-8')) if content is not None else None
+        size = len(text_blob or b'') + len(content_blob or b'')
+        now = time.time()
+        with self._lock:
+            self._put((url_key(url), normalize_url(url), status, content_type, text_blob, content_blob, max_chars,
+                       size, now, now))
+
+    def evict(self):
+        """Drops expired entries, then least recently used ones until under max_bytes."""
+        now = time.time()
+        with self._lock:
+            expired = self.conn.execute(
+                "DELETE FROM urls WHERE (status = 'ok' AND created_at < ?) OR (status != 'ok' AND created_at < ?)",
+                (now - self.ttl, now - self.error_ttl),
+            ).rowcount
+            return expired + self._evict()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM urls").fetchone()
+            by_status = dict(self.conn.execute("SELECT status, COUNT(*) FROM urls GROUP BY status").fetchall())
+        return {'entries': entries, 'bytes': size, 'by_status': by_status, 'hits': self.hits, 'misses': self.misses}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or trim the scraped URL cache")
+    parser.add_argument('command', choices=['stats', 'evict'])
+    parser.add_argument('--path', default=URL_CACHE_PATH)
+    args = parser.parse_args()
+
+    cache = UrlCache(args.path)
+    if args.command == 'stats':
+        print(cache.stats())
+    else:
+        print(f"Evicted {cache.evict()} entries")
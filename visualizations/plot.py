@@ -1,11 +1,15 @@
 import seaborn as sns
 import matplotlib.pyplot as plt
 import pickle
-import json
 import os
+import numpy as np
 import pandas as pd
+import sys
 from os.path import join as opj
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aggregate import align, load_grades, take
+
 VIZ_DIR ="/Users/anushreechaudhuri/pCloud Drive/MIT/MIT Work/Renewable Energy UROP/dispute-characterization/visualizations"
 
 CB91_Blue = '#2CBDFE'
@@ -57,29 +61,9 @@ sns.set_style("whitegrid", {'axes.grid' : False})
 
 
 def compute_avg_relevance():
-    def calculate_avg_score(plant_code):
-        path = f"results/article_relevance/{plant_code}.json"
-
-        if not os.path.exists(path):
-            return None
-
-        with open(path, "r") as f:
-            relevance_data = json.load(f)
-
-        try:
-            if relevance_data == []:
-                return None
-            scores = [item['grade'] for item in relevance_data.get('scores_and_justifications', [])]
-        except:
-            print(plant_code)
-            print(scores)
-
-        if scores:
-            return sum(scores) / len(scores)
-        else:
-            return None
-
-    joined_data['avg_relevance_score'] = joined_data['plant_code'].apply(calculate_avg_score)
+    grades = load_grades()
+    index = align(grades.plant_codes, joined_data['plant_code'].to_numpy(dtype='int64'))
+    joined_data['avg_relevance_score'] = take(grades.mean(), index)
     joined_data['avg_relevance_score'] = pd.to_numeric(joined_data['avg_relevance_score'], errors='coerce')
     return joined_data
 